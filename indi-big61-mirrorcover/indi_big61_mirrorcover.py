@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """indi_big61_mirrorcover.py
 
-One group - Main Control
+Two groups - Main Control, Engineering
 
 Main Control
 ------------
@@ -11,25 +11,137 @@ ITextVector : Opened, Closed, Error
     Opened - OK
     Closed - BUSY
     Error  - ALERT
+INumberVector : phase_timing
+    ETA, Phase Elapsed, Phase Expected, Phase P99
+    Opening and closing are timed from the command until the state
+    reaches Opened/Closed, ALERT when the phase runs past its p99
+ILightVector : phase_alerts
+    Opening, Closing - ALERT when the last run was slower than its p99
+
+Engineering
+-----------
+INumberVector : data_age
+    Seconds since the mirror cover state was acquired, ALERT (and states
+    ALERT) once older than stale_after. Vectors are stamped with the
+    acquisition time of their data.
+ISwitchVector : profiling
+    Start, Stop - runs cProfile for profile_window seconds
+ITextVector : profile
+    File and hottest functions of the last profile
+INumberVector : memory
+    RSS, RSS Peak, Traced, Traced Peak in MB, see indidrivers.memstats
+ITextVector : command_traces
+    Latest commands with where their time went, see indidrivers.tracing
+ITextVector : memory_growth
+    Source lines allocating the most since start, with
+    INDIDRIVERS_TRACEMALLOC=1
+ISwitchVector : log_level
+    Debug, Info, Warning, Error - messages below are dropped unformatted
+ISwitchVector : log_output
+    Clients (IDMessage), File (rotated, in the state directory)
+INumberVector : output_queue
+    Pending, Backlog, Sent, Coalesced, Dropped - updates waiting while
+    indiserver reads slowly, see indidrivers.outqueue
 
 Polling
 -------
 update : 1000ms
     Grabs the latest telemetry from the mirror covers and updates ITextVector
+update_memory : 10000ms
+    Publishes memory and memory_growth
 """
 # Python imports
+import asyncio
+import functools
 import sys
 from pathlib import Path
 
 sys.path.insert(0, str(Path.cwd().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
 # Github imports
-from mtnpy import Kuiper
 from pyindi.device import *
 
+# Local imports
+from indidrivers import clock
+from indidrivers.backend import make_telescope
+from indidrivers.config import config_path, load_config
+from indidrivers.freshness import Freshness
+from indidrivers.log import LEVELS, DriverLog
+from indidrivers.memstats import MemoryStats
+from indidrivers.metrics import DriverMetrics, MetricsServer
+from indidrivers.outqueue import OutputQueue
+from indidrivers.profiling import ProfilerControl
+from indidrivers.push import Push
+from indidrivers.reload import ConfigReloader, check_config
+from indidrivers.tracing import Tracer, switched_on
+from indidrivers.watchdog import Watchdog
+from indidrivers.paths import state_file
+from indidrivers.phases import (
+    PhaseTimer, phase_timing_properties, update_phase_properties
+)
+
 # Constants
 MYDEVICE = 'Mirror Cover'
 MAIN_CONTROL_GROUP = 'Main Control'
+ENGINEERING_GROUP = 'Engineering'
+
+# Defaults, override any of these in indi_big61_mirrorcover.json
+DEFAULT_CONFIG = {
+    # Log level (debug, info, warning, error) and where messages go, the
+    # log file is rotated at file_kb (see indidrivers.log)
+    'log': {
+        'level': 'info',
+        'clients': True,
+        'file': True,
+        'file_kb': 1024,
+    },
+    # Serve OpenMetrics on http://host:port/metrics, None to not serve
+    # (see indidrivers.metrics)
+    'metrics': {
+        'host': 'localhost',
+        'port': None,
+    },
+    # Seconds the Engineering profiling switch runs cProfile for
+    'profile_window': 30,
+    # Write every command's trace (queue, hardware call, motion, report) to
+    # mirror_cover_traces.json in the state directory, rotated at file_kb
+    # (see indidrivers.tracing)
+    'tracing': {
+        'file': True,
+        'file_kb': 1024,
+    },
+    # Seconds without fresh data before vectors go ALERT
+    'stale_after': 10,
+    # Seconds a poll may take. After misses of them without a poll finishing
+    # the poll is cancelled and the connection replaced (see
+    # indidrivers.watchdog)
+    'watchdog': {
+        'deadline': 5,
+        'misses': 3,
+    },
+    # At most one unsent update per vector is kept, a newer one replaces
+    # it. While indiserver has more than max_backlog messages unread the
+    # rest waits, looked at again every retry seconds, and only the last
+    # max_messages messages are kept (see indidrivers.outqueue)
+    'output': {
+        'max_backlog': 50,
+        'max_messages': 100,
+        'retry': 0.1,
+    },
+    # With a telemetry:// backend, receive change events instead of
+    # polling: the server samples every sample seconds and sends what
+    # changed, an empty event after keepalive seconds without a change.
+    # Polling resumes after misses keepalives without anything, subscribing
+    # is retried every retry seconds (see indidrivers.push)
+    'push': {
+        'enabled': True,
+        'sample': 0.05,
+        'keepalive': 2,
+        'misses': 3,
+        'retry': 30,
+    },
+}
 
 # State machine for mirror cover
 class MirrorCover():
@@ -77,9 +189,100 @@ class MirrorCover():
         else:
             return False
 
+    def phase(self):
+        """Returns the light name of the current phase"""
+        if not self.busy():
+            return 'idle'
+        if self._opening:
+            return 'mirror_cover_opening'
+        return 'mirror_cover_closing'
+
 # Globals
-telescope = Kuiper()
+CONFIG_PATH = config_path(__file__)
+config = load_config(CONFIG_PATH, DEFAULT_CONFIG)
+telescope = make_telescope('Kuiper')
 mirror_cover = MirrorCover()
+phase_timer = PhaseTimer(
+    {
+        'open': ['mirror_cover_opening'],
+        'close': ['mirror_cover_closing']
+    },
+    path=state_file('mirror_cover_phases.json')
+)
+log = DriverLog(MYDEVICE, **config['log'])
+profiler = ProfilerControl(
+    MYDEVICE, window=config['profile_window'], log=log
+)
+memstats = MemoryStats(MYDEVICE)
+output = OutputQueue(MYDEVICE, log=log, **config['output'])
+tracer = Tracer(MYDEVICE, log=log, **config['tracing'])
+freshness = Freshness(
+    {'mirror_cover': ['states']}, stale_after=config['stale_after']
+)
+metrics = DriverMetrics(
+    MYDEVICE,
+    [
+        'states', 'state_message', 'phase_timing', 'memory', 'heartbeat',
+        'output_queue'
+    ],
+    freshness=freshness
+)
+metrics_server = MetricsServer([metrics], **config['metrics'])
+
+
+def reconnect():
+    """Replaces the connection after the watchdog found a stalled poll"""
+    global telescope
+    old, telescope = telescope, make_telescope('Kuiper')
+    if hasattr(old, 'close'):
+        old.close()
+
+
+watchdog = Watchdog(
+    MYDEVICE, {'poll': config['watchdog']['deadline']},
+    misses=config['watchdog']['misses'], reconnect=reconnect, log=log
+)
+push = Push({'mirror_cover': ('mirror_cover', 'request_state')},
+            telescope='Kuiper', log=log, **config['push'])
+
+
+def apply_config(driver, new):
+    """Applies a reloaded config in place, returns what needs a restart"""
+    # Checked whole first, a config that fails leaves the driver as it was
+    check_config(
+        new,
+        configures=[
+            ('log', functools.partial(log.configure, driver)),
+            ('tracing', tracer.configure),
+            ('output', output.configure),
+            ('push', push.configure),
+        ],
+        numbers=[
+            'profile_window', 'stale_after', 'watchdog.deadline',
+            'watchdog.misses', 'output.max_backlog', 'output.max_messages',
+            'output.retry',
+        ],
+        choices={'log.level': LEVELS},
+    )
+    log.configure(driver, **new['log'])
+    profiler.window = new['profile_window']
+    tracer.configure(**new['tracing'])
+    freshness.stale_after = new['stale_after']
+    watchdog.deadlines['poll'] = new['watchdog']['deadline']
+    watchdog.misses = new['watchdog']['misses']
+    output.configure(**new['output'])
+    if new['push'] != reloader.current['push']:
+        push.configure(**new['push'])
+    if new['metrics'] != config['metrics']:
+        return ['metrics needs a restart']
+    return []
+
+
+reloader = ConfigReloader(
+    MYDEVICE, CONFIG_PATH,
+    lambda: load_config(CONFIG_PATH, DEFAULT_CONFIG, strict=True),
+    apply_config, config, log
+)
 
 class Device(device):
     def ISGetProperties(self, device=None):
@@ -136,10 +339,34 @@ class Device(device):
             'State Message', MAIN_CONTROL_GROUP
         )
         
+        phase_timing_nvp, phase_alerts_lvp = phase_timing_properties(
+            MYDEVICE, MAIN_CONTROL_GROUP, {
+                'mirror_cover_opening': 'Mirror Cover Opening',
+                'mirror_cover_closing': 'Mirror Cover Closing'
+            }
+        )
+        
         # Define properties
         self.IDDef(commands_svp)
         self.IDDef(state_message_lvp)
         self.IDDef(states_tvp)
+        self.IDDef(phase_timing_nvp)
+        self.IDDef(phase_alerts_lvp)
+        self.IDDef(freshness.properties(MYDEVICE, ENGINEERING_GROUP))
+        self.IDDef(tracer.properties(ENGINEERING_GROUP))
+        for vp in profiler.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in memstats.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in log.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in reloader.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in watchdog.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        self.IDDef(output.properties(ENGINEERING_GROUP))
+        metrics_server.ensure_started()
+        push.ensure_started(self.pushed)
 
         return
 
@@ -153,68 +380,100 @@ class Device(device):
         pass
 
     def ISNewSwitch(self, device, name, values, names):
+        if profiler.handle_switch(self, device, name, values, names):
+            return
+        if log.handle_switch(self, device, name, values, names):
+            return
+        if reloader.handle_switch(self, device, name, values, names):
+            return
+
         # Figure out what switch vp was clicked on
         if name == 'commands':
-            if mirror_cover.busy():
-                # Won't let mirror covers be sent a command when busy
-                # Busy means it is either opening or closing
-                self.IDMessage('BUSY ignoring button press')
+            trace = tracer.begin(name, switched_on(values, names))
+            # Sent as a task, with the async client a slow controller then
+            # never holds up the loop
+            asyncio.ensure_future(
+                self.command(device, name, values, names, trace)
+            )
+
+        return
+
+    async def command(self, device, name, values, names, trace):
+        """Sends the commands switch to the mirror covers"""
+        if mirror_cover.busy():
+            # Won't let mirror covers be sent a command when busy
+            # Busy means it is either opening or closing
+            log.warning('BUSY ignoring button press')
+            tracer.finish(trace, 'ignored')
+            return
+
+        svp = self.IUUpdate(device, name, values, names)
+        if svp['open'].value == 'On':
+            # Open the mirror covers
+            trace.step('command_open')
+            try:
+                ok = await watchdog.call(telescope.mirror_cover.command_open)
+                if not ok: raise
+
+            except Exception:
+                svp.state = IPState.ALERT
+                svp['open'].value = 'Off'
+                log.error('Failed to open mirror covers')
+                tracer.finish(trace, 'failed')
+                self.IDSet(svp)
+                return
+            tracer.wait(
+                trace, lambda data: data['mirror_cover_state'] == 'Opened'
+            )
+            
+            # Handle command being fine
+            svp.state = IPState.BUSY
+            
+            mirror_cover.opening = True
+            # Find state message, reset lights, update
+            try:
+                state_message_lvp = self.IUFind('state_message')
+            except ValueError:
                 return
+            reset_lights(state_message_lvp)
+            state_message_lvp['mirror_cover_opening'].value = IPState.BUSY
+            state_message_lvp.state = IPState.BUSY
 
-            svp = self.IUUpdate(device, name, values, names)
-            if svp['open'].value == 'On':
-                # Open the mirror covers
-                try:
-                    ok = telescope.mirror_cover.command_open()
-                    if not ok: raise
-
-                except Exception:
-                    svp.state = IPState.ALERT
-                    svp['open'].value = 'Off'
-                    self.IDMessage('Failed to open mirror covers')
-                    self.IDSet(svp)
-                    return
-                
-                # Handle command being fine
-                svp.state = IPState.BUSY
-                
-                mirror_cover.opening = True
-                # Find state message, reset lights, update
-                try:
-                    state_message_lvp = self.IUFind('state_message')
-                except ValueError:
-                    return
-                reset_lights(state_message_lvp)
-                state_message_lvp['mirror_cover_opening'].value = IPState.BUSY
-                state_message_lvp.state = IPState.BUSY
-
-            elif svp['close'].value == 'On':
-                # Close the mirror covers
-                try:
-                    ok = telescope.mirror_cover.command_close()
-                    if not ok: raise
-
-                except Exception:
-                    svp.state = IPState.ALERT
-                    svp['close'].value = 'Off'
-                    self.IDMessage('Failed to close mirror covers')
-                    self.IDSet(svp)
-                    return
-                
-                # Handle closing command ok
-                svp.state = IPState.BUSY
-                mirror_cover.closing = True
-                # Find state message, reset lights, update
-                try:
-                    state_message_lvp = self.IUFind('state_message')
-                except ValueError:
-                    return
-                reset_lights(state_message_lvp)
-                state_message_lvp['mirror_cover_closing'].value = IPState.BUSY
-                state_message_lvp.state = IPState.BUSY
+        elif svp['close'].value == 'On':
+            # Close the mirror covers
+            trace.step('command_close')
+            try:
+                ok = await watchdog.call(telescope.mirror_cover.command_close)
+                if not ok: raise
+
+            except Exception:
+                svp.state = IPState.ALERT
+                svp['close'].value = 'Off'
+                log.error('Failed to close mirror covers')
+                tracer.finish(trace, 'failed')
+                self.IDSet(svp)
+                return
+            tracer.wait(
+                trace, lambda data: data['mirror_cover_state'] == 'Closed'
+            )
             
-            self.IDSet(svp)
-            self.IDSet(state_message_lvp)
+            # Handle closing command ok
+            svp.state = IPState.BUSY
+            mirror_cover.closing = True
+            # Find state message, reset lights, update
+            try:
+                state_message_lvp = self.IUFind('state_message')
+            except ValueError:
+                return
+            reset_lights(state_message_lvp)
+            state_message_lvp['mirror_cover_closing'].value = IPState.BUSY
+            state_message_lvp.state = IPState.BUSY
+        
+        self.IDSet(svp)
+        self.IDSet(state_message_lvp)
+
+        # Phase starts with the command, not the next poll
+        self.update_phase_timing()
 
         return
 
@@ -222,10 +481,39 @@ class Device(device):
         pass
 
     # Poll decorator
-    # TODO make async
-    @device.repeat(1000)
+    @device.repeat(clock.period_ms(1000))
     def update(self):
         """Called after first getProperties is initiated then every x secs"""
+        if push.active():
+            return # Change events arrive instead
+        watchdog.start('poll', self.poll)
+
+    async def poll(self):
+        """Gets the mirror cover state and sets values"""
+        # Get the data from mirror cover
+        started = clock.time()
+        try:
+            data = await watchdog.call(telescope.mirror_cover.request_state)
+        except Exception as e:
+            metrics.polled('mirror_cover', clock.time() - started, ok=False)
+            self.update_mirror_cover(e)
+            return
+
+        metrics.polled('mirror_cover', clock.time() - started)
+        freshness.acquired('mirror_cover', started)
+        self.update_mirror_cover(data)
+
+    def pushed(self, channel, data, received):
+        """Publishes a change event (see indidrivers.push) like a poll"""
+        metrics.pushed(channel)
+        watchdog.beat('poll')
+        if not isinstance(data, Exception):
+            freshness.acquired(channel, received, received)
+        self.update_mirror_cover(data)
+
+    def update_mirror_cover(self, data):
+        """Updates the mirror cover properties with data, an Exception if
+        the request failed"""
         # Get the vp's for mirror cover
         try:
             states_tvp = self.IUFind('states')
@@ -234,21 +522,24 @@ class Device(device):
             # Could not find the vp's
             return
 
-        # Get the data from mirror cover
-        try:
-            data = telescope.mirror_cover.request_state()
-        except Exception:
-            # Set IDLE for all vector properties for mirror cover
-            states_tvp.state = IPState.IDLE
+        if isinstance(data, Exception):
+            # Set IDLE for all vector properties for mirror cover, ALERT if
+            # it has been a while
+            states_tvp.state = freshness.failed_state('mirror_cover')
             state_message_lvp.state = IPState.IDLE
             self.IDSet(states_tvp)
             self.IDSet(state_message_lvp)
             mirror_cover.state = None
             return
         
+        # Stamp with when the data was acquired
+        freshness.stamp('mirror_cover', states_tvp, state_message_lvp)
+
         # Go through data and update properties
         update_properties(data, states_tvp)
         mirror_cover.state = data['mirror_cover_state']
+        tracer.confirm(data, freshness.acquired_at['mirror_cover'])
+        self.update_phase_timing()
         
         # Set ALERT if error in mirror cover data
         indi_states = {
@@ -270,6 +561,7 @@ class Device(device):
                 return
             
             commands_svp.state = IPState.IDLE # Reset to IDLE since done
+            freshness.stamp('mirror_cover', commands_svp)
             for c in commands_svp:
                 c.value = 'Off'
             mirror_cover.reset() # Reset the opening and closing states
@@ -281,6 +573,52 @@ class Device(device):
 
         return
 
+    @device.repeat(clock.period_ms(1000))
+    def check_freshness(self):
+        """Publishes data age and flags stale vectors"""
+        freshness.check(self)
+
+    @device.repeat(10000)
+    def update_memory(self):
+        """Publishes memory use, in real time even when time is scaled"""
+        memstats.update(self)
+
+    @device.repeat(1000)
+    def check_watchdog(self):
+        """Recovers a stalled poll, publishes heartbeat and output_queue"""
+        watchdog.check(self)
+        output.update(self)
+
+    @device.repeat(2000)
+    def check_config(self):
+        """Reloads the config file when it changed"""
+        reloader.check(self)
+
+    def update_phase_timing(self):
+        """Feeds the phase timer and publishes ETA and slow phase alerts"""
+        try:
+            timing_nvp = self.IUFind('phase_timing')
+            alerts_lvp = self.IUFind('phase_alerts')
+        except ValueError:
+            return
+
+        was_slow = phase_timer.slow()
+        ended = {'Opened': 'open', 'Closed': 'close'}.get(mirror_cover.state)
+        phase_timer.update(mirror_cover.phase(), ended=ended)
+        slow = update_phase_properties(phase_timer, timing_nvp, alerts_lvp)
+        freshness.stamp('mirror_cover', timing_nvp, alerts_lvp)
+        if slow and not was_slow:
+            p99 = phase_timer.stats[phase_timer.phase].p99
+            log.warning(
+                '%s is slow, %.1fs > p99 %.1fs',
+                phase_timer.phase, phase_timer.elapsed(), p99
+            )
+
+        self.IDSet(timing_nvp)
+        self.IDSet(alerts_lvp)
+
+        return
+
 def no_csp(value):
     """Removes space and case"""
     return value.lower().replace(' ', '_')
@@ -313,4 +651,8 @@ def update_properties(data, vp):
     return
 
 driver = Device(name=MYDEVICE)
+log.attach(driver)
+output.attach(driver)
+metrics.attach(driver)
+tracer.attach(driver)
 driver.start()
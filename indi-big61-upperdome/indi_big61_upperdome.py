@@ -64,8 +64,91 @@ TP : states
     BUSY  : Same as above but any of them equal to Closed
     ALERT : Local Mode SW or Upperdome Faulted are true (yes)
 
+NP : phase_timing
+     ETA, Phase Elapsed, Phase Expected, Phase P99
+
+    Logic
+    -----
+    Every state message transition is timed, durations of phases that
+    completed normally feed a per phase distribution (see
+    indidrivers.phases). ETA is the time left in the current Open All or
+    Close All sequence.
+
+    LED NP Logic
+    ------------
+    IDLE  : Not moving
+    OK    : Never
+    BUSY  : Moving within the usual time
+    ALERT : Current phase has taken longer than its p99
+
+LP : phase_alerts
+     One light per opening/closing phase
+
+    LED LP Logic
+    ------------
+    IDLE  : Not enough samples for that phase yet
+    OK    : Last run of the phase was within its p99
+    ALERT : Last (or current) run of the phase went past its p99
+
 Engineering
 -----------
+SP : profiling
+     Start, Stop
+     Runs cProfile for profile_window seconds, see indidrivers.profiling
+
+TP : profile
+     File, Hot 1..5
+     Where the last profile was written and its hottest functions
+
+NP : memory
+     RSS, RSS Peak, Traced, Traced Peak (MB)
+     Published every 10 seconds, see indidrivers.memstats
+
+TP : memory_growth
+     Growth 1..3
+     Source lines that allocated the most since start, only filled when
+     started with INDIDRIVERS_TRACEMALLOC=1
+
+TP : command_traces
+     Trace 1..5
+     Latest commands with where their time went (queue, hardware call,
+     motion, report), see indidrivers.tracing
+
+SP : log_level
+     Debug, Info, Warning, Error
+     Messages below the level are dropped before being formatted, see
+     indidrivers.log
+
+SP : log_output
+     Clients, File
+     Send messages to clients with IDMessage and/or to a rotated log file
+     in the state directory
+
+NP : output_queue
+     Pending, Backlog, Sent, Coalesced, Dropped
+     Updates waiting while indiserver reads slowly, at most one per vector,
+     see indidrivers.outqueue
+
+NP : side_channel
+     Readers, Snapshots, Dropped
+     Readers of the binary snapshots on upper_dome.sock, see
+     indidrivers.sidechannel
+
+NP : data_age
+     Upperdome Age
+
+    Logic
+    -----
+    Seconds since the upperdome data shown was acquired, checked every
+    second. Every vector is stamped with the acquisition time of its data.
+
+    LED NP Logic
+    ------------
+    IDLE  : On startup
+    OK    : Data is fresh
+    ALERT : Data older than stale_after, states, state_message and details
+            are put in ALERT too
+
 TP : details
      Upperdome State Integer, Upperdome IO Byte, Upperdome Fault Byte, 
      Domeslit Opened LimitSW, Domeslit Closed LimitSW, UpperWS Opened LimitSW, 
@@ -84,15 +167,37 @@ TP : details
     ALERT : Never
 """
 # Python imports
+import asyncio
+import functools
 import sys
 from pathlib import Path
 
 sys.path.insert(0, str(Path.cwd().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
 # Github imports
-from mtnpy import Bok
 from pyindi.device import *
 
+# Local imports
+from indidrivers import clock
+from indidrivers.backend import make_telescope
+from indidrivers.config import config_path, load_config
+from indidrivers.freshness import Freshness
+from indidrivers.log import LEVELS, DriverLog
+from indidrivers.memstats import MemoryStats
+from indidrivers.metrics import DriverMetrics, MetricsServer
+from indidrivers.outqueue import OutputQueue
+from indidrivers.profiling import ProfilerControl
+from indidrivers.push import Push
+from indidrivers.reload import ConfigReloader, check_config
+from indidrivers.sidechannel import SideChannel
+from indidrivers.tracing import Tracer, switched_on
+from indidrivers.watchdog import Watchdog
+from indidrivers.paths import state_file
+from indidrivers.phases import (
+    PhaseTimer, phase_timing_properties, update_phase_properties
+)
+
 # Constants
 MYDEVICE = 'Upper Dome'
 MAIN_CONTROL_GROUP = 'Main Control'
@@ -130,6 +235,23 @@ DETAILS_TVP = [
     'UpperWS Faulted',
     'LowerWS Faulted',
 ]
+# Record of the side channel snapshots, fixed, readers may hard code it
+SIDE_CHANNEL_SCHEMA = [
+    ('upperdome_state_integer', 'B'),
+    ('upperdome_io_byte', 'B'),
+    ('upperdome_fault_byte', 'B'),
+    ('local_mode_sw', '?'),
+    ('upperdome_faulted', '?'),
+    ('domeslit_opened_limitsw', '?'),
+    ('domeslit_closed_limitsw', '?'),
+    ('upperws_opened_limitsw', '?'),
+    ('upperws_closed_limitsw', '?'),
+    ('lowerws_opened_limitsw', '?'),
+    ('lowerws_closed_limitsw', '?'),
+    ('domeslit_faulted', '?'),
+    ('upperws_faulted', '?'),
+    ('lowerws_faulted', '?'),
+]
 
 # State machine for upperdome
 class UpperDome():
@@ -148,9 +270,181 @@ class UpperDome():
         """Returns true is state is anything but idle"""
         return self._state != 'Idle'
 
+# Phases of Open All and Close All in the order the upperdome runs them
+PHASE_SEQUENCES = {
+    'open_all': [
+        'domeslit_opening',
+        'upper_windscreen_opening',
+        'lower_windscreen_opening',
+    ],
+    'close_all': [
+        'lower_windscreen_closing',
+        'upper_windscreen_closing',
+        'domeslit_closing',
+    ],
+}
+
+# Defaults, override any of these in indi_big61_upperdome.json
+DEFAULT_CONFIG = {
+    # Log level (debug, info, warning, error) and where messages go, the
+    # log file is rotated at file_kb (see indidrivers.log)
+    'log': {
+        'level': 'info',
+        'clients': True,
+        'file': True,
+        'file_kb': 1024,
+    },
+    # Serve OpenMetrics on http://host:port/metrics, None to not serve
+    # (see indidrivers.metrics)
+    'metrics': {
+        'host': 'localhost',
+        'port': None,
+    },
+    # Seconds the Engineering profiling switch runs cProfile for
+    'profile_window': 30,
+    # Write every command's trace (queue, hardware call, motion, report) to
+    # upper_dome_traces.json in the state directory, rotated at file_kb
+    # (see indidrivers.tracing)
+    'tracing': {
+        'file': True,
+        'file_kb': 1024,
+    },
+    # Seconds without fresh data before vectors go ALERT
+    'stale_after': 10,
+    # Seconds a poll may take. After misses of them without a poll finishing
+    # the poll is cancelled and the connection replaced (see
+    # indidrivers.watchdog)
+    'watchdog': {
+        'deadline': 5,
+        'misses': 3,
+    },
+    # At most one unsent update per vector is kept, a newer one replaces
+    # it. While indiserver has more than max_backlog messages unread the
+    # rest waits, looked at again every retry seconds, and only the last
+    # max_messages messages are kept (see indidrivers.outqueue)
+    'output': {
+        'max_backlog': 50,
+        'max_messages': 100,
+        'retry': 0.1,
+    },
+    # Serve the upperdome data as binary snapshots on a UNIX socket (path,
+    # None for upper_dome.sock in the state directory), one per poll or
+    # change event. Snapshots for a reader with more than max_buffer bytes
+    # unread are dropped (see indidrivers.sidechannel)
+    'side_channel': {
+        'enabled': False,
+        'path': None,
+        'max_buffer': 65536,
+    },
+    # With a telemetry:// backend, receive change events instead of
+    # polling: the server samples every sample seconds and sends what
+    # changed, an empty event after keepalive seconds without a change.
+    # Polling resumes after misses keepalives without anything, subscribing
+    # is retried every retry seconds (see indidrivers.push)
+    'push': {
+        'enabled': True,
+        'sample': 0.05,
+        'keepalive': 2,
+        'misses': 3,
+        'retry': 30,
+    },
+}
+
 # Globals
-telescope = Kuiper()
+CONFIG_PATH = config_path(__file__)
+config = load_config(CONFIG_PATH, DEFAULT_CONFIG)
+telescope = make_telescope('Kuiper')
 upper_dome = UpperDome()
+phase_timer = PhaseTimer(
+    PHASE_SEQUENCES, path=state_file('upperdome_phases.json')
+)
+log = DriverLog(MYDEVICE, **config['log'])
+profiler = ProfilerControl(
+    MYDEVICE, window=config['profile_window'], log=log
+)
+memstats = MemoryStats(MYDEVICE)
+output = OutputQueue(MYDEVICE, log=log, **config['output'])
+tracer = Tracer(MYDEVICE, log=log, **config['tracing'])
+side_channel = SideChannel(
+    MYDEVICE, ['upperdome'], SIDE_CHANNEL_SCHEMA, log=log,
+    **config['side_channel']
+)
+freshness = Freshness(
+    {'upperdome': ['state_message', 'states', 'details']},
+    stale_after=config['stale_after']
+)
+metrics = DriverMetrics(
+    MYDEVICE,
+    [
+        'states', 'state_message', 'details', 'phase_timing', 'memory',
+        'heartbeat', 'output_queue', 'side_channel'
+    ],
+    freshness=freshness
+)
+metrics_server = MetricsServer([metrics], **config['metrics'])
+
+
+def reconnect():
+    """Replaces the connection after the watchdog found a stalled poll"""
+    global telescope
+    old, telescope = telescope, make_telescope('Kuiper')
+    if hasattr(old, 'close'):
+        old.close()
+
+
+watchdog = Watchdog(
+    MYDEVICE, {'poll': config['watchdog']['deadline']},
+    misses=config['watchdog']['misses'], reconnect=reconnect, log=log
+)
+push = Push({'upperdome': ('upperdome', 'request_all')},
+            telescope='Kuiper', log=log, **config['push'])
+
+
+def apply_config(driver, new):
+    """Applies a reloaded config in place, returns what needs a restart"""
+    # Checked whole first, a config that fails leaves the driver as it was
+    check_config(
+        new,
+        configures=[
+            ('log', functools.partial(log.configure, driver)),
+            ('tracing', tracer.configure),
+            ('output', output.configure),
+            ('side_channel', side_channel.configure),
+            ('push', push.configure),
+        ],
+        numbers=[
+            'profile_window', 'stale_after', 'watchdog.deadline',
+            'watchdog.misses', 'output.max_backlog', 'output.max_messages',
+            'output.retry',
+        ],
+        choices={'log.level': LEVELS},
+    )
+    log.configure(driver, **new['log'])
+    profiler.window = new['profile_window']
+    tracer.configure(**new['tracing'])
+    freshness.stale_after = new['stale_after']
+    watchdog.deadlines['poll'] = new['watchdog']['deadline']
+    watchdog.misses = new['watchdog']['misses']
+    output.configure(**new['output'])
+    side_channel.configure(**new['side_channel'])
+    if new['push'] != reloader.current['push']:
+        push.configure(**new['push'])
+
+    notes = []
+    if new['metrics'] != config['metrics']:
+        notes.append('metrics needs a restart')
+    for key in ('enabled', 'path'):
+        if new['side_channel'][key] != config['side_channel'][key]:
+            notes.append(f'side_channel.{key} needs a restart')
+
+    return notes
+
+
+reloader = ConfigReloader(
+    MYDEVICE, CONFIG_PATH,
+    lambda: load_config(CONFIG_PATH, DEFAULT_CONFIG, strict=True),
+    apply_config, config, log
+)
 
 class Device(device):
     def ISGetProperties(self, device=None):
@@ -203,6 +497,17 @@ class Device(device):
         )
         self.IDDef(tvp)
 
+        # Build phase timing, lights only for the moving states
+        phases = {
+            no_csp(light): light for light in STATE_MESSAGE_LVP
+            if no_csp(light) in phase_timer.stats
+        }
+        nvp, lvp = phase_timing_properties(
+            MYDEVICE, MAIN_CONTROL_GROUP, phases
+        )
+        self.IDDef(nvp)
+        self.IDDef(lvp)
+
         # Build engineering group, all text read only property
         texts = []
         for text in DETAILS_TVP:
@@ -212,6 +517,23 @@ class Device(device):
             'Details', ENGINEERING_GROUP
         )
         self.IDDef(tvp)
+        self.IDDef(freshness.properties(MYDEVICE, ENGINEERING_GROUP))
+        self.IDDef(tracer.properties(ENGINEERING_GROUP))
+        for vp in profiler.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in memstats.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in log.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in reloader.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in watchdog.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        self.IDDef(output.properties(ENGINEERING_GROUP))
+        self.IDDef(side_channel.properties(ENGINEERING_GROUP))
+        metrics_server.ensure_started()
+        side_channel.ensure_started()
+        push.ensure_started(self.pushed)
 
         return
 
@@ -228,118 +550,193 @@ class Device(device):
     # FIXME Had to do this for IUUpdate as well since wrong order
     def ISNewSwitch(self, device, name, values, names):
         """A switch was updated by the client"""
+        if profiler.handle_switch(self, device, name, values, names):
+            return
+        if log.handle_switch(self, device, name, values, names):
+            return
+        if reloader.handle_switch(self, device, name, values, names):
+            return
+
         # Figure out what switch vp was clicked on
         if name == 'commands':
-            self.IDMessage(f'values are equal to {values} names={names}')
-            # If stop is selected...
-            stop = False
-            if 'stop' in names:
-                stop_index = names.index('stop')
-                stop = values[stop_index] == 'On'
-
-            # Even if busy let it send stop
-            if upper_dome.busy() and stop:
-                svp = self.IUUpdate(device, name, values, names)
-                # Send stop to upperdome
-                try:
-                    ok = telescope.upperdome.command_stop()
-                    if not ok: raise
-
-                    # Finish stop
-                    svp.state = IPState.BUSY
-                    self.IDMessage('Stopped upperdome')
-                    self.IDSet(svp)
-                    return 
-
-                except Exception:
-                    svp.state = IPState.ALERT
-                    svp['stop'].value = 'Off'
-                    self.IDMessage('Failed to stop upperdome')
-                    self.IDSet(svp)
-
-                    return
-                
-            elif upper_dome.busy():
-                # Don't let upperdome be sent a command unless it is stop
-                self.IDMessage('Busy...ignoring all buttons except stop')
+            trace = tracer.begin(name, switched_on(values, names))
+            # Sent as a task, with the async client a slow controller then
+            # never holds up the loop
+            asyncio.ensure_future(
+                self.command(device, name, values, names, trace)
+            )
+
+        return
+
+    async def command(self, device, name, values, names, trace):
+        """Sends the commands switch to the upperdome"""
+        log.debug('commands values=%s names=%s', values, names)
+        # If stop is selected...
+        stop = False
+        if 'stop' in names:
+            stop_index = names.index('stop')
+            stop = values[stop_index] == 'On'
+
+        # Even if busy let it send stop
+        if upper_dome.busy() and stop:
+            svp = self.IUUpdate(device, name, values, names)
+            # Send stop to upperdome
+            trace.step('command_stop')
+            try:
+                ok = await watchdog.call(telescope.upperdome.command_stop)
+                if not ok: raise
+
+                # Finish stop
+                svp.state = IPState.BUSY
+                log.info('Stopped upperdome')
+                tracer.wait(trace, stopped)
+                self.IDSet(svp)
+                return 
+
+            except Exception:
+                svp.state = IPState.ALERT
+                svp['stop'].value = 'Off'
+                log.error('Failed to stop upperdome')
+                tracer.finish(trace, 'failed')
+                self.IDSet(svp)
+
                 return
             
-            # Handle normal cases
-            svp = self.IUUpdate(device, name, values, names)
-            if svp['open_all'].value == 'On':
-                # Open all
-                try:
-                    ok = telescope.upperdome.command_all_open()
-                    if not ok: raise
-                except Exception:
-                    svp.state = IPState.ALERT
-                    svp['open_all'].value == 'Off'
-                    self.IDMessage('Failed to open all upperdome')
-                    self.IDSet(svp)
-                    
-                    return
-                
-                # SwitchLEDs are handled from state message
-
-            elif svp['close_all'].value == 'On':
-                # Close all
-                try:
-                    ok = telescope.upperdome.command_all_close()
-                    if not ok: raise
-                except Exception:
-                    svp.state = IPState.ALERT
-                    svp['close_all'].value == 'Off'
-                    self.IDMessage('Failed to close all upperdome')
-                    self.IDSet(svp)
-
-                    return
+        elif upper_dome.busy():
+            # Don't let upperdome be sent a command unless it is stop
+            log.warning('Busy...ignoring all buttons except stop')
+            tracer.finish(trace, 'ignored')
+            return
+        
+        # Handle normal cases
+        svp = self.IUUpdate(device, name, values, names)
+        if svp['open_all'].value == 'On':
+            # Open all
+            trace.step('command_all_open')
+            try:
+                ok = await watchdog.call(telescope.upperdome.command_all_open)
+                if not ok: raise
+            except Exception:
+                svp.state = IPState.ALERT
+                svp['open_all'].value == 'Off'
+                log.error('Failed to open all upperdome')
+                tracer.finish(trace, 'failed')
+                self.IDSet(svp)
                 
-            elif svp['stop'].value == 'On':
-                # Stop it
-                try:
-                    ok = telescope.upperdome.command_stop()
-                    if not ok: raise
-                    # Even though state message updates LED, want users to see
-                    # some busy light when stopped, even if a second
-                    svp.state = IPState.BUSY
-                except Exception:
-                    svp.state = IPState.ALERT
-                    svp['stop'].value == 'Off'
-                    self.IDMessage('Failed to stop upperdome')
-                    self.IDSet(svp)
-
-                    return
+                return
+            tracer.wait(trace, all_parts('Opened'))
             
-            # Update commands switch
-            self.IDSet(svp)
-                          
+            # SwitchLEDs are handled from state message
+
+        elif svp['close_all'].value == 'On':
+            # Close all
+            trace.step('command_all_close')
+            try:
+                ok = await watchdog.call(telescope.upperdome.command_all_close)
+                if not ok: raise
+            except Exception:
+                svp.state = IPState.ALERT
+                svp['close_all'].value == 'Off'
+                log.error('Failed to close all upperdome')
+                tracer.finish(trace, 'failed')
+                self.IDSet(svp)
+
+                return
+            tracer.wait(trace, all_parts('Closed'))
+            
+        elif svp['stop'].value == 'On':
+            # Stop it
+            trace.step('command_stop')
+            try:
+                ok = await watchdog.call(telescope.upperdome.command_stop)
+                if not ok: raise
+                # Even though state message updates LED, want users to see
+                # some busy light when stopped, even if a second
+                svp.state = IPState.BUSY
+            except Exception:
+                svp.state = IPState.ALERT
+                svp['stop'].value == 'Off'
+                log.error('Failed to stop upperdome')
+                tracer.finish(trace, 'failed')
+                self.IDSet(svp)
+
+                return
+            tracer.wait(trace, stopped)
+
+        else:
+            # Every switch Off, nothing to send
+            tracer.finish(trace, 'ignored')
+        
+        # Update commands switch
+        self.IDSet(svp)
+                      
         return
-                    
-    @device.repeat(1000)
+                
+    @device.repeat(clock.period_ms(1000))
     def update(self):
+        """Polls the upperdome unless the last poll is still running"""
+        if push.active():
+            return # Change events arrive instead
+        watchdog.start('poll', self.poll)
+
+    async def poll(self):
         """Gets the upperdome information and sets values"""
+        started = clock.time()
+        try:
+            data = await watchdog.call(telescope.upperdome.request_all)
+        except Exception as e:
+            metrics.polled('upperdome', clock.time() - started, ok=False)
+            self.update_upperdome(e)
+            return
+
+        metrics.polled('upperdome', clock.time() - started)
+        freshness.acquired('upperdome', started)
+        self.update_upperdome(data)
+
+    def pushed(self, channel, data, received):
+        """Publishes a change event (see indidrivers.push) like a poll"""
+        metrics.pushed(channel)
+        watchdog.beat('poll')
+        if not isinstance(data, Exception):
+            freshness.acquired(channel, received, received)
+        self.update_upperdome(data)
+
+    def update_upperdome(self, data):
+        """Updates the upperdome properties with data, an Exception if the
+        request failed"""
         try:
             engineering_details_tvp = self.IUFind('details')
             states_tvp = self.IUFind('states')
             state_message_lvp = self.IUFind('state_message')
         except ValueError:
-            self.IDMessage('Cannot retrieve vector property')
+            log.warning('Cannot retrieve vector property')
             return
 
-        try:
-            data = telescope.upperdome.request_all()
-        except Exception:
-            # Set to idle since failed to get
-            engineering_details_tvp.state = IPState.IDLE
-            states_tvp.state = IPState.IDLE
-            state_message_lvp.state = IPState.IDLE
+        if isinstance(data, Exception):
+            # Set to idle since failed to get, ALERT if it has been a while
+            state = freshness.failed_state('upperdome')
+            engineering_details_tvp.state = state
+            states_tvp.state = state
+            state_message_lvp.state = state
             self.IDSet(states_tvp)
             self.IDSet(engineering_details_tvp)
             self.IDSet(state_message_lvp)
             return
         
-        # Got a response, update state machine
+        # Got a response, stamp everything with when it was acquired
+        freshness.stamp(
+            'upperdome', engineering_details_tvp, states_tvp, state_message_lvp
+        )
+
+        # Update state machine
         upper_dome.state = data['upperdome_state_message']
+        tracer.confirm(data, freshness.acquired_at['upperdome'])
+        side_channel.publish(
+            'upperdome', data, freshness.acquired_at['upperdome']
+        )
+
+        # Time the phase and publish ETA
+        self.update_phase_timing(no_csp(upper_dome.state), ended(data))
 
         # Update the state message, lights come on depending on what state
         # Reset the lights back to default
@@ -386,6 +783,7 @@ class Device(device):
                 return
             
             commands.state = IPState.IDLE # Reset to IDLE since not busy
+            freshness.stamp('upperdome', commands)
 
             # Update switches for commands
             for c in commands:
@@ -395,6 +793,54 @@ class Device(device):
 
         return 
 
+    @device.repeat(clock.period_ms(1000))
+    def check_freshness(self):
+        """Publishes data age and flags stale vectors"""
+        freshness.check(self)
+
+    @device.repeat(10000)
+    def update_memory(self):
+        """Publishes memory use, in real time even when time is scaled"""
+        memstats.update(self)
+
+    @device.repeat(1000)
+    def check_watchdog(self):
+        """Recovers a stalled poll, publishes heartbeat, output_queue and
+        side_channel"""
+        watchdog.check(self)
+        output.update(self)
+        side_channel.update(self)
+
+    @device.repeat(2000)
+    def check_config(self):
+        """Reloads the config file when it changed"""
+        reloader.check(self)
+
+    def update_phase_timing(self, phase, ended=None):
+        """Feeds the phase timer and publishes ETA and slow phase alerts,
+        ended is the sequence the data shows finished"""
+        try:
+            timing_nvp = self.IUFind('phase_timing')
+            alerts_lvp = self.IUFind('phase_alerts')
+        except ValueError:
+            return
+
+        was_slow = phase_timer.slow()
+        phase_timer.update(phase, ended=ended)
+        slow = update_phase_properties(phase_timer, timing_nvp, alerts_lvp)
+        freshness.stamp('upperdome', timing_nvp, alerts_lvp)
+        if slow and not was_slow:
+            p99 = phase_timer.stats[phase_timer.phase].p99
+            log.warning(
+                '%s is slow, %.1fs > p99 %.1fs',
+                phase_timer.phase, phase_timer.elapsed(), p99
+            )
+
+        self.IDSet(timing_nvp)
+        self.IDSet(alerts_lvp)
+
+        return
+
 def no_csp(value):
     """Removes space and case"""
     return value.lower().replace(' ', '_')
@@ -403,6 +849,30 @@ def format_boolean(value):
     """Return yes or no"""
     return 'Yes' if value else 'No'
 
+def all_parts(state):
+    """Done condition of Open All or Close All for tracing"""
+    return lambda data: all(
+        data[f'{part}_state'] == state
+        for part in ('domeslit', 'upperws', 'lowerws')
+    )
+
+
+def ended(data):
+    """Sequence whose end data shows, Idle with every part Opened or
+    Closed, otherwise None"""
+    if data['upperdome_state_message'] != 'Idle':
+        return None
+    for sequence, state in (('open_all', 'Opened'), ('close_all', 'Closed')):
+        if all_parts(state)(data):
+            return sequence
+    return None
+
+
+def stopped(data):
+    """Done condition of Stop for tracing"""
+    return data['upperdome_state_message'] == 'Idle'
+
+
 def reset_lights(lvp, state=IPState.IDLE):
     """Resets the state of the light to state IDLE"""
     for light in lvp:
@@ -445,6 +915,10 @@ def update_properties(data, vp):
     return
 
 sk = Device(name=MYDEVICE)
+log.attach(sk)
+output.attach(sk)
+metrics.attach(sk)
+tracer.attach(sk)
 sk.start()
 
 
@@ -1,22 +1,388 @@
 #!/usr/bin/env python3
 
+import functools
 import sys
+import time
 from pathlib import Path
 
 sys.path.insert(0, str(Path.cwd().parent))
-
-
-from mtnpy import Kuiper
-#from aiomtnpy import Kuiper
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
 from pyindi.device import *
 
+from indidrivers import clock
+from indidrivers.backend import (
+    fetch_many, fetch_many_async, is_async, make_telescope
+)
+from indidrivers.config import config_path, load_config
+from indidrivers.derived import DerivedWeather
+from indidrivers.freshness import Freshness
+from indidrivers.log import LEVELS, DriverLog
+from indidrivers.memstats import MemoryStats
+from indidrivers.metrics import DriverMetrics, MetricsServer
+from indidrivers.outqueue import OutputQueue
+from indidrivers.profiling import ProfilerControl
+from indidrivers.interlock import Action, InterlockEngine, Rule
+from indidrivers.publish import DeadbandPublisher, as_float
+from indidrivers.push import Push
+from indidrivers.reload import ConfigReloader, check_config
+from indidrivers.sidechannel import SideChannel
+from indidrivers.watchdog import Watchdog
+from indidrivers.scheduling import AdaptivePoller
+
 MYDEVICE = 'Weather'
 OUTSIDE_GROUP = 'Outside'
 INSIDE_GROUP = 'Inside'
 BOLTWOOD_GROUP = 'Boltwood Information'
-
-telescope = Kuiper()
+INTERLOCK_GROUP = 'Safety Interlock'
+ENGINEERING_GROUP = 'Engineering'
+
+# Readings vectors, name -> (label, group, elements) with elements as
+# (name, format, min, max, label, unit)
+READINGS = {
+    'out_readings': ('Readings', OUTSIDE_GROUP, [
+        ('outside_temperature', '%.1f', -50, 60, 'Temperature', 'C'),
+        ('outside_humidity', '%.0f', 0, 100, 'Humidity', '%'),
+        ('outside_dew_point', '%.1f', -60, 60, 'Dew Point', 'C'),
+        ('wind_speed', '%.1f', 0, 200, 'Wind Speed', 'km/h'),
+    ]),
+    'in_readings': ('Readings', INSIDE_GROUP, [
+        ('tube_temperature', '%.2f', -50, 60, 'Tube Temperature', 'C'),
+        ('dome_temperature', '%.2f', -50, 60, 'Dome Temperature', 'C'),
+        ('dome_humidity', '%.0f', 0, 100, 'Dome Humidity', '%'),
+        ('dome_dew_point', '%.1f', -60, 60, 'Dome Dew Point', 'C'),
+    ]),
+    'boltwood': ('Boltwood', BOLTWOOD_GROUP, [
+        ('sky_temperature', '%.1f', -100, 60, 'Sky Temperature', 'C'),
+        (
+            'boltwood_sensor_temperature', '%.1f', -50, 60,
+            'Sensor Temperature', 'C'
+        ),
+        ('boltwood_heater', '%.0f', 0, 100, 'Heater', '%'),
+    ]),
+}
+# Record of the side channel snapshots, every reading as a double in the
+# order of READINGS, fixed, readers may hard code it
+SIDE_CHANNEL_SCHEMA = [
+    (element[0], 'd')
+    for _, _, elements in READINGS.values() for element in elements
+]
+
+# Defaults, override any of these in indi_big61_weather.json
+DEFAULT_CONFIG = {
+    # Publish out_readings, in_readings and boltwood as text vectors like
+    # before instead of numbers, for clients that still parse the strings
+    # (needs a restart)
+    'text_readings': False,
+    # Readings are only published when they move more than their deadband,
+    # at most every min_interval and at least every max_interval seconds
+    'publish': {
+        'min_interval': 0,
+        'max_interval': 30,
+        'deadbands': {
+            'outside_temperature': 0.2,
+            'outside_humidity': 1.0,
+            'outside_dew_point': 0.2,
+            'wind_speed': 1.0,
+            'tube_temperature': 0.1,
+            'dome_temperature': 0.1,
+            'dome_humidity': 1.0,
+            'dome_dew_point': 0.2,
+            'sky_temperature': 0.5,
+            'boltwood_sensor_temperature': 0.2,
+            'outside_spread': 0.2,
+            'outside_temperature_rate': 0.2,
+            'outside_humidity_rate': 1.0,
+            'dome_spread': 0.2,
+            'tube_dome_difference': 0.1,
+            'condensation_margin': 0.2,
+            'condensation_risk': 5.0,
+            'dome_temperature_rate': 0.2,
+            'dome_humidity_rate': 1.0,
+            # interlock_latency (ms)
+            'last': 1.0,
+        }
+    },
+    # Derived quantities (see indidrivers.derived): rates are smoothed over
+    # tau seconds, condensation risk rises as the tube gets within
+    # risk_margin C of the dome dew point, thresholds are [busy, alert]
+    # (falling for spreads and margin)
+    'derived': {
+        'tau': 600,
+        'risk_margin': 3.0,
+        'thresholds': {
+            'outside_spread': [3.0, 1.0],
+            'dome_spread': [3.0, 1.0],
+            'condensation_margin': [2.0, 0.5],
+            'condensation_risk': [50, 80],
+            'outside_temperature_rate': [5, 10],
+            'dome_humidity_rate': [20, 40],
+        },
+    },
+    # Log level (debug, info, warning, error) and where messages go, the
+    # log file is rotated at file_kb (see indidrivers.log)
+    'log': {
+        'level': 'info',
+        'clients': True,
+        'file': True,
+        'file_kb': 1024,
+    },
+    # Serve OpenMetrics on http://host:port/metrics, None to not serve
+    # (see indidrivers.metrics)
+    'metrics': {
+        'host': 'localhost',
+        'port': None,
+    },
+    # Seconds the Engineering profiling switch runs cProfile for
+    'profile_window': 30,
+    # Seconds without fresh data before a channel's vectors go ALERT, keep
+    # above the channel's max_period
+    'freshness': {
+        'stale_after': {
+            'boltwood': 15,
+            'onewire': 180,
+        }
+    },
+    # Seconds a poll may take. After misses of them without a poll finishing
+    # the poll is cancelled and the connection replaced (see
+    # indidrivers.watchdog)
+    'watchdog': {
+        'deadline': 5,
+        'misses': 3,
+    },
+    # At most one unsent update per vector is kept, a newer one replaces
+    # it. While indiserver has more than max_backlog messages unread the
+    # rest waits, looked at again every retry seconds, and only the last
+    # max_messages messages are kept (see indidrivers.outqueue)
+    'output': {
+        'max_backlog': 50,
+        'max_messages': 100,
+        'retry': 0.1,
+    },
+    # Serve the readings as binary snapshots on a UNIX socket (path, None
+    # for weather.sock in the state directory), one per poll or change
+    # event of either channel. Snapshots for a reader with more than
+    # max_buffer bytes unread are dropped (see indidrivers.sidechannel)
+    'side_channel': {
+        'enabled': False,
+        'path': None,
+        'max_buffer': 65536,
+    },
+    # With a telemetry:// backend, receive change events instead of
+    # polling: the server samples each channel every sample seconds and
+    # sends what changed, an empty event after keepalive seconds without a
+    # change. Polling resumes after misses keepalives without anything,
+    # subscribing is retried every retry seconds (see indidrivers.push)
+    'push': {
+        'enabled': True,
+        'sample': {
+            'boltwood': 0.05,
+            'onewire': 1.0,
+        },
+        'keepalive': 2,
+        'misses': 3,
+        'retry': 30,
+    },
+    # Each channel is checked every tick seconds and polled when due, its
+    # period moves between min_period and max_period with its activity
+    # (see indidrivers.scheduling). The boltwood feeds the interlock, it is
+    # never polled slower than every second like before, and at min_period
+    # while the interlock is armed
+    'polling': {
+        'tick': 0.25,
+        'boltwood': {
+            'min_period': 0.5,
+            'max_period': 1,
+            'scales': {
+                'outside_temperature': 0.5,
+                'outside_humidity': 2.0,
+                'wind_speed': 2.0,
+                'sky_temperature': 1.0,
+            },
+            'discrete': [
+                'cloud_condition',
+                'wind_condition',
+                'rain_condition',
+                'daylight_condition',
+            ],
+            # One step away from an ALERT light
+            'urgent': {
+                'rain_condition': ['Moist', 'Raining'],
+                'wind_condition': ['Windy', 'Very Windy'],
+                'cloud_condition': ['Cloudy', 'Very Cloudy'],
+            },
+            'thresholds': {},
+        },
+        'onewire': {
+            'min_period': 2,
+            'max_period': 60,
+            'scales': {
+                'tube_temperature': 0.2,
+                'dome_temperature': 0.2,
+                'dome_humidity': 2.0,
+                'dome_dew_point': 0.5,
+            },
+            'discrete': [],
+            'urgent': {},
+            # Condensation gets likely above 85% humidity
+            'thresholds': {'dome_humidity': [85, 10]},
+        },
+    },
+}
+CONFIG_PATH = config_path(__file__)
+config = load_config(CONFIG_PATH, DEFAULT_CONFIG)
+
+telescope = make_telescope('Kuiper')
+readings_publisher = DeadbandPublisher(**config['publish'])
+log = DriverLog(MYDEVICE, **config['log'])
+profiler = ProfilerControl(
+    MYDEVICE, window=config['profile_window'], log=log
+)
+memstats = MemoryStats(MYDEVICE)
+output = OutputQueue(MYDEVICE, log=log, **config['output'])
+side_channel = SideChannel(
+    MYDEVICE, ['boltwood', 'onewire'], SIDE_CHANNEL_SCHEMA, log=log,
+    **config['side_channel']
+)
+freshness = Freshness(
+    {
+        'boltwood': [
+            'out_readings', 'boltwood', 'cloud_condition', 'wind_condition',
+            'daylight_condition', 'rain_condition', 'derived_outside'
+        ],
+        'onewire': ['in_readings', 'derived_inside'],
+    },
+    **config['freshness']
+)
+metrics = DriverMetrics(
+    MYDEVICE,
+    [
+        'out_readings', 'in_readings', 'derived_outside', 'derived_inside',
+        'boltwood', 'cloud_condition',
+        'wind_condition', 'daylight_condition', 'rain_condition',
+        'interlock', 'interlock_status', 'interlock_latency', 'poll_rates',
+        'memory', 'heartbeat', 'output_queue', 'side_channel'
+    ],
+    freshness=freshness
+)
+metrics_server = MetricsServer([metrics], **config['metrics'])
+derived = DerivedWeather(MYDEVICE, **config['derived'])
+POLL_TICK_MS = clock.period_ms(config['polling']['tick'] * 1000)
+pollers = {
+    channel: AdaptivePoller(**config['polling'][channel])
+    for channel in ('boltwood', 'onewire')
+}
+
+
+def reconnect():
+    """Replaces the connection after the watchdog found a stalled poll"""
+    global telescope
+    old, telescope = telescope, make_telescope('Kuiper')
+    if hasattr(old, 'close'):
+        old.close()
+
+
+# The interlock runs in the poll, a hung poll leaves it blind
+watchdog = Watchdog(
+    MYDEVICE, {'poll': config['watchdog']['deadline']},
+    misses=config['watchdog']['misses'], reconnect=reconnect, log=log
+)
+push = Push(
+    {
+        'boltwood': ('boltwood', 'request_all'),
+        'onewire': ('onewire', 'request_all'),
+    },
+    telescope='Kuiper', log=log, **config['push']
+)
+
+
+def apply_config(driver, new):
+    """Applies a reloaded config in place, returns what needs a restart"""
+    # Checked whole first, a config that fails leaves the driver as it was
+    check_config(
+        new,
+        configures=[
+            ('log', functools.partial(log.configure, driver)),
+            ('output', output.configure),
+            ('side_channel', side_channel.configure),
+            ('push', push.configure),
+        ] + [
+            (f'polling.{channel}', poller.reconfigure)
+            for channel, poller in pollers.items()
+        ],
+        numbers=[
+            'publish.min_interval', 'publish.max_interval',
+            'publish.deadbands', 'freshness.stale_after', 'derived.tau',
+            'derived.risk_margin', 'derived.thresholds', 'profile_window',
+            'watchdog.deadline', 'watchdog.misses',
+            'output.max_backlog', 'output.max_messages', 'output.retry',
+        ] + [
+            f'polling.{channel}.{key}'
+            for channel in pollers for key in ('min_period', 'max_period')
+        ],
+        choices={'log.level': LEVELS},
+    )
+    readings_publisher.deadbands = dict(new['publish']['deadbands'])
+    readings_publisher.min_interval = new['publish']['min_interval']
+    readings_publisher.max_interval = new['publish']['max_interval']
+    freshness.stale_after = new['freshness']['stale_after']
+    derived.set_tau(new['derived']['tau'])
+    derived.risk_margin = new['derived']['risk_margin']
+    derived.thresholds = dict(new['derived']['thresholds'])
+    for channel, poller in pollers.items():
+        poller.reconfigure(**new['polling'][channel])
+    log.configure(driver, **new['log'])
+    profiler.window = new['profile_window']
+    watchdog.deadlines['poll'] = new['watchdog']['deadline']
+    watchdog.misses = new['watchdog']['misses']
+    output.configure(**new['output'])
+    side_channel.configure(**new['side_channel'])
+    if new['push'] != reloader.current['push']:
+        push.configure(**new['push'])
+
+    notes = []
+    if new['text_readings'] != config['text_readings']:
+        notes.append('text_readings needs a restart')
+    if new['polling']['tick'] != config['polling']['tick']:
+        notes.append('polling.tick needs a restart')
+    if new['metrics'] != config['metrics']:
+        notes.append('metrics needs a restart')
+    for key in ('enabled', 'path'):
+        if new['side_channel'][key] != config['side_channel'][key]:
+            notes.append(f'side_channel.{key} needs a restart')
+
+    return notes
+
+
+reloader = ConfigReloader(
+    MYDEVICE, CONFIG_PATH,
+    lambda: load_config(CONFIG_PATH, DEFAULT_CONFIG, strict=True),
+    apply_config, config, log
+)
+
+# Close the mirror cover first, it protects the most expensive glass
+interlock = InterlockEngine(
+    rules=[
+        Rule(
+            'rain',           # Name (also the light name)
+            'rain_condition', # Boltwood field to watch
+            ['Raining'],      # Values that trip the rule
+            trip_after=1,     # Consecutive bad polls before tripping
+            clear_after=900   # Seconds of good polls before clearing
+        )
+    ],
+    actions=[
+        Action(
+            'mirror_cover',
+            lambda: watchdog.call(telescope.mirror_cover.command_close)
+        ),
+        Action(
+            'upperdome',
+            lambda: watchdog.call(telescope.upperdome.command_all_close)
+        )
+    ],
+    budget=1.0
+)
 
 class WeatherDevice(device):
     def ISGetProperties(self, device=None):
@@ -103,59 +469,82 @@ class WeatherDevice(device):
             "Rain Condition", OUTSIDE_GROUP
         )
 
-        out_readings_t = [
-            IText(
-                'outside_temperature', # Name (for internal use)
-                '',                    # Value
-                'Temperature'          # Label (for display)
-            ),
-            IText('outside_humidity', '', 'Humidity'),
-            IText('outside_dew_point', '', 'Dew Point'),
-            IText('wind_speed', '', 'Wind Speed')
+        interlock_s = [
+            ISwitch('arm', ISState.OFF, 'Arm'),
+            ISwitch('disarm', ISState.ON, 'Disarm')
         ]
-
-        out_readings_tp = ITextVector(
-            out_readings_t, # List of IText properties
-            MYDEVICE,       # Device belongs to
-            'out_readings', # Name (for internal use)
-            IPState.IDLE,   # INDI state
-            IPerm.RO,       # INDI perm (RW/RO)
-            0,              # Timeout (float)
-            None,           # Timestamp
-            'Readings',     # Label (for display)
-            OUTSIDE_GROUP   # Group to attach to
+        interlock_sp = ISwitchVector(
+            interlock_s, MYDEVICE, 'interlock', IPState.IDLE,
+            ISRule.ONEOFMANY, IPerm.RW, 0, 'Interlock', INTERLOCK_GROUP
         )
 
-        in_readings_t = [
-            IText('tube_temperature', '', 'Tube Temperature'),
-            IText('dome_temperature', '', 'Dome Temperature'),
-            IText('dome_humidity', '', 'Dome Humidity'),
-            IText('dome_dew_point', '', 'Dome Dew Point')
+        interlock_status_l = [
+            ILight(rule.name, IPState.IDLE, rule.name.title())
+            for rule in interlock.rules
         ]
-
-        in_readings_tp = ITextVector(
-            in_readings_t, MYDEVICE, 'in_readings', IPState.IDLE, IPerm.RO, 0,
-            None, 'Readings', INSIDE_GROUP
+        interlock_status_lp = ILightVector(
+            interlock_status_l, MYDEVICE, 'interlock_status', IPState.IDLE, 0,
+            None, 'Tripped By', INTERLOCK_GROUP
         )
 
-        boltwood_t = [
-            IText('sky_temperature', '', 'Sky Temperature'),
-            IText('boltwood_sensor_temperature', '', 'Sensor Temperature'),
-            IText('boltwood_heater', '', 'Heater On')
+        interlock_latency_n = [
+            INumber('last', '%.0f', 0, 60000, 0, 0, 'Last Latency (ms)'),
+            INumber('max', '%.0f', 0, 60000, 0, 0, 'Max Latency (ms)'),
+            INumber(
+                'budget', '%.0f', 0, 60000, 0, interlock.budget * 1000,
+                'Budget (ms)'
+            )
         ]
-
-        boltwood_tp = ITextVector(
-            boltwood_t, MYDEVICE, 'boltwood', IPState.IDLE, IPerm.RO, 0, None,
-            'Boltwood', BOLTWOOD_GROUP
+        interlock_latency_np = INumberVector(
+            interlock_latency_n, MYDEVICE, 'interlock_latency', IPState.IDLE,
+            IPerm.RO, 0, None, 'Detection To Close', INTERLOCK_GROUP
         )
 
         self.IDDef(cloudConditionLP)
         self.IDDef(windConditionLP)
         self.IDDef(daylightConditionLP)
         self.IDDef(rainConditionLP)
-        self.IDDef(out_readings_tp)
-        self.IDDef(in_readings_tp)
-        self.IDDef(boltwood_tp)
+        self.IDDef(readings_vector('out_readings'))
+        self.IDDef(readings_vector('in_readings'))
+        for vp in derived.properties(OUTSIDE_GROUP, INSIDE_GROUP):
+            self.IDDef(vp)
+        self.IDDef(readings_vector('boltwood'))
+        self.IDDef(interlock_sp)
+        self.IDDef(interlock_status_lp)
+        self.IDDef(interlock_latency_np)
+
+        poll_rates_n = [
+            INumber(
+                f'{channel}_period', '%.2f', poller.min_period,
+                poller.max_period, 0, poller.period,
+                f'{channel.title()} Period (s)'
+            )
+            for channel, poller in pollers.items()
+        ]
+        poll_rates_np = INumberVector(
+            poll_rates_n, MYDEVICE, 'poll_rates', IPState.IDLE, IPerm.RO, 0,
+            None, 'Poll Rates', ENGINEERING_GROUP
+        )
+        self.IDDef(poll_rates_np)
+        self.IDDef(freshness.properties(MYDEVICE, ENGINEERING_GROUP))
+        for vp in profiler.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in memstats.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in log.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in reloader.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in watchdog.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        self.IDDef(output.properties(ENGINEERING_GROUP))
+        self.IDDef(side_channel.properties(ENGINEERING_GROUP))
+        metrics_server.ensure_started()
+        side_channel.ensure_started()
+        push.ensure_started(self.pushed)
+
+        # Whoever asked needs the readings again straight away
+        readings_publisher.forget()
         pass
 
     #def initProperties(self):
@@ -174,7 +563,7 @@ class WeatherDevice(device):
         mainloop
         """
 
-        self.IDMessage(f"Updating {name} text")
+        log.debug('Updating %s text', name)
         self.IUUpdate(device, name, names, values, Set=True)
 
     def ISNewNumber(self, device, name, names, values):
@@ -188,10 +577,10 @@ class WeatherDevice(device):
         mainloop
         """
 
-        self.IDMessage(f"Updating {name} number")
+        log.debug('Updating %s number', name)
         self.IUUpdate(device, name, names, values, Set=True)
 
-    def ISNewSwitch(self, device, name, names, values):
+    def ISNewSwitch(self, device, name, values, names):
 
         """A numer switch has been updated from the client.
         This function handles when a new switch
@@ -201,15 +590,81 @@ class WeatherDevice(device):
         """
 
 
-        self.IDMessage(f"{device}, {name=='CONNECTION'}, {names}, {values}")
+        log.debug('%s %s values=%s names=%s', device, name, values, names)
 
-    @device.repeat(1000)
-    def update_boltwood(self):
+        if profiler.handle_switch(self, device, name, values, names):
+            return
+        if log.handle_switch(self, device, name, values, names):
+            return
+        if reloader.handle_switch(self, device, name, values, names):
+            return
+
+        if name == 'interlock':
+            sp = self.IUUpdate(device, name, values, names)
+            if sp['arm'].value == 'On':
+                interlock.arm()
+                pollers['boltwood'].fast = True
+                sp.state = IPState.OK
+                log.info('Interlock armed')
+            else:
+                interlock.disarm()
+                pollers['boltwood'].fast = False
+                sp.state = IPState.IDLE
+                log.info('Interlock disarmed')
+            self.IDSet(sp)
+            self.update_interlock_status()
+
+    @device.repeat(POLL_TICK_MS)
+    def update(self):
+        """Polls unless the last poll is still running"""
+        if push.active():
+            return # Change events arrive instead
+        watchdog.start('poll', self.poll)
+
+    async def poll(self):
         """
-        This function is called after the first get
-        properties is initiated and then every 1000ms 
-        after that. 
+        This function is started after the first get
+        properties is initiated and then every tick
+        after that. Every channel that is due is
+        requested in one batch (one round trip with
+        the telemetry backend).
         """
+        due = [channel for channel, poller in pollers.items() if poller.due()]
+        if not due:
+            return
+
+        acquired = time.monotonic() # Interlock latency is real, never scaled
+        started = clock.time()
+        fetch = fetch_many_async if is_async(telescope) else fetch_many
+        results = await watchdog.call(
+            fetch, telescope, [(channel, 'request_all', ()) for channel in due]
+        )
+        finished = clock.time()
+        for channel, data in zip(due, results):
+            ok = not isinstance(data, Exception)
+            metrics.polled(channel, finished - started, ok)
+            if ok:
+                freshness.acquired(channel, started, finished)
+            if channel == 'boltwood':
+                await self.update_boltwood(data, acquired)
+            else:
+                self.update_onewire(data)
+
+    async def pushed(self, channel, data, received):
+        """Publishes a change event (see indidrivers.push) like a poll"""
+        acquired = time.monotonic()
+        metrics.pushed(channel)
+        watchdog.beat('poll')
+        if not isinstance(data, Exception):
+            freshness.acquired(channel, received, received)
+        if channel == 'boltwood':
+            await self.update_boltwood(data, acquired)
+        else:
+            self.update_onewire(data)
+
+    async def update_boltwood(self, data, acquired):
+        """Updates the boltwood properties with data, an Exception if the
+        request failed"""
         conditions = ['cloud', 'wind', 'rain', 'daylight']
         # Get the vp's for the boltwood
         try:
@@ -219,11 +674,11 @@ class WeatherDevice(device):
             # IUFind could not find the property
             return
         
-        # Get the data using mtnpy
-        try:
-            data = telescope.boltwood.request_all()
-        except Exception:
-            # Set IDLE for all vector properties for boltwood
+        if isinstance(data, Exception):
+            pollers['boltwood'].failed()
+            # Set IDLE for all vector properties for boltwood, ALERT if it
+            # has been a while
+            failed_state = freshness.failed_state('boltwood')
             for condition in conditions:
                 # Find the light vector property
                 try:
@@ -231,27 +686,39 @@ class WeatherDevice(device):
                 except ValueError:
                     # IUFind could not find the property
                     return
-                lvp_selector.state = IPState.IDLE
-                self.IDSet(lvp_selector)
+                lvp_selector.state = failed_state
+                readings_publisher.publish(self, lvp_selector)
                 
-            out_readings.state = IPState.IDLE
-            boltwood.state = IPState.IDLE
-            self.IDSet(out_readings)
-            self.IDSet(boltwood)
+            out_readings.state = failed_state
+            boltwood.state = failed_state
+            readings_publisher.publish(self, out_readings)
+            readings_publisher.publish(self, boltwood)
+            self.update_derived('derived_outside', failed_state)
 
             return
 
-        # Go through all conditions and update lights
+        # Interlock goes first so nothing delays a close
+        await self.check_interlock(data, acquired)
+        side_channel.publish(
+            'boltwood', data, freshness.acquired_at['boltwood']
+        )
+        if not push.active(): # Poll rates only matter while polling
+            self.update_poll_rate('boltwood', data)
+
+        # Go through all readings and update them
         for property in out_readings:
-            property.value = data[property.name]
+            set_reading(property, data[property.name])
         
         for property in boltwood:
-            property.value = data[property.name]
+            set_reading(property, data[property.name])
 
         out_readings.state = IPState.OK
         boltwood.state = IPState.OK
-        self.IDSet(out_readings)
-        self.IDSet(boltwood)
+        freshness.stamp('boltwood', out_readings, boltwood)
+        readings_publisher.publish(self, out_readings)
+        readings_publisher.publish(self, boltwood)
+        derived.update_outside(data, freshness.acquired_at['boltwood'])
+        self.update_derived('derived_outside')
         
         # Update the light properties from boltwood
         conditions = ['cloud', 'wind', 'rain', 'daylight']
@@ -271,35 +738,152 @@ class WeatherDevice(device):
             state = set_state(lp_selector)
             lp_selector.value = state
             lvp_selector.state = state
+            freshness.stamp('boltwood', lvp_selector)
             # Set the change
-            self.IDSet(lvp_selector)
+            readings_publisher.publish(self, lvp_selector)
         
         return
 
-    @device.repeat(1000)
-    def update_onewire(self):
-        """Gets the onewire information and sets values"""
+    def update_onewire(self, data):
+        """Updates the onewire properties with data, an Exception if the
+        request failed"""
         tvp_selector = self.IUFind('in_readings')
-        # Get the data using mtnpy
-        try:
-            data = telescope.onewire.request_all()
-        except Exception:
-            # Set to idle since failed to parse
-            tvp_selector.state = IPState.IDLE
-            self.IDSet(tvp_selector)
+        if isinstance(data, Exception):
+            pollers['onewire'].failed()
+            # Set to idle since failed to parse, ALERT if it has been a while
+            tvp_selector.state = freshness.failed_state('onewire')
+            readings_publisher.publish(self, tvp_selector)
+            self.update_derived('derived_inside', tvp_selector.state)
             return
         
+        side_channel.publish(
+            'onewire', data, freshness.acquired_at['onewire']
+        )
+
         # Go through and get all properties
         for key, value in data.items():
-            tp_selector = tvp_selector[key]
-
-            if isinstance(value, bool):
-                value = format_boolean(value)
-            
-            tp_selector.value = value
+            set_reading(tvp_selector[key], value)
 
         tvp_selector.state = IPState.OK
-        self.IDSet(tvp_selector)
+        freshness.stamp('onewire', tvp_selector)
+        readings_publisher.publish(self, tvp_selector)
+        derived.update_inside(data, freshness.acquired_at['onewire'])
+        self.update_derived('derived_inside')
+        if not push.active(): # Poll rates only matter while polling
+            self.update_poll_rate('onewire', data)
+
+    def update_derived(self, name, failed_state=None):
+        """Publishes a derived vector, with failed_state after a failed
+        poll"""
+        try:
+            nvp = self.IUFind(name)
+        except ValueError:
+            return
+        source = 'boltwood' if name == 'derived_outside' else 'onewire'
+        if failed_state is None:
+            derived.fill(nvp)
+            freshness.stamp(source, nvp)
+        else:
+            nvp.state = failed_state
+        readings_publisher.publish(self, nvp)
+
+    def update_poll_rate(self, channel, data):
+        """Adapts the channel period to data and publishes it if changed"""
+        poller = pollers[channel]
+        previous = poller.period
+        period = poller.sample(data)
+        try:
+            poll_rates_np = self.IUFind('poll_rates')
+        except ValueError:
+            return
+
+        if abs(period - previous) < 0.01 and poll_rates_np.state == IPState.OK:
+            return
+        poll_rates_np[f'{channel}_period'].value = period
+        poll_rates_np.state = IPState.OK
+        self.IDSet(poll_rates_np)
+
+    @device.repeat(clock.period_ms(1000))
+    def check_freshness(self):
+        """Publishes data age and flags stale vectors"""
+        freshness.check(self, publish=self.publish_stale)
+
+    @device.repeat(10000)
+    def update_memory(self):
+        """Publishes memory use, in real time even when time is scaled"""
+        memstats.update(self)
+
+    @device.repeat(1000)
+    def check_watchdog(self):
+        """Recovers a stalled poll, publishes heartbeat, output_queue and
+        side_channel"""
+        watchdog.check(self)
+        output.update(self)
+        side_channel.update(self)
+
+    @device.repeat(2000)
+    def check_config(self):
+        """Reloads the config file when it changed"""
+        reloader.check(self)
+
+    def publish_stale(self, vp):
+        """Sends a vector that went stale, past any deadband"""
+        self.IDSet(vp)
+        readings_publisher.forget(vp.name)
+
+    async def check_interlock(self, data, acquired):
+        """Runs the interlock on the latest boltwood data"""
+        ran = await interlock.evaluate(data, acquired)
+        for action, ok in ran:
+            if ok:
+                log.warning('Interlock sent close to %s', action.name)
+            else:
+                log.error('Interlock failed to close %s', action.name)
+
+        if ran and interlock.over_budget():
+            log.warning(
+                'Interlock took %.0f ms, budget is %.0f ms',
+                interlock.last_latency * 1000, interlock.budget * 1000
+            )
+
+        self.update_interlock_status()
+
+    def update_interlock_status(self):
+        """Sets the interlock lights and latency"""
+        try:
+            status_lp = self.IUFind('interlock_status')
+            latency_np = self.IUFind('interlock_latency')
+        except ValueError:
+            return
+
+        for light in status_lp:
+            rule = next(r for r in interlock.rules if r.name == light.name)
+            if not interlock.armed:
+                light.value = IPState.IDLE
+            elif rule.tripped:
+                light.value = IPState.ALERT
+            else:
+                light.value = IPState.OK
+        if not interlock.armed:
+            status_lp.state = IPState.IDLE
+        elif interlock.pending:
+            status_lp.state = IPState.ALERT # Tripped but not closed yet
+        elif interlock.tripped:
+            status_lp.state = IPState.BUSY
+        else:
+            status_lp.state = IPState.OK
+
+        if interlock.last_latency is not None:
+            latency_np['last'].value = interlock.last_latency * 1000
+            latency_np['max'].value = interlock.max_latency * 1000
+            if interlock.over_budget():
+                latency_np.state = IPState.ALERT
+            else:
+                latency_np.state = IPState.OK
+
+        freshness.stamp('boltwood', status_lp, latency_np)
+        readings_publisher.publish(self, status_lp)
+        readings_publisher.publish(self, latency_np)
 
 
 
@@ -316,6 +900,51 @@ def format_boolean(value):
     """Return yes or no"""
     return 'Yes' if value else 'No'
 
+def readings_vector(name):
+    """Builds the readings vector name from READINGS, as numbers with
+    units or as text with text_readings"""
+    label, group, elements = READINGS[name]
+    if config['text_readings']:
+        texts = [
+            IText(element, '', element_label)
+            for element, _, _, _, element_label, _ in elements
+        ]
+        return ITextVector(
+            texts, MYDEVICE, name, IPState.IDLE, IPerm.RO, 0, None, label,
+            group
+        )
+
+    numbers = [
+        INumber(
+            element,                     # Name (for internal use)
+            fmt,                         # printf format for display
+            minimum,                     # Min
+            maximum,                     # Max
+            0,                           # Step
+            0,                           # Value
+            f'{element_label} ({unit})'  # Label (for display)
+        )
+        for element, fmt, minimum, maximum, element_label, unit in elements
+    ]
+    return INumberVector(
+        numbers, MYDEVICE, name, IPState.IDLE, IPerm.RO, 0, None, label, group
+    )
+
+def set_reading(element, value):
+    """Sets a readings element, a value that is not a number leaves a
+    number element as it was"""
+    if config['text_readings']:
+        if isinstance(value, bool):
+            value = format_boolean(value)
+        element.value = value
+        return
+    if isinstance(value, bool):
+        value = int(value)
+    value = as_float(value)
+    if value is not None:
+        element.value = value
+    return
+
 def reset_lights(lvp_selector, state=IPState.IDLE):
     """Resets the state of the light to state IDLE"""
     for l in lvp_selector:
@@ -341,6 +970,9 @@ def pprint(value):
 
 
 sk = WeatherDevice(name=MYDEVICE)
+log.attach(sk)
+output.attach(sk)
+metrics.attach(sk)
 sk.start()
 
 
@@ -1,20 +1,184 @@
 #!/usr/bin/env python3
 # Python imports
+import asyncio
+import functools
 import sys
 from pathlib import Path
 
 sys.path.insert(0, str(Path.cwd().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
 # Github imports
-from mtnpy import Bok
 from pyindi.device import *
 
+# Local imports
+from indidrivers import clock
+from indidrivers.backend import make_telescope
+from indidrivers.config import config_path, load_config
+from indidrivers.freshness import Freshness
+from indidrivers.log import LEVELS, DriverLog
+from indidrivers.memstats import MemoryStats
+from indidrivers.metrics import DriverMetrics, MetricsServer
+from indidrivers.outqueue import OutputQueue
+from indidrivers.profiling import ProfilerControl
+from indidrivers.push import Push
+from indidrivers.reload import ConfigReloader, check_config
+from indidrivers.sequence import LAMPS, LampSequencer, switch_lamps
+from indidrivers.tracing import Tracer, switched_on
+from indidrivers.watchdog import Watchdog
+
 # Constants
 MYDEVICE = '90Prime Flatfield'
 MAIN_CONTROL_GROUP = 'Main Control'
+SEQUENCE_GROUP = 'Sequence'
+ENGINEERING_GROUP = 'Engineering'
+
+# Defaults, override any of these in indi_bok90_flatfield.json
+DEFAULT_CONFIG = {
+    # Log level (debug, info, warning, error) and where messages go, the
+    # log file is rotated at file_kb (see indidrivers.log)
+    'log': {
+        'level': 'info',
+        'clients': True,
+        'file': True,
+        'file_kb': 1024,
+    },
+    # Serve OpenMetrics on http://host:port/metrics, None to not serve
+    # (see indidrivers.metrics)
+    'metrics': {
+        'host': 'localhost',
+        'port': None,
+    },
+    # Seconds the Engineering profiling switch runs cProfile for
+    'profile_window': 30,
+    # Write every command's trace (queue, hardware calls, until the lamp
+    # status shows it) to 90prime_flatfield_traces.json in the state
+    # directory, rotated at file_kb (see indidrivers.tracing)
+    'tracing': {
+        'file': True,
+        'file_kb': 1024,
+    },
+    # While a lamp sequence runs, the lamp status is requested every
+    # confirm_interval seconds after a command until it shows the new state,
+    # for at most confirm_timeout seconds (see indidrivers.sequence)
+    'sequence': {
+        'confirm_interval': 0.05,
+        'confirm_timeout': 5,
+    },
+    # Seconds without fresh lamp status before commands goes ALERT
+    'stale_after': 5,
+    # Seconds a poll may take. After misses of them without a poll finishing
+    # the poll is cancelled and the connection replaced (see
+    # indidrivers.watchdog)
+    'watchdog': {
+        'deadline': 5,
+        'misses': 3,
+    },
+    # At most one unsent update per vector is kept, a newer one replaces
+    # it. While indiserver has more than max_backlog messages unread the
+    # rest waits, looked at again every retry seconds, and only the last
+    # max_messages messages are kept (see indidrivers.outqueue)
+    'output': {
+        'max_backlog': 50,
+        'max_messages': 100,
+        'retry': 0.1,
+    },
+    # With a telemetry:// backend, receive change events instead of
+    # polling: the server samples every sample seconds and sends what
+    # changed, an empty event after keepalive seconds without a change.
+    # Polling resumes after misses keepalives without anything, subscribing
+    # is retried every retry seconds (see indidrivers.push)
+    'push': {
+        'enabled': True,
+        'sample': 0.05,
+        'keepalive': 2,
+        'misses': 3,
+        'retry': 30,
+    },
+}
 
 # Globals
-telescope = Bok()
+CONFIG_PATH = config_path(__file__)
+config = load_config(CONFIG_PATH, DEFAULT_CONFIG)
+telescope = make_telescope('Bok')
+log = DriverLog(MYDEVICE, **config['log'])
+profiler = ProfilerControl(
+    MYDEVICE, window=config['profile_window'], log=log
+)
+memstats = MemoryStats(MYDEVICE)
+output = OutputQueue(MYDEVICE, log=log, **config['output'])
+tracer = Tracer(MYDEVICE, log=log, **config['tracing'])
+freshness = Freshness(
+    {'flatfield': ['commands']}, stale_after=config['stale_after']
+)
+metrics = DriverMetrics(
+    MYDEVICE,
+    ['commands', 'sequence_timing', 'memory', 'heartbeat', 'output_queue'],
+    freshness=freshness
+)
+metrics_server = MetricsServer([metrics], **config['metrics'])
+
+
+def reconnect():
+    """Replaces the connection after the watchdog found a stalled poll"""
+    global telescope
+    old, telescope = telescope, make_telescope('Bok')
+    if hasattr(old, 'close'):
+        old.close()
+
+
+watchdog = Watchdog(
+    MYDEVICE, {'poll': config['watchdog']['deadline']},
+    misses=config['watchdog']['misses'], reconnect=reconnect, log=log
+)
+sequencer = LampSequencer(
+    MYDEVICE, lambda: telescope.ninety_prime_flatfield, log=log,
+    call=watchdog.call, **config['sequence']
+)
+push = Push({'flatfield': ('ninety_prime_flatfield', 'request_all')},
+            telescope='Bok', log=log, **config['push'])
+
+
+def apply_config(driver, new):
+    """Applies a reloaded config in place, returns what needs a restart"""
+    # Checked whole first, a config that fails leaves the driver as it was
+    check_config(
+        new,
+        configures=[
+            ('log', functools.partial(log.configure, driver)),
+            ('tracing', tracer.configure),
+            ('sequence', sequencer.configure),
+            ('output', output.configure),
+            ('push', push.configure),
+        ],
+        numbers=[
+            'profile_window', 'stale_after', 'sequence.confirm_interval',
+            'sequence.confirm_timeout', 'watchdog.deadline',
+            'watchdog.misses', 'output.max_backlog', 'output.max_messages',
+            'output.retry',
+        ],
+        choices={'log.level': LEVELS},
+    )
+    log.configure(driver, **new['log'])
+    profiler.window = new['profile_window']
+    tracer.configure(**new['tracing'])
+    sequencer.configure(**new['sequence'])
+    freshness.stale_after = new['stale_after']
+    watchdog.deadlines['poll'] = new['watchdog']['deadline']
+    watchdog.misses = new['watchdog']['misses']
+    output.configure(**new['output'])
+    if new['push'] != reloader.current['push']:
+        push.configure(**new['push'])
+    if new['metrics'] != config['metrics']:
+        return ['metrics needs a restart']
+    return []
+
+
+reloader = ConfigReloader(
+    MYDEVICE, CONFIG_PATH,
+    lambda: load_config(CONFIG_PATH, DEFAULT_CONFIG, strict=True),
+    apply_config, config, log
+)
 
 class Device(device):
     def ISGetProperties(self, device=None):
@@ -34,9 +198,30 @@ class Device(device):
             MAIN_CONTROL_GROUP
         )
         self.IDDef(commands_sp)
+        for vp in sequencer.properties(SEQUENCE_GROUP):
+            self.IDDef(vp)
+        self.IDDef(freshness.properties(MYDEVICE, ENGINEERING_GROUP))
+        self.IDDef(tracer.properties(ENGINEERING_GROUP))
+        for vp in profiler.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in memstats.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in log.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in reloader.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in watchdog.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        self.IDDef(output.properties(ENGINEERING_GROUP))
+        metrics_server.ensure_started()
+        push.ensure_started(self.pushed)
 
     def ISNewText(self, device, name, values, names):
-        pass
+        """A text was updated by the client"""
+        if sequencer.handle_text(self, device, name, values, names):
+            return
+
+        return
 
     def ISNewNumber(self, device, name, values, names):
         pass
@@ -46,64 +231,116 @@ class Device(device):
 
     def ISNewSwitch(self, device, name, values, names):
         """A switch was updated by the client"""
+        if profiler.handle_switch(self, device, name, values, names):
+            return
+        if log.handle_switch(self, device, name, values, names):
+            return
+        if reloader.handle_switch(self, device, name, values, names):
+            return
+        if sequencer.handle_switch(self, device, name, values, names):
+            return
+
         # Figure out what switch vp was clicked on
-        if name == 'commands':
-            # commands are checkboxes, so do if statements, not elif
+        if name == 'commands' and sequencer.running:
+            # The sequence owns the lamps, show the client they did not
+            # change
+            log.warning('Sequence running, ignoring lamp switches')
+            self.IDSet(self.IUFind(name))
+        elif name == 'commands':
+            trace = tracer.begin(name, switched_on(values, names))
             sp = self.IUUpdate(device, name, values, names)
+            lamps = {
+                'halogen': sp['halogen_power'].value == 'On',
+                'uband': sp['uband_power'].value == 'On',
+            }
+            # Sent as a task, with the async client a slow controller then
+            # never holds up the loop
+            asyncio.ensure_future(self.command(sp, lamps, trace))
 
-            if sp['halogen_power'].value == 'On':
-                # Turn on halogen
-                try:
-                    ok = telescope.ninety_prime_flatfield.command_halogen(True)
-                    if not ok: raise
-                except Exception as e:
-                    self.IDMessage(error('Could not turn on halogen'))
-                    sp.state = IPState.ALERT
-
-            if sp['uband_power'].value == 'On':
-                # Turn on uband
-                try:
-                    ok = telescope.ninety_prime_flatfield.command_uband(True)
-                    if not ok: raise
-                except Exception as e:
-                    self.IDMessage(error('Could not turn on uband'))
-                    sp.state = IPState.ALERT
-
-            if sp['uband_power'].value == 'Off':
-                # Turn off uband
-                try:
-                    ok = telescope.ninety_prime_flatfield.command_uband(False)
-                    if not ok: raise
-                except Exception as e:
-                    self.IDMessage(error('Could not turn on uband'))
-                    sp.state = IPState.ALERT
-
-            if sp['halogen_power'].value == 'Off':
-                # Turn off halogen
-                try:
-                    ok = telescope.ninety_prime_flatfield.command_halogen(False)
-                    if not ok: raise
-                except Exception as e:
-                    self.IDMessage(error('Could not turn on halogen'))
-                    sp.state = IPState.ALERT
-
-            # Update switch
-            self.IDSet(sp)
+        return
+
+    async def command(self, sp, lamps, trace):
+        """Switches the lamps to lamps, the commands switch as clicked"""
+        # Only the clicked values count, polls publish the lamps into sp
+        # while the commands are on their way
+        failed = not await switch_lamps(
+            lambda: telescope.ninety_prime_flatfield, lamps,
+            call=watchdog.call, trace=trace, log=log
+        )
+        if failed:
+            sp.state = IPState.ALERT
+            tracer.finish(trace, 'failed')
+        else:
+            tracer.wait(
+                trace, lambda data: all(
+                    bool(data[LAMPS[lamp][1]]) == on
+                    for lamp, on in lamps.items()
+                )
+            )
+
+        # Update switch
+        self.IDSet(sp)
 
         return
 
-    @device.repeat(500)
+    @device.repeat(clock.period_ms(500))
     def update(self):
         """Called after first getProperties and gets the lamp status"""
+        if push.active():
+            return # Change events arrive instead
+        watchdog.start('poll', self.poll)
+
+    async def poll(self):
+        """Gets the lamp status and sets values"""
+        started = clock.time()
+        try:
+            data = await watchdog.call(
+                telescope.ninety_prime_flatfield.request_all
+            )
+        except Exception as e:
+            metrics.polled('flatfield', clock.time() - started, ok=False)
+            self.update_lamps(e)
+            return
+        metrics.polled('flatfield', clock.time() - started)
+        freshness.acquired('flatfield', started)
+        self.update_lamps(data)
+
+    def pushed(self, channel, data, received):
+        """Publishes a change event (see indidrivers.push) like a poll"""
+        metrics.pushed(channel)
+        watchdog.beat('poll')
+        if not isinstance(data, Exception):
+            freshness.acquired(channel, received, received)
+        self.update_lamps(data)
+
+    def sequenced(self, data):
+        """Publishes a lamp status requested by the sequencer like a poll"""
+        now = clock.time()
+        freshness.acquired('flatfield', now, now)
+        self.update_lamps(data)
+
+    @device.repeat(clock.period_ms(1000))
+    def update_sequence(self):
+        """Publishes sequence_timing while a sequence runs"""
+        if sequencer.running:
+            sequencer.update(self)
+
+    def update_lamps(self, data):
+        """Updates the commands switch with data, an Exception if the
+        request failed"""
         # Get current state
         sp = self.IUFind('commands')
-        try:
-            data = telescope.ninety_prime_flatfield.request_all()
-        except Exception as error:
-            self.IDMessage(error('Could not fetch flatfield status'))
+        if isinstance(data, Exception):
+            # Only the first failure in a row is worth telling clients about
+            if sp.state == IPState.ALERT:
+                log.debug('Could not fetch flatfield status: %s', data)
+            else:
+                log.error('Could not fetch flatfield status: %s', data)
             sp.state = IPState.ALERT
             self.IDSet(sp)
             return
+        freshness.stamp('flatfield', sp)
+        tracer.confirm(data, freshness.acquired_at['flatfield'])
         
         # Toggle on or off
         if data['uband_lamps']: sp['uband_power'].value = 'On'
@@ -118,17 +355,34 @@ class Device(device):
         self.IDSet(sp)
 
         return
-    
-def error(message):
-    return f'[ERROR] {message}'
-def warn(message):
-    return f'[WARN] {message}'
-def info(message):
-    return f'[INFO] {message}'
-def debug(message):
-    return f'[DEBUG] {message}'
 
+    @device.repeat(clock.period_ms(1000))
+    def check_freshness(self):
+        """Publishes data age and flags stale lamp status"""
+        freshness.check(self)
+
+    @device.repeat(10000)
+    def update_memory(self):
+        """Publishes memory use, in real time even when time is scaled"""
+        memstats.update(self)
+
+    @device.repeat(1000)
+    def check_watchdog(self):
+        """Recovers a stalled poll, publishes heartbeat and output_queue"""
+        watchdog.check(self)
+        output.update(self)
+
+    @device.repeat(2000)
+    def check_config(self):
+        """Reloads the config file when it changed"""
+        reloader.check(self)
+    
 driver = Device(name=MYDEVICE)
+log.attach(driver)
+output.attach(driver)
+metrics.attach(driver)
+tracer.attach(driver)
+sequencer.on_data = driver.sequenced
 driver.start()
             
 
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""indi_observatory_summary.py
+
+Weather, Upper Dome, Mirror Cover and 90Prime Flatfield in a few vectors
+for dashboards and the observing scheduler, see indidrivers.summary, and
+opening or closing all of them from one switch, see indidrivers.operations.
+
+Three groups - Summary, Operations, Engineering
+
+Summary
+-------
+ILightVector : safe
+    Weather, Dome, Mirror Cover, Data - the vector takes the worst
+ILightVector : open
+    Dome Slit, Upper Windscreen, Lower Windscreen, Mirror Cover
+    Opened - OK
+    Partially Opened - BUSY
+    Closed - IDLE
+ITextVector : status
+    Weather, Dome, Mirror Cover, Lamps
+INumberVector : conditions
+    Outside Temperature, Humidity, Dew Point, Wind Speed
+All four are sent only when they changed, with one timestamp per pass.
+
+Operations
+----------
+ISwitchVector : operations
+    Open, Close, Abort - runs the open or close plan, steps in parallel
+    where they can be
+ILightVector : operation_steps
+    Lamps Off, Mirror Cover, Dome, Weather - state of each step
+ITextVector : operation_report
+    Operation, Result and how long each step took
+INumberVector : operation_timing
+    Total, Steps Sum and the duration of each step in seconds
+
+Engineering
+-----------
+INumberVector : data_age
+    Seconds since each source was acquired, a stale source turns the Data
+    light ALERT
+ISwitchVector : profiling
+    Start, Stop - runs cProfile for profile_window seconds
+ITextVector : profile
+    File and hottest functions of the last profile
+INumberVector : memory
+    RSS, RSS Peak, Traced, Traced Peak in MB, see indidrivers.memstats
+ITextVector : memory_growth
+    Source lines allocating the most since start, with
+    INDIDRIVERS_TRACEMALLOC=1
+ISwitchVector : log_level
+    Debug, Info, Warning, Error - messages below are dropped unformatted
+ISwitchVector : log_output
+    Clients (IDMessage), File (rotated, in the state directory)
+INumberVector : output_queue
+    Pending, Backlog, Sent, Coalesced, Dropped - updates waiting while
+    indiserver reads slowly, see indidrivers.outqueue
+
+Polling
+-------
+update : 1000ms
+    Grabs the latest telemetry of every source in one batch
+update_operations : 1000ms
+    Publishes operation progress while a plan runs
+update_memory : 10000ms
+    Publishes memory and memory_growth
+"""
+# Python imports
+import functools
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path.cwd().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Github imports
+from pyindi.device import *
+
+# Local imports
+from indidrivers import clock
+from indidrivers.backend import (
+    fetch_many, fetch_many_async, is_async, make_telescope
+)
+from indidrivers.config import config_path, load_config
+from indidrivers.freshness import Freshness
+from indidrivers.log import LEVELS, DriverLog
+from indidrivers.memstats import MemoryStats
+from indidrivers.metrics import DriverMetrics, MetricsServer
+from indidrivers.operations import Coordinator
+from indidrivers.outqueue import OutputQueue
+from indidrivers.profiling import ProfilerControl
+from indidrivers.push import Push
+from indidrivers.reload import ConfigReloader, check_config
+from indidrivers.summary import SOURCES, ObservatorySummary
+from indidrivers.watchdog import Watchdog
+
+# Constants
+MYDEVICE = 'Observatory'
+SUMMARY_GROUP = 'Summary'
+OPERATIONS_GROUP = 'Operations'
+ENGINEERING_GROUP = 'Engineering'
+# The flatfield is on the Bok, everything else on the Kuiper
+BOK_SOURCES = ['flatfield']
+
+# Defaults, override any of these in indi_observatory_summary.json
+DEFAULT_CONFIG = {
+    # Log level (debug, info, warning, error) and where messages go, the
+    # log file is rotated at file_kb (see indidrivers.log)
+    'log': {
+        'level': 'info',
+        'clients': True,
+        'file': True,
+        'file_kb': 1024,
+    },
+    # Serve OpenMetrics on http://host:port/metrics, None to not serve
+    # (see indidrivers.metrics)
+    'metrics': {
+        'host': 'localhost',
+        'port': None,
+    },
+    # Seconds the Engineering profiling switch runs cProfile for
+    'profile_window': 30,
+    # Seconds without fresh data before the Data light goes ALERT
+    'stale_after': 10,
+    # conditions are only sent when a reading moves more than its deadband
+    'deadbands': {
+        'outside_temperature': 0.2,
+        'outside_humidity': 1.0,
+        'outside_dew_point': 0.2,
+        'wind_speed': 1.0,
+    },
+    # Open and Close request the status of a moving device every interval
+    # seconds, a step not done within its timeout fails (see
+    # indidrivers.operations)
+    'operations': {
+        'interval': 0.25,
+        'timeouts': {
+            'weather': 10,
+            'lamps_off': 10,
+            'mirror_cover': 120,
+            'dome': 300,
+        },
+    },
+    # Seconds a poll may take. After misses of them without a poll finishing
+    # the poll is cancelled and the connection replaced (see
+    # indidrivers.watchdog)
+    'watchdog': {
+        'deadline': 5,
+        'misses': 3,
+    },
+    # At most one unsent update per vector is kept, a newer one replaces
+    # it. While indiserver has more than max_backlog messages unread the
+    # rest waits, looked at again every retry seconds, and only the last
+    # max_messages messages are kept (see indidrivers.outqueue)
+    'output': {
+        'max_backlog': 50,
+        'max_messages': 100,
+        'retry': 0.1,
+    },
+    # With a telemetry:// backend, receive change events instead of
+    # polling: the server samples every sample seconds and sends what
+    # changed, an empty event after keepalive seconds without a change.
+    # Polling resumes after misses keepalives without anything, subscribing
+    # is retried every retry seconds (see indidrivers.push)
+    'push': {
+        'enabled': True,
+        'sample': 0.05,
+        'keepalive': 2,
+        'misses': 3,
+        'retry': 30,
+    },
+}
+
+# Globals
+CONFIG_PATH = config_path(__file__)
+config = load_config(CONFIG_PATH, DEFAULT_CONFIG)
+kuiper = make_telescope('Kuiper')
+bok = make_telescope('Bok')
+log = DriverLog(MYDEVICE, **config['log'])
+profiler = ProfilerControl(
+    MYDEVICE, window=config['profile_window'], log=log
+)
+memstats = MemoryStats(MYDEVICE)
+output = OutputQueue(MYDEVICE, log=log, **config['output'])
+# The summary goes stale as a whole through its Data light, not vector by
+# vector
+freshness = Freshness(
+    {source: [] for source in SOURCES}, stale_after=config['stale_after']
+)
+summary = ObservatorySummary(
+    MYDEVICE, freshness, deadbands=config['deadbands']
+)
+metrics = DriverMetrics(
+    MYDEVICE,
+    [
+        'safe', 'open', 'status', 'conditions', 'operation_steps',
+        'operation_timing', 'memory', 'heartbeat', 'output_queue'
+    ],
+    freshness=freshness
+)
+metrics_server = MetricsServer([metrics], **config['metrics'])
+
+
+def reconnect():
+    """Replaces the connections after the watchdog found a stalled poll"""
+    global kuiper, bok
+    old = [kuiper, bok]
+    kuiper, bok = make_telescope('Kuiper'), make_telescope('Bok')
+    for telescope in old:
+        if hasattr(telescope, 'close'):
+            telescope.close()
+
+
+def telescope_for(source):
+    """The telescope a source is on"""
+    return bok if source in BOK_SOURCES else kuiper
+
+
+watchdog = Watchdog(
+    MYDEVICE, {'poll': config['watchdog']['deadline']},
+    misses=config['watchdog']['misses'], reconnect=reconnect, log=log
+)
+coordinator = Coordinator(
+    MYDEVICE, telescope_for, log=log, call=watchdog.call,
+    **config['operations']
+)
+# One subscription per telescope, each may have its own telemetry server
+pushes = {
+    'Kuiper': Push(
+        {s: SOURCES[s] for s in SOURCES if s not in BOK_SOURCES},
+        telescope='Kuiper', log=log, **config['push']
+    ),
+    'Bok': Push(
+        {s: SOURCES[s] for s in BOK_SOURCES},
+        telescope='Bok', log=log, **config['push']
+    ),
+}
+
+
+def apply_config(driver, new):
+    """Applies a reloaded config in place, returns what needs a restart"""
+    # Checked whole first, a config that fails leaves the driver as it was
+    check_config(
+        new,
+        configures=[
+            ('log', functools.partial(log.configure, driver)),
+            ('operations', coordinator.configure),
+            ('output', output.configure),
+            ('push', pushes['Kuiper'].configure),
+        ],
+        numbers=[
+            'profile_window', 'stale_after', 'deadbands',
+            'operations.interval', 'operations.timeouts',
+            'watchdog.deadline', 'watchdog.misses', 'output.max_backlog',
+            'output.max_messages', 'output.retry',
+        ],
+        choices={'log.level': LEVELS},
+    )
+    log.configure(driver, **new['log'])
+    profiler.window = new['profile_window']
+    freshness.stale_after = new['stale_after']
+    coordinator.configure(**new['operations'])
+    summary.publisher.deadbands = dict(new['deadbands'])
+    watchdog.deadlines['poll'] = new['watchdog']['deadline']
+    watchdog.misses = new['watchdog']['misses']
+    output.configure(**new['output'])
+    if new['push'] != reloader.current['push']:
+        for push in pushes.values():
+            push.configure(**new['push'])
+    if new['metrics'] != config['metrics']:
+        return ['metrics needs a restart']
+    return []
+
+
+reloader = ConfigReloader(
+    MYDEVICE, CONFIG_PATH,
+    lambda: load_config(CONFIG_PATH, DEFAULT_CONFIG, strict=True),
+    apply_config, config, log
+)
+
+class Device(device):
+    def ISGetProperties(self, device=None):
+        """Builds and returns INDI properties for this device"""
+        # Define properties
+        for vp in summary.properties(SUMMARY_GROUP):
+            self.IDDef(vp)
+        for vp in coordinator.properties(OPERATIONS_GROUP):
+            self.IDDef(vp)
+        self.IDDef(freshness.properties(MYDEVICE, ENGINEERING_GROUP))
+        for vp in profiler.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in memstats.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in log.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in reloader.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        for vp in watchdog.properties(ENGINEERING_GROUP):
+            self.IDDef(vp)
+        self.IDDef(output.properties(ENGINEERING_GROUP))
+        metrics_server.ensure_started()
+        for push in pushes.values():
+            push.ensure_started(self.pushed)
+
+        return
+
+    def ISNewText(self, device, name, values, names):
+        pass
+
+    def ISNewNumber(self, device, name, values, names):
+        pass
+
+    def ISNewLight(self, device, name, values, names):
+        pass
+
+    def ISNewSwitch(self, device, name, values, names):
+        if profiler.handle_switch(self, device, name, values, names):
+            return
+        if log.handle_switch(self, device, name, values, names):
+            return
+        if reloader.handle_switch(self, device, name, values, names):
+            return
+        if coordinator.handle_switch(self, device, name, values, names):
+            return
+
+        return
+
+    # Poll decorator
+    @device.repeat(clock.period_ms(1000))
+    def update(self):
+        """Called after first getProperties is initiated then every x secs"""
+        if all(push.active() for push in pushes.values()):
+            return # Change events arrive instead
+        watchdog.start('poll', self.poll)
+
+    async def poll(self):
+        """Gets every source, one batch per telescope, and publishes"""
+        for name, telescope, sources in (
+            ('Kuiper', kuiper, [s for s in SOURCES if s not in BOK_SOURCES]),
+            ('Bok', bok, BOK_SOURCES),
+        ):
+            if pushes[name].active():
+                continue # Change events arrive instead
+            started = clock.time()
+            fetch = fetch_many_async if is_async(telescope) else fetch_many
+            results = await watchdog.call(
+                fetch, telescope,
+                [SOURCES[source] + ((),) for source in sources]
+            )
+            finished = clock.time()
+            for source, data in zip(sources, results):
+                ok = not isinstance(data, Exception)
+                metrics.polled(source, finished - started, ok)
+                if ok:
+                    freshness.acquired(source, started, finished)
+                summary.update(source, data)
+
+        summary.publish(self)
+
+    def pushed(self, channel, data, received):
+        """Publishes a change event (see indidrivers.push) like a poll"""
+        metrics.pushed(channel)
+        watchdog.beat('poll')
+        if not isinstance(data, Exception):
+            freshness.acquired(channel, received, received)
+        summary.update(channel, data)
+        summary.publish(self)
+
+    def operated(self, source, data):
+        """Publishes a status requested by an operation like a poll"""
+        now = clock.time()
+        freshness.acquired(source, now, now)
+        summary.update(source, data)
+        summary.publish(self)
+
+    @device.repeat(clock.period_ms(1000))
+    def update_operations(self):
+        """Publishes operation progress while a plan runs"""
+        if coordinator.running:
+            coordinator.publish(self)
+
+    @device.repeat(clock.period_ms(1000))
+    def check_freshness(self):
+        """Publishes data age, a source going stale changes safe"""
+        freshness.check(self)
+        summary.publish(self)
+
+    @device.repeat(10000)
+    def update_memory(self):
+        """Publishes memory use, in real time even when time is scaled"""
+        memstats.update(self)
+
+    @device.repeat(1000)
+    def check_watchdog(self):
+        """Recovers a stalled poll, publishes heartbeat and output_queue"""
+        watchdog.check(self)
+        output.update(self)
+
+    @device.repeat(2000)
+    def check_config(self):
+        """Reloads the config file when it changed"""
+        reloader.check(self)
+
+
+driver = Device(name=MYDEVICE)
+log.attach(driver)
+output.attach(driver)
+metrics.attach(driver)
+coordinator.on_data = driver.operated
+driver.start()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""indi_subsystem.py
+
+Runs a driver generated from a subsystem spec (see indidrivers.engine).
+
+    indi_subsystem.py specs/kuiper_upperdome.json
+
+indiserver does not pass arguments, so either wrap it in a shell script like
+the other drivers or set INDIDRIVERS_SPEC to the spec file. The spec file
+is reloaded when it changes, see indidrivers.engine.
+"""
+# Python imports
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path.cwd().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Local imports
+from indidrivers.engine import build_driver, load_spec
+
+if len(sys.argv) > 1:
+    spec_path = Path(sys.argv[1])
+elif os.environ.get('INDIDRIVERS_SPEC'):
+    spec_path = Path(os.environ['INDIDRIVERS_SPEC'])
+else:
+    sys.exit('usage: indi_subsystem.py SPEC (or set INDIDRIVERS_SPEC)')
+
+spec = load_spec(spec_path)
+Driver = build_driver(spec, spec_path)
+driver = Driver(name=spec['device'])
+driver.start()
@@ -0,0 +1,7 @@
+"""indidrivers
+
+Shared helpers for the pyindi drivers in this repo. Each driver script adds
+the repo root to sys.path and imports what it needs from here, e.g.
+
+    from indidrivers.phases import PhaseTimer
+"""
@@ -0,0 +1,194 @@
+"""backend.py
+
+Picks where a driver's telescope object comes from.
+
+INDIDRIVERS_BACKEND selects it:
+
+    mtnpy                      (default) mtnpy.Kuiper() / mtnpy.Bok()
+    sim                        indidrivers.simulator, speed from
+                               INDIDRIVERS_SIM_SPEED (default 1)
+    telemetry://host:port      RemoteTelescope over one pipelined connection
+                               to an indidrivers.telemetry server
+
+INDIDRIVERS_BACKEND_KUIPER and INDIDRIVERS_BACKEND_BOK override it for one
+telescope, a telemetry server serves only one (--telescope), so a driver
+using both needs one server each.
+
+fetch_many runs several calls as one batch when the telescope supports it
+(RemoteTelescope) and one after the other otherwise.
+
+INDIDRIVERS_CLIENT picks how the drivers talk to it:
+
+    sync                       (default) blocking calls, polls run them in
+                               the watchdog's worker thread
+    async                      methods are coroutines awaited on the pyindi
+                               loop: aiomtnpy for mtnpy (sync mtnpy if it is
+                               not installed), AsyncRemoteTelescope for
+                               telemetry://, AsyncTelescope around the
+                               simulator
+
+Drivers call hardware through Watchdog.call (indidrivers.watchdog), which
+runs a sync call on its one worker thread and awaits an async one, so the
+sync path stays as the fallback. invoke and fetch_many_async call either
+client on the loop.
+"""
+import asyncio
+import inspect
+import os
+import sys
+
+
+class _AsyncSubsystem():
+    def __init__(self, subsystem):
+        self._subsystem = subsystem
+
+    def __getattr__(self, method):
+        function = getattr(self._subsystem, method)
+
+        async def call(*args):
+            return function(*args)
+        call.__name__ = method
+        return call
+
+
+class AsyncTelescope():
+    """Coroutine methods around a telescope whose calls never block (the
+    simulator), for running drivers with INDIDRIVERS_CLIENT=async offline"""
+    asynchronous = True
+
+    def __init__(self, telescope):
+        self.telescope = telescope
+
+    def __getattr__(self, subsystem):
+        if subsystem.startswith('_'):
+            raise AttributeError(subsystem)
+        return _AsyncSubsystem(getattr(self.telescope, subsystem))
+
+
+def backend_for(name):
+    """Backend of telescope name, INDIDRIVERS_BACKEND_<NAME> or else
+    INDIDRIVERS_BACKEND"""
+    return (
+        os.environ.get(f'INDIDRIVERS_BACKEND_{name.upper()}')
+        or os.environ.get('INDIDRIVERS_BACKEND', 'mtnpy')
+    )
+
+
+def telemetry_address(backend=None):
+    """(host, port) of a telemetry:// backend, None for the others"""
+    if backend is None:
+        backend = os.environ.get('INDIDRIVERS_BACKEND', 'mtnpy')
+    if not backend.startswith('telemetry://'):
+        return None
+    host, _, port = backend[len('telemetry://'):].partition(':')
+    return host, int(port or 7700)
+
+
+def make_telescope(name, backend=None, client=None):
+    """Returns a telescope object
+
+    Parameters
+    ----------
+    name : str
+        'Kuiper' or 'Bok'
+    backend : str or None
+        See module docstring, None reads the telescope's backend_for
+    client : str or None
+        'sync' or 'async', None reads INDIDRIVERS_CLIENT
+    """
+    if backend is None:
+        backend = backend_for(name)
+    if client is None:
+        client = os.environ.get('INDIDRIVERS_CLIENT', 'sync')
+    asynchronous = client == 'async'
+
+    if backend == 'mtnpy':
+        if asynchronous:
+            try:
+                import aiomtnpy
+                return getattr(aiomtnpy, name)()
+            except ImportError:
+                # stdout belongs to indiserver, complain on stderr
+                sys.stderr.write('aiomtnpy not installed, using mtnpy\n')
+        import mtnpy
+        return getattr(mtnpy, name)()
+
+    if backend == 'sim':
+        from indidrivers import simulator
+        speed = float(os.environ.get('INDIDRIVERS_SIM_SPEED', 1.0))
+        telescope = getattr(simulator, f'Sim{name}')(speed=speed)
+        return AsyncTelescope(telescope) if asynchronous else telescope
+
+    address = telemetry_address(backend)
+    if address is not None:
+        from indidrivers import telemetry
+        if asynchronous:
+            return telemetry.AsyncRemoteTelescope(
+                telemetry.AsyncTelemetryClient(*address)
+            )
+        return telemetry.RemoteTelescope(telemetry.TelemetryClient(*address))
+
+    raise ValueError(f'Unknown backend {backend}')
+
+
+def fetch_many(telescope, calls):
+    """Runs calls, batched into one round trip if the telescope can
+
+    Parameters
+    ----------
+    calls : list of (subsystem, method, args)
+
+    Returns
+    -------
+    list
+        Result of each call in order, an Exception instance where it failed
+    """
+    if hasattr(type(telescope), 'request_many'):
+        try:
+            return telescope.request_many(calls)
+        except Exception as e:
+            return [e] * len(calls)
+
+    results = []
+    for subsystem, method, args in calls:
+        try:
+            results.append(getattr(getattr(telescope, subsystem), method)(*args))
+        except Exception as e:
+            results.append(e)
+
+    return results
+
+
+def is_async(telescope):
+    """True if the telescope's methods are coroutines"""
+    return getattr(telescope, 'asynchronous', False) or \
+        type(telescope).__module__.split('.')[0] == 'aiomtnpy'
+
+
+async def invoke(function, *args):
+    """Calls a telescope method of either client, awaiting it if needed
+
+    With the sync client the call blocks the loop, drivers send hardware
+    calls through Watchdog.call instead so they never run next to a poll.
+    """
+    result = function(*args)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+async def fetch_many_async(telescope, calls):
+    """fetch_many for async telescopes, calls run concurrently"""
+    if hasattr(type(telescope), 'request_many'):
+        try:
+            return await telescope.request_many(calls)
+        except Exception as e:
+            return [e] * len(calls)
+
+    return await asyncio.gather(
+        *(
+            invoke(getattr(getattr(telescope, subsystem), method), *args)
+            for subsystem, method, args in calls
+        ),
+        return_exceptions=True
+    )
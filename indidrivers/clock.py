@@ -0,0 +1,45 @@
+"""clock.py
+
+Driver time that can run faster than wall time.
+
+Normally this is just time.monotonic and time.time. For soak tests
+INDIDRIVERS_TIME_SCALE=N makes driver time run N times faster: repeat
+periods given to period_ms shrink by N and monotonic()/time() advance N
+seconds per real second, so pollers, deadbands, data age and the simulator
+all agree that a month went by in a month / N.
+"""
+import asyncio
+import os
+import time as _time
+
+SCALE = float(os.environ.get('INDIDRIVERS_TIME_SCALE', 1.0))
+
+_mono_start = _time.monotonic()
+_wall_start = _time.time()
+
+
+def monotonic():
+    """time.monotonic() in driver time"""
+    if SCALE == 1.0:
+        return _time.monotonic()
+    return _mono_start + (_time.monotonic() - _mono_start) * SCALE
+
+
+def time():
+    """time.time() in driver time"""
+    if SCALE == 1.0:
+        return _time.time()
+    return _wall_start + (_time.monotonic() - _mono_start) * SCALE
+
+
+async def sleep_until(deadline):
+    """Sleeps until monotonic() reaches deadline, without drift from
+    earlier sleeps"""
+    remaining = deadline - monotonic()
+    if remaining > 0:
+        await asyncio.sleep(remaining / SCALE)
+
+
+def period_ms(ms):
+    """Real milliseconds for a repeat period of ms in driver time"""
+    return max(1, round(ms / SCALE))
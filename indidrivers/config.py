@@ -0,0 +1,62 @@
+"""config.py
+
+Optional JSON configuration for the drivers.
+
+Each driver keeps its defaults in a dict next to its constants and calls
+load_config with the path of a JSON file (by default the driver file with a
+.json suffix). Anything in the file overrides the defaults, nested dicts are
+merged key by key so a file only needs what it changes, e.g.
+
+    {"publish": {"deadbands": {"wind_speed": 2.0}}}
+
+With INDIDRIVERS_CONFIG_DIR set the files are looked up there instead
+(config_path), e.g. to keep them out of the checkout or to run a driver
+with a throwaway config.
+"""
+import copy
+import json
+import os
+import sys
+from pathlib import Path
+
+
+def merge(defaults, overrides):
+    """Returns a copy of defaults with overrides merged in recursively"""
+    merged = copy.deepcopy(defaults)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+
+    return merged
+
+
+def config_path(driver_file):
+    """Path of the JSON config of the driver script driver_file"""
+    path = Path(driver_file).with_suffix('.json')
+    directory = os.environ.get('INDIDRIVERS_CONFIG_DIR')
+    if directory:
+        return Path(directory) / path.name
+    return path
+
+
+def load_config(path, defaults, strict=False):
+    """Loads path over defaults, missing or broken files give the defaults
+
+    With strict a broken file raises instead, for reloads where falling
+    back to the defaults would undo what the running driver was told.
+    """
+    try:
+        with open(path) as f:
+            overrides = json.load(f)
+    except FileNotFoundError:
+        return copy.deepcopy(defaults)
+    except (OSError, ValueError) as e:
+        if strict:
+            raise
+        # stdout belongs to indiserver, complain on stderr
+        sys.stderr.write(f'Ignoring config {path}: {e}\n')
+        return copy.deepcopy(defaults)
+
+    return merge(defaults, overrides)
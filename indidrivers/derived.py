@@ -0,0 +1,244 @@
+"""derived.py
+
+Quantities derived from the weather readings, updated one sample at a time.
+
+External scripts used to scrape the driver every second and work these out
+over their own history. The driver has every sample already, so it derives
+them as they arrive. Each update is a handful of arithmetic on the new
+sample and a few numbers of state, nothing is kept or recomputed over
+history:
+
+    outside_spread        outside temperature - outside dew point
+    outside_*_rate        rate of change of outside temperature and
+                          humidity, per hour
+    dome_spread           dome temperature - dome dew point
+    tube_dome_difference  tube temperature - dome temperature
+    condensation_margin   tube temperature - dome dew point, how far the
+                          tube is from collecting dew
+    condensation_risk     0 % with the margin at risk_margin or more, 100 %
+                          with the tube at or below the dew point
+    dome_*_rate           rate of change of dome temperature and humidity,
+                          per hour
+
+A Rate is the slope of a least squares line through the samples, with
+older samples weighted down by exp(-age / tau). The five weighted sums the
+fit needs are decayed and added to on each sample, so the fit costs the
+same after a week as after a minute, and it follows time rather than
+sample count, so it behaves the same whatever the poll period is. Unlike
+smoothing the slope between consecutive samples, one noisy reading moves
+it only as much as one point moves a line. A line through the first few
+seconds is mostly noise, so there is no rate until the samples span a
+tenth of tau.
+
+Each element can have thresholds [busy, alert]. With busy < alert the
+element is BUSY from busy and ALERT from alert upwards, with busy > alert
+low values are the bad ones (spreads, margin). Rates are compared by their
+size. A vector takes the worst state of its elements.
+
+Properties
+----------
+NP : derived_outside
+     Dew Point Spread, Temperature Rate, Humidity Rate
+NP : derived_inside
+     Dome Dew Point Spread, Tube - Dome, Condensation Margin,
+     Condensation Risk, Temperature Rate, Humidity Rate
+"""
+import math
+
+from pyindi.device import INumber, INumberVector, IPerm, IPState
+
+from indidrivers.publish import as_float
+
+# State order, worst last
+SEVERITY = [IPState.IDLE, IPState.OK, IPState.BUSY, IPState.ALERT]
+
+OUTSIDE = [
+    ('outside_spread', '%.1f', 'Dew Point Spread (C)'),
+    ('outside_temperature_rate', '%.2f', 'Temperature Rate (C/h)'),
+    ('outside_humidity_rate', '%.1f', 'Humidity Rate (%/h)'),
+]
+INSIDE = [
+    ('dome_spread', '%.1f', 'Dew Point Spread (C)'),
+    ('tube_dome_difference', '%.2f', 'Tube - Dome (C)'),
+    ('condensation_margin', '%.1f', 'Condensation Margin (C)'),
+    ('condensation_risk', '%.0f', 'Condensation Risk (%)'),
+    ('dome_temperature_rate', '%.2f', 'Temperature Rate (C/h)'),
+    ('dome_humidity_rate', '%.1f', 'Humidity Rate (%/h)'),
+]
+
+
+class Rate():
+    """Rate of change of one quantity per hour, see module docstring
+
+    Parameters
+    ----------
+    tau : float
+        Seconds after which a sample's weight dropped to 1/e
+    """
+    def __init__(self, tau=600.0):
+        self.tau = tau
+        self.value = None
+        self._t = None
+        self._first = None
+        # Weighted sums of 1, t, v, t*t and t*v with t relative to the
+        # latest sample, which keeps them small
+        self._sums = [0.0] * 5
+
+    def update(self, t, value):
+        """Adds a sample taken at t (seconds), returns the rate"""
+        n, st, sv, stt, stv = self._sums
+        if self._t is not None:
+            dt = t - self._t
+            if dt <= 0:
+                return self.value
+            decay = math.exp(-dt / self.tau)
+            # Move the origin to t, then age everything by dt
+            stt = (stt - 2 * dt * st + dt * dt * n) * decay
+            stv = (stv - dt * sv) * decay
+            st = (st - dt * n) * decay
+            sv *= decay
+            n *= decay
+        else:
+            self._first = t
+        self._t = t
+        n += 1
+        sv += value
+        self._sums = [n, st, sv, stt, stv]
+
+        denominator = n * stt - st * st
+        if t - self._first >= self.tau / 10 and denominator > 1e-12:
+            self.value = (n * stv - st * sv) / denominator * 3600
+
+        return self.value
+
+
+def threshold_state(value, limits):
+    """State of value against [busy, alert], see module docstring"""
+    if value is None:
+        return IPState.IDLE
+    if not limits:
+        return IPState.OK
+    busy, alert = limits
+    if busy > alert:
+        # Low is bad, flip everything so the checks below still hold
+        value, busy, alert = -value, -busy, -alert
+    if value >= alert:
+        return IPState.ALERT
+    if value >= busy:
+        return IPState.BUSY
+    return IPState.OK
+
+
+def worst(states):
+    return max(states, key=SEVERITY.index, default=IPState.IDLE)
+
+
+class DerivedWeather():
+    """Derived quantities of the weather driver, see module docstring
+
+    Parameters
+    ----------
+    device : str
+        Device name to attach to
+    tau : float
+        Time constant of the rates in seconds
+    risk_margin : float
+        Condensation margin (C) below which the risk starts to rise
+    thresholds : dict
+        Element name to [busy, alert]
+    """
+    def __init__(self, device, tau=600.0, risk_margin=3.0, thresholds=None):
+        self.device = device
+        self.risk_margin = risk_margin
+        self.thresholds = dict(thresholds or {})
+        self.rates = {
+            name: Rate(tau) for name in (
+                'outside_temperature', 'outside_humidity',
+                'dome_temperature', 'dome_humidity'
+            )
+        }
+        self.values = {name: None for name, _, _ in OUTSIDE + INSIDE}
+
+    def set_tau(self, tau):
+        for rate in self.rates.values():
+            rate.tau = tau
+
+    def properties(self, outside_group, inside_group):
+        """Builds the derived_outside and derived_inside NPs"""
+        vps = []
+        for name, elements, label, group in (
+            ('derived_outside', OUTSIDE, 'Derived', outside_group),
+            ('derived_inside', INSIDE, 'Derived', inside_group),
+        ):
+            numbers = [
+                INumber(
+                    element, fmt, -1e6, 1e6, 0, self.values[element] or 0,
+                    element_label
+                )
+                for element, fmt, element_label in elements
+            ]
+            vps.append(INumberVector(
+                numbers, self.device, name, IPState.IDLE, IPerm.RO, 0, None,
+                label, group
+            ))
+
+        return vps
+
+    def update_outside(self, data, t):
+        """Updates from a boltwood sample taken at t"""
+        temperature = as_float(data.get('outside_temperature'))
+        humidity = as_float(data.get('outside_humidity'))
+        dew_point = as_float(data.get('outside_dew_point'))
+        values = self.values
+        if temperature is not None and dew_point is not None:
+            values['outside_spread'] = temperature - dew_point
+        if temperature is not None:
+            values['outside_temperature_rate'] = \
+                self.rates['outside_temperature'].update(t, temperature)
+        if humidity is not None:
+            values['outside_humidity_rate'] = \
+                self.rates['outside_humidity'].update(t, humidity)
+
+        return
+
+    def update_inside(self, data, t):
+        """Updates from a onewire sample taken at t"""
+        tube = as_float(data.get('tube_temperature'))
+        dome = as_float(data.get('dome_temperature'))
+        humidity = as_float(data.get('dome_humidity'))
+        dew_point = as_float(data.get('dome_dew_point'))
+        values = self.values
+        if dome is not None and dew_point is not None:
+            values['dome_spread'] = dome - dew_point
+        if tube is not None and dome is not None:
+            values['tube_dome_difference'] = tube - dome
+        if tube is not None and dew_point is not None:
+            margin = tube - dew_point
+            values['condensation_margin'] = margin
+            risk = 1 - margin / self.risk_margin
+            values['condensation_risk'] = min(max(risk, 0.0), 1.0) * 100
+        if dome is not None:
+            values['dome_temperature_rate'] = \
+                self.rates['dome_temperature'].update(t, dome)
+        if humidity is not None:
+            values['dome_humidity_rate'] = \
+                self.rates['dome_humidity'].update(t, humidity)
+
+        return
+
+    def fill(self, vp):
+        """Copies the values into vp and sets its state from thresholds"""
+        states = []
+        for element in vp:
+            value = self.values[element.name]
+            if value is None:
+                continue
+            element.value = value
+            if element.name.endswith('_rate'):
+                value = abs(value)
+            states.append(
+                threshold_state(value, self.thresholds.get(element.name))
+            )
+        vp.state = worst(states)
+
+        return
@@ -0,0 +1,865 @@
+"""engine.py
+
+Drivers generated from a subsystem spec.
+
+Every hand written driver repeats the same things: property lists, a poll
+that asks an mtnpy subsystem for a dict, copies fields into vectors, maps a
+state message to lights, and command switches that call the subsystem and
+stay BUSY until it is done. A spec describes just that and build_driver
+turns it into a driver class:
+
+    {
+        "device": "Upper Dome",
+        "telescope": "Kuiper",          mtnpy class, see indidrivers.backend
+        "subsystem": "upperdome",       attribute of the telescope
+        "request": "request_all",       method returning the data dict
+        "period": 1.0,                  seconds between polls
+        "vectors": [...],
+        "commands": [...],
+        "phases": {...}                 optional, see Phases
+    }
+
+plus the keys every driver has (log, metrics, profile_window, tracing,
+stale_after, watchdog, output, push and publish, see DEFAULT_SPEC).
+
+Vectors
+-------
+Every vector has name, label, group and type, one of
+
+text, number
+    "fields": list of labels, the element name and the data key are the
+    label without case and spaces ('Domeslit State' -> domeslit_state), or
+    dicts with label, field, and for numbers format, min, max. Booleans
+    show as Yes/No.
+light
+    "field": data key holding a state message, "lights": every message it
+    can take. The light of the current message gets the state from
+    "states" (message -> Idle/Ok/Busy/Alert, "default" for the others), the
+    rest go Idle, the vector takes the state of the lit light.
+
+text and number vectors get their state from "state": {"rules": [[state,
+field, [values...]], ...], "default": state}, the first rule whose field
+has one of its values wins.
+
+Commands
+--------
+Switch vectors with name, label, group, "rule" (OneOfMany, AtMostOne,
+AnyOfMany) and "buttons", each with name, label and "call", a method of
+the subsystem. A button is either
+
+momentary
+    Calls call(*args) when pressed, the vector is BUSY until the data shows
+    "done": {"field": ..., "values": [...]} (or straight back to IDLE
+    without done)
+toggle
+    "toggle": true, calls call(True) or call(False) when switched and
+    follows the boolean data key "field"; the vector is BUSY while any
+    toggle is on
+
+"busy": {"field": ..., "values": [...]} on the vector ignores every button
+but those with "always": true while the data shows one of the values (Stop
+while moving).
+
+Phases
+------
+"field": data key holding the phase, "sequences": sequence name to its
+phases in order (see indidrivers.phases), and "ends": sequence name to the
+conditions showing it finished, {field: [values...]} that must all hold.
+Leaving the last phase of a sequence only counts as completed when its end
+shows, a sequence without ends never samples its last phase.
+
+What the engine does for every driver
+-------------------------------------
+- vectors are built once from the spec, getProperties re-sends the same
+  objects, polls update elements through references kept at build time
+  instead of IUFind and name lookups
+- a vector is only sent when it changed (DeadbandPublisher), state changes
+  always and everything at least every publish.max_interval seconds
+- data age, memory, profiling, leveled logging, metrics, the poll
+  watchdog, the coalescing output queue and change events instead of polls
+  as in the hand written drivers
+- every command is traced from the click to the data showing it done, the
+  done conditions above end the motion span (see indidrivers.tracing)
+- when run from a spec file (build_driver(spec, path)) the file is watched
+  and reloaded in place: period, state rules, light states, calls, done and
+  busy conditions, deadbands and the common keys change without a restart.
+  A vector is only re-defined when its structure (name, label, group,
+  elements, rule) changed, the others keep their objects and values.
+  device, telescope, subsystem and metrics still need a restart.
+"""
+import asyncio
+import copy
+import functools
+
+from pyindi.device import (
+    device, ILight, ILightVector, INumber, INumberVector, IPerm, IPState,
+    ISRule, ISState, ISwitch, ISwitchVector, IText, ITextVector
+)
+
+from indidrivers import clock
+from indidrivers.backend import make_telescope
+from indidrivers.config import load_config
+from indidrivers.freshness import Freshness
+from indidrivers.log import LEVELS, DriverLog
+from indidrivers.memstats import MemoryStats
+from indidrivers.metrics import DriverMetrics, MetricsServer
+from indidrivers.outqueue import OutputQueue
+from indidrivers.paths import state_file
+from indidrivers.phases import (
+    PhaseTimer, phase_timing_properties, update_phase_properties
+)
+from indidrivers.profiling import ProfilerControl
+from indidrivers.publish import DeadbandPublisher
+from indidrivers.push import Push
+from indidrivers.reload import ConfigReloader, check_config
+from indidrivers.tracing import Tracer, switched_on
+from indidrivers.watchdog import Watchdog
+
+ENGINEERING_GROUP = 'Engineering'
+# Seconds between checks of whether a poll is due, the period itself can be
+# reloaded so it is not baked into a repeat
+POLL_TICK = 0.1
+# Spec keys only read at start
+RESTART_KEYS = ('device', 'telescope', 'subsystem', 'metrics')
+STATES = {
+    'Idle': IPState.IDLE,
+    'Ok': IPState.OK,
+    'Busy': IPState.BUSY,
+    'Alert': IPState.ALERT,
+}
+RULES = {
+    'OneOfMany': ISRule.ONEOFMANY,
+    'AtMostOne': ISRule.ATMOST1,
+    'AnyOfMany': ISRule.NOFMANY,
+}
+
+# Keys every spec has, a spec file only needs what it changes
+DEFAULT_SPEC = {
+    'telescope': 'Kuiper',
+    'request': 'request_all',
+    'period': 1.0,
+    'vectors': [],
+    'commands': [],
+    'phases': None,
+    # Same meaning as in the hand written drivers
+    'log': {
+        'level': 'info',
+        'clients': True,
+        'file': True,
+        'file_kb': 1024,
+    },
+    'metrics': {
+        'host': 'localhost',
+        'port': None,
+    },
+    'profile_window': 30,
+    'tracing': {
+        'file': True,
+        'file_kb': 1024,
+    },
+    'stale_after': 10,
+    'watchdog': {
+        'deadline': 5,
+        'misses': 3,
+    },
+    'output': {
+        'max_backlog': 50,
+        'max_messages': 100,
+        'retry': 0.1,
+    },
+    'push': {
+        'enabled': True,
+        'sample': 0.05,
+        'keepalive': 2,
+        'misses': 3,
+        'retry': 30,
+    },
+    'publish': {
+        'min_interval': 0,
+        'max_interval': 30,
+        'deadbands': {},
+    },
+}
+
+
+def no_csp(value):
+    """Removes space and case"""
+    return value.lower().replace(' ', '_')
+
+
+def format_value(value):
+    """Booleans as Yes/No, everything else as is"""
+    if isinstance(value, bool):
+        return 'Yes' if value else 'No'
+    return value
+
+
+def load_spec(path, strict=False):
+    """Loads a spec file over DEFAULT_SPEC, strict as in load_config"""
+    spec = load_config(path, DEFAULT_SPEC, strict=strict)
+    if 'device' not in spec or 'subsystem' not in spec:
+        raise ValueError(f'{path} needs at least device and subsystem')
+    return spec
+
+
+def structure(spec):
+    """What a vector or command spec defines, as opposed to how it behaves
+
+    Two specs with the same structure give identical definitions, so a
+    reload can keep the vector a client already has.
+    """
+    if 'buttons' in spec:
+        elements = [(b['name'], b['label']) for b in spec['buttons']]
+        return ('switch', spec['name'], spec['label'],
+                spec.get('group', 'Main Control'),
+                spec.get('rule', 'AtMostOne'), elements)
+    if spec['type'] == 'light':
+        elements = list(spec['lights'])
+    else:
+        elements = [
+            (f['field'], f['label'], f.get('format'), f.get('min'),
+             f.get('max'))
+            for f in field_specs(spec['fields'])
+        ]
+    return (spec['type'], spec['name'], spec['label'],
+            spec.get('group', 'Main Control'), elements)
+
+
+def field_specs(fields):
+    """Normalizes a fields list to dicts with label and field"""
+    specs = []
+    for f in fields:
+        if isinstance(f, str):
+            f = {'label': f}
+        f = dict(f)
+        f.setdefault('field', no_csp(f['label']))
+        specs.append(f)
+    return specs
+
+
+class StateRules():
+    """[[state, field, values], ...] first match wins, else default"""
+    def __init__(self, spec):
+        spec = spec or {}
+        self.rules = [
+            (STATES[state], field, set(values))
+            for state, field, values in spec.get('rules', [])
+        ]
+        self.default = STATES[spec.get('default', 'Ok')]
+
+    def __call__(self, data):
+        for state, field, values in self.rules:
+            if data.get(field) in values:
+                return state
+        return self.default
+
+
+class Binding():
+    """A vector built from its spec and what the poll needs to fill it
+
+    elements is a list of (element, data key) so a poll is a plain loop over
+    references, no lookups by name.
+    """
+    def __init__(self, vp, elements=(), rules=None, light_field=None,
+                 light_states=None, light_default=None, spec=None):
+        self.vp = vp
+        self.spec = spec
+        self.elements = list(elements)
+        self.rules = rules
+        self.light_field = light_field
+        self.light_states = light_states or {}
+        self.light_default = light_default
+        self.lights = {element.name: element for element in vp}
+
+    def update(self, data):
+        """Copies data into the vector"""
+        if self.light_field is not None:
+            message = data.get(self.light_field)
+            state = IPState.IDLE
+            for element in self.vp:
+                element.value = IPState.IDLE
+            light = self.lights.get(no_csp(str(message)))
+            if light is not None:
+                state = self.light_states.get(message, self.light_default)
+                light.value = state
+            self.vp.state = state
+            return
+
+        for element, field in self.elements:
+            value = data.get(field)
+            if value is not None:
+                element.value = format_value(value)
+        self.vp.state = self.rules(data)
+
+    def adopt(self, old):
+        """Takes over the vector of old, a binding with the same structure"""
+        self.elements = [
+            (old.vp[element.name], field) for element, field in self.elements
+        ]
+        self.vp = old.vp
+        self.lights = old.lights
+
+
+def build_vector(device_name, spec):
+    """Builds the Binding of a vector spec"""
+    kind = spec['type']
+    name, label = spec['name'], spec['label']
+    group = spec.get('group', 'Main Control')
+
+    if kind == 'light':
+        lights = [
+            ILight(no_csp(message), IPState.IDLE, message)
+            for message in spec['lights']
+        ]
+        vp = ILightVector(
+            lights, device_name, name, IPState.IDLE, 0, None, label, group
+        )
+        states = {
+            message: STATES[state]
+            for message, state in spec.get('states', {}).items()
+        }
+        return Binding(
+            vp, light_field=spec['field'], light_states=states,
+            light_default=STATES[spec.get('default', 'Busy')], spec=spec
+        )
+
+    fields = field_specs(spec['fields'])
+    if kind == 'text':
+        elements = [IText(f['field'], '', f['label']) for f in fields]
+        vp = ITextVector(
+            elements, device_name, name, IPState.IDLE, IPerm.RO, 0, None,
+            label, group
+        )
+    elif kind == 'number':
+        elements = [
+            INumber(
+                f['field'], f.get('format', '%.2f'), f.get('min', -1e6),
+                f.get('max', 1e6), 0, 0, f['label']
+            )
+            for f in fields
+        ]
+        vp = INumberVector(
+            elements, device_name, name, IPState.IDLE, IPerm.RO, 0, None,
+            label, group
+        )
+    else:
+        raise ValueError(f'Unknown vector type {kind} for {name}')
+
+    return Binding(
+        vp, zip(elements, (f['field'] for f in fields)),
+        rules=StateRules(spec.get('state')), spec=spec
+    )
+
+
+class Command():
+    """A command switch vector and its buttons"""
+    def __init__(self, device_name, spec):
+        self.spec = spec
+        self.buttons = {b['name']: b for b in spec['buttons']}
+        self.toggles = [b for b in spec['buttons'] if b.get('toggle')]
+        self.busy = spec.get('busy')
+        self.pending = None # Momentary button waiting for its done
+        switches = [
+            ISwitch(b['name'], ISState.OFF, b['label']) for b in spec['buttons']
+        ]
+        self.vp = ISwitchVector(
+            switches, device_name, spec['name'], IPState.IDLE,
+            RULES[spec.get('rule', 'AtMostOne')], IPerm.RW, 0, spec['label'],
+            spec.get('group', 'Main Control')
+        )
+        self.switches = {s.name: s for s in self.vp}
+
+    def adopt(self, old):
+        """Takes over the vector and pending button of old"""
+        self.vp = old.vp
+        self.switches = old.switches
+        if old.pending in self.buttons:
+            self.pending = old.pending
+
+    def is_busy(self, data):
+        if self.busy is None or data is None:
+            return False
+        return data.get(self.busy['field']) in self.busy['values']
+
+    def update(self, data):
+        """Follows toggles and finishes the pending button from data"""
+        for b in self.toggles:
+            self.switches[b['name']].value = 'On' if data.get(b['field']) \
+                else 'Off'
+
+        if self.pending is not None:
+            done = self.buttons[self.pending].get('done')
+            if done is None or data.get(done['field']) in done['values']:
+                self.pending = None
+        if self.pending is None:
+            for b in self.buttons.values():
+                if not b.get('toggle'):
+                    self.switches[b['name']].value = 'Off'
+            self.vp.state = self.toggle_state()
+
+    def toggle_state(self):
+        """BUSY while any toggle is on (a lamp is lit), else IDLE"""
+        if any(self.switches[b['name']].value == 'On' for b in self.toggles):
+            return IPState.BUSY
+        return IPState.IDLE
+
+
+class SubsystemDriver(device):
+    """Driver for one subsystem spec, use build_driver to get a class"""
+    spec = None
+    spec_path = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        spec = self.spec
+        name = spec['device']
+        self.telescope = make_telescope(spec['telescope'])
+        self.subsystem = getattr(self.telescope, spec['subsystem'])
+        self.source = spec['subsystem']
+        self.data = None
+        self.next_poll = 0.0
+        self.publisher = DeadbandPublisher(**spec['publish'])
+        self.log = DriverLog(name, **spec['log'])
+        self.log.attach(self)
+        self.output = OutputQueue(name, log=self.log, **spec['output'])
+        self.output.attach(self)
+        self.profiler = ProfilerControl(
+            name, window=spec['profile_window'], log=self.log
+        )
+        self.memstats = MemoryStats(name)
+        self.tracer = Tracer(name, log=self.log, **spec['tracing'])
+        self.tracer.attach(self)
+        self.watchdog = Watchdog(
+            name, {'poll': spec['watchdog']['deadline']},
+            misses=spec['watchdog']['misses'], reconnect=self.reconnect,
+            log=self.log
+        )
+        self.push = Push(
+            {self.source: (spec['subsystem'], spec['request'])},
+            telescope=spec['telescope'], log=self.log, **spec['push']
+        )
+        self.reloader = None
+        if self.spec_path is not None:
+            self.reloader = ConfigReloader(
+                name, self.spec_path,
+                lambda: load_spec(self.spec_path, strict=True),
+                self.apply_spec, spec, self.log
+            )
+
+        # Everything is built once, getProperties sends the same objects
+        self.bindings = [build_vector(name, v) for v in spec['vectors']]
+        self.commands = {c['name']: Command(name, c) for c in spec['commands']}
+        self.build_phases(spec['phases'])
+        names = self.vector_names()
+        self.freshness = Freshness(
+            {self.source: names}, stale_after=spec['stale_after']
+        )
+        self.metrics = DriverMetrics(
+            name, names + ['memory', 'heartbeat', 'output_queue'],
+            freshness=self.freshness
+        )
+        self.metrics.attach(self)
+        self.metrics_server = MetricsServer([self.metrics], **spec['metrics'])
+        self.definitions = self.build_definitions()
+
+    def build_phases(self, phases):
+        """Phase timer and its vectors, none without phases"""
+        self.phase_timer, self.phase_vps = self.make_phases(phases)
+
+    def make_phases(self, phases):
+        """Returns the phase timer and its vectors, (None, ()) without
+        phases"""
+        if not phases:
+            return None, ()
+        name = self.spec['device']
+        phase_timer = PhaseTimer(
+            phases['sequences'],
+            path=state_file(f"{no_csp(name)}_phases.json")
+        )
+        lights = {
+            phase: phase.replace('_', ' ').title()
+            for phase in phase_timer.stats
+        }
+        return phase_timer, phase_timing_properties(
+            name, phases.get('group', 'Main Control'), lights
+        )
+
+    def check_settings(self, new):
+        """Raises ValueError if the common keys of new cannot be applied"""
+        check_config(
+            new,
+            configures=[
+                ('log', functools.partial(self.log.configure, self)),
+                ('tracing', self.tracer.configure),
+                ('output', self.output.configure),
+                ('push', self.push.configure),
+            ],
+            numbers=[
+                'publish.deadbands', 'publish.min_interval',
+                'publish.max_interval', 'profile_window', 'stale_after',
+                'watchdog.deadline', 'watchdog.misses',
+            ],
+            choices={'log.level': LEVELS},
+        )
+
+    def vector_names(self):
+        """Names of the vectors filled from the subsystem"""
+        return [b.vp.name for b in self.bindings] + list(self.commands)
+
+    def build_definitions(self):
+        """Every vector getProperties defines, in order"""
+        name = self.spec['device']
+        definitions = (
+            [c.vp for c in self.commands.values()]
+            + [b.vp for b in self.bindings]
+            + list(self.phase_vps)
+            + [self.freshness.properties(name, ENGINEERING_GROUP)]
+            + [self.tracer.properties(ENGINEERING_GROUP)]
+            + list(self.profiler.properties(ENGINEERING_GROUP))
+            + list(self.memstats.properties(ENGINEERING_GROUP))
+            + list(self.log.properties(ENGINEERING_GROUP))
+            + list(self.watchdog.properties(ENGINEERING_GROUP))
+            + [self.output.properties(ENGINEERING_GROUP)]
+        )
+        if self.reloader is not None:
+            definitions += list(self.reloader.properties(ENGINEERING_GROUP))
+        return definitions
+
+    def apply_spec(self, driver, new):
+        """Applies a reloaded spec in place, see module docstring
+
+        Returns notes on what could not be applied.
+        """
+        name = self.spec['device']
+        notes = [
+            f'{key} needs a restart' for key in RESTART_KEYS
+            if new.get(key) != self.spec.get(key)
+        ]
+        # Build and check everything first so a bad spec raises before
+        # anything changed
+        self.check_settings(new)
+        old_bindings = {b.vp.name: b for b in self.bindings}
+        bindings = [build_vector(name, v) for v in new['vectors']]
+        commands = {c['name']: Command(name, c) for c in new['commands']}
+        defined = []
+        for binding in bindings:
+            old = old_bindings.get(binding.vp.name)
+            if old is not None and \
+                    structure(old.spec) == structure(binding.spec):
+                binding.adopt(old)
+            else:
+                defined.append(binding.vp)
+        for command in commands.values():
+            old = self.commands.get(command.vp.name)
+            if old is not None and \
+                    structure(old.spec) == structure(command.spec):
+                command.adopt(old)
+            else:
+                defined.append(command.vp)
+        removed = (
+            set(old_bindings) | set(self.commands)
+        ) - {b.vp.name for b in bindings} - set(commands)
+
+        phases_changed = new['phases'] != self.spec['phases']
+        if phases_changed:
+            phase_timer, phase_vps = self.make_phases(new['phases'])
+            removed |= {vp.name for vp in self.phase_vps}
+            removed -= {vp.name for vp in phase_vps}
+            defined += list(phase_vps)
+
+        # Nothing below raises, the driver changes over in one step
+        self.spec = new
+        self.bindings = bindings
+        self.commands = commands
+        if phases_changed:
+            self.phase_timer, self.phase_vps = phase_timer, phase_vps
+
+        self.publisher.deadbands = dict(new['publish']['deadbands'])
+        self.publisher.min_interval = new['publish']['min_interval']
+        self.publisher.max_interval = new['publish']['max_interval']
+        self.log.configure(self, **new['log'])
+        self.profiler.window = new['profile_window']
+        self.tracer.configure(**new['tracing'])
+        names = self.vector_names()
+        self.freshness.sources[self.source] = names
+        self.freshness.stale_after = new['stale_after']
+        self.metrics.vectors = \
+            names + ['memory', 'heartbeat', 'output_queue']
+        self.watchdog.deadlines['poll'] = new['watchdog']['deadline']
+        self.watchdog.misses = new['watchdog']['misses']
+        self.output.configure(**new['output'])
+        if new['push'] != self.reloader.current['push']:
+            self.push.configure(**new['push'])
+        self.definitions = self.build_definitions()
+
+        for vp in defined:
+            self.IDDef(vp)
+            self.publisher.forget(vp.name)
+        if removed:
+            delete = getattr(self, 'IDDelete', None)
+            if delete is None:
+                notes.append('removed vectors stay defined until a restart')
+            else:
+                for vector in sorted(removed):
+                    delete(vector)
+        if defined:
+            notes.append('re-defined ' + ', '.join(vp.name for vp in defined))
+
+        return notes
+
+    def ISGetProperties(self, device=None):
+        for vp in self.definitions:
+            self.IDDef(vp)
+        # New client, it gets everything on the next poll
+        self.publisher.forget()
+        self.metrics_server.ensure_started()
+        self.push.ensure_started(self.pushed)
+
+    def ISNewText(self, device, name, values, names):
+        pass
+
+    def ISNewNumber(self, device, name, values, names):
+        pass
+
+    def ISNewSwitch(self, device, name, values, names):
+        if self.profiler.handle_switch(self, device, name, values, names):
+            return
+        if self.log.handle_switch(self, device, name, values, names):
+            return
+        if self.reloader is not None and \
+                self.reloader.handle_switch(self, device, name, values, names):
+            return
+        command = self.commands.get(name)
+        if command is None:
+            return
+
+        self.log.debug('%s values=%s names=%s', name, values, names)
+        trace = self.tracer.begin(name, switched_on(values, names))
+        pressed = dict(zip(names, values))
+        if command.is_busy(self.data) and not all(
+            command.buttons[n].get('always')
+            for n, v in pressed.items() if v == 'On'
+        ):
+            self.log.warning('%s busy, ignoring all but %s', name, ', '.join(
+                b['name'] for b in command.buttons.values() if b.get('always')
+            ) or 'nothing')
+            self.tracer.finish(trace, 'ignored')
+            return
+
+        self.IUUpdate(device, name, values, names)
+        # Sent as a task, with the async client a slow controller then never
+        # holds up the loop
+        asyncio.ensure_future(self.send(command, pressed, trace))
+
+    async def send(self, command, pressed, trace):
+        """Sends the pressed buttons of command to the subsystem"""
+        # What the data shows once every call sent is done, for the trace
+        waits = []
+        sent = failed = False
+        for n, value in pressed.items():
+            button = command.buttons.get(n)
+            if button is None:
+                continue
+            on = value == 'On'
+            if button.get('toggle'):
+                # Only switch what is not already that way
+                if self.data is not None and \
+                        bool(self.data.get(button['field'])) == on:
+                    continue
+                args = [on]
+            elif on:
+                args = button.get('args', [])
+            else:
+                continue
+            trace.step(button['call'], args=args)
+            sent = True
+            try:
+                call = getattr(self.subsystem, button['call'])
+                ok = await self.watchdog.call(call, *args)
+                if ok is False:
+                    raise RuntimeError(f"{button['call']} returned False")
+            except Exception as e:
+                self.log.error('%s failed: %s', button['label'], e)
+                command.vp.state = IPState.ALERT
+                command.switches[n].value = 'Off' if on else 'On'
+                failed = True
+                continue
+            if button.get('toggle'):
+                self.log.info('%s %s', button['label'], 'on' if on else 'off')
+                command.vp.state = command.toggle_state()
+                waits.append(
+                    lambda data, field=button['field'], on=on:
+                    bool(data.get(field)) == on
+                )
+                continue
+            self.log.info('%s sent', button['label'])
+            done = button.get('done')
+            if done is not None:
+                waits.append(
+                    lambda data, done=done:
+                    data.get(done['field']) in done['values']
+                )
+            # A new command replaces whatever was still running
+            for other in command.buttons.values():
+                if other['name'] != n and not other.get('toggle'):
+                    command.switches[other['name']].value = 'Off'
+            command.pending = n
+            command.vp.state = IPState.BUSY
+
+        if failed:
+            self.tracer.finish(trace, 'failed')
+        elif not sent:
+            # Nothing needed sending, toggles already that way
+            self.tracer.finish(trace, 'ignored')
+        else:
+            self.tracer.wait(
+                trace, lambda data: all(wait(data) for wait in waits)
+            )
+
+        self.IDSet(command.vp)
+        self.publisher.published(command.vp)
+
+    def reconnect(self):
+        """Replaces the connection after the watchdog found a stalled poll"""
+        old = self.telescope
+        self.telescope = make_telescope(self.spec['telescope'])
+        self.subsystem = getattr(self.telescope, self.spec['subsystem'])
+        if hasattr(old, 'close'):
+            old.close()
+
+    async def poll(self):
+        """Requests the subsystem and publishes what changed"""
+        started = clock.time()
+        try:
+            data = await self.watchdog.call(
+                getattr(self.subsystem, self.spec['request'])
+            )
+        except Exception as e:
+            self.metrics.polled(self.source, clock.time() - started, ok=False)
+            self.update_data(e)
+            return
+
+        self.metrics.polled(self.source, clock.time() - started)
+        self.freshness.acquired(self.source, started)
+        self.update_data(data)
+
+    def pushed(self, channel, data, received):
+        """Publishes a change event (see indidrivers.push) like a poll"""
+        self.metrics.pushed(channel)
+        self.watchdog.beat('poll')
+        if not isinstance(data, Exception):
+            self.freshness.acquired(channel, received, received)
+        self.update_data(data)
+
+    def update_data(self, data):
+        """Updates every vector from data, an Exception if the request
+        failed"""
+        if isinstance(data, Exception):
+            self.log.debug('%s failed: %s', self.spec['request'], data)
+            self.data = None
+            state = self.freshness.failed_state(self.source)
+            for binding in self.bindings:
+                if binding.vp.state != state:
+                    binding.vp.state = state
+                    self.publisher.publish(self, binding.vp)
+            return
+
+        self.data = data
+        self.tracer.confirm(data, self.freshness.acquired_at[self.source])
+        for binding in self.bindings:
+            binding.update(data)
+            self.freshness.stamp(self.source, binding.vp)
+            self.publisher.publish(self, binding.vp)
+        for command in self.commands.values():
+            command.update(data)
+            self.freshness.stamp(self.source, command.vp)
+            self.publisher.publish(self, command.vp)
+        if self.phase_timer is not None:
+            self.update_phase_timing(data)
+
+        return
+
+    def update_phase_timing(self, data):
+        """Feeds the phase timer from the phases field"""
+        timing_nvp, alerts_lvp = self.phase_vps
+        was_slow = self.phase_timer.slow()
+        ended = None
+        ends = self.spec['phases'].get('ends', {})
+        for sequence, conditions in ends.items():
+            if all(data.get(field) in values
+                   for field, values in conditions.items()):
+                ended = sequence
+                break
+        self.phase_timer.update(
+            no_csp(str(data.get(self.spec['phases']['field']))), ended=ended
+        )
+        slow = update_phase_properties(
+            self.phase_timer, timing_nvp, alerts_lvp
+        )
+        self.freshness.stamp(self.source, timing_nvp, alerts_lvp)
+        if slow and not was_slow:
+            self.log.warning(
+                '%s is slow, %.1fs > p99 %.1fs', self.phase_timer.phase,
+                self.phase_timer.elapsed(),
+                self.phase_timer.stats[self.phase_timer.phase].p99
+            )
+        if self.phase_timer.phase is not None or was_slow:
+            self.IDSet(timing_nvp)
+        self.publisher.publish(self, alerts_lvp)
+
+    def check_freshness(self):
+        self.freshness.check(self, publish=self.publish_stale)
+
+    def publish_stale(self, vp):
+        """Sends a vector that went stale, past any deadband"""
+        self.IDSet(vp)
+        self.publisher.forget(vp.name)
+
+
+def build_driver(spec, path=None):
+    """Returns a driver class for spec (a dict, see module docstring)
+
+    With the path of the spec file the driver reloads it when it changes.
+    """
+    spec = copy.deepcopy(spec)
+
+    class Driver(SubsystemDriver):
+        @device.repeat(clock.period_ms(POLL_TICK * 1000))
+        def update(self):
+            now = clock.monotonic()
+            if self.push.active():
+                return # Change events arrive instead
+            if now < self.next_poll or \
+                    not self.watchdog.start('poll', self.poll):
+                return
+            # Keep the cadence, but never try to catch up missed polls
+            self.next_poll += self.spec['period']
+            if self.next_poll <= now:
+                self.next_poll = now + self.spec['period']
+
+        @device.repeat(clock.period_ms(1000))
+        def update_freshness(self):
+            self.check_freshness()
+
+        @device.repeat(10000)
+        def update_memory(self):
+            self.memstats.update(self)
+
+        @device.repeat(1000)
+        def check_watchdog(self):
+            self.watchdog.check(self)
+            self.output.update(self)
+
+        @device.repeat(2000)
+        def check_spec(self):
+            if self.reloader is not None:
+                self.reloader.check(self)
+
+    Driver.spec = spec
+    Driver.spec_path = path
+    Driver.__name__ = Driver.__qualname__ = (
+        spec['device'].title().replace(' ', '') + 'Driver'
+    )
+
+    return Driver
+
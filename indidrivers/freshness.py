@@ -0,0 +1,140 @@
+"""freshness.py
+
+Acquisition timestamps and data age.
+
+Vectors used to go out with timestamp None, so pyindi stamped them with the
+time they were sent, and after a failed poll the old values just sat there.
+A Freshness keeps, for every data source of a driver (e.g. boltwood,
+onewire), the time its data was acquired:
+
+    acquired = midpoint of the request to the hardware, our best guess of
+               when the controller sampled it
+
+Vectors filled from a source are stamped with that time (stamp). Once a
+second check publishes the age of every source in a data_age number vector
+and puts the source's vectors in ALERT when the age goes over stale_after,
+which catches pollers that silently stopped.
+"""
+from datetime import datetime, timezone
+
+from pyindi.device import INumber, INumberVector, IPerm, IPState
+
+from indidrivers import clock
+
+
+def indi_timestamp(epoch):
+    """INDI timestamp (UTC, ISO 8601 without zone) for a clock.time()"""
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime(
+        '%Y-%m-%dT%H:%M:%S.%f'
+    )[:-3]
+
+
+class Freshness():
+    """Tracks acquisition times, see module docstring
+
+    Parameters
+    ----------
+    sources : dict
+        Source name to the names of the vectors filled from it
+    stale_after : dict or float
+        Seconds after which a source is stale, per source or for all
+    """
+    def __init__(self, sources, stale_after=10.0):
+        self.sources = sources
+        self.stale_after = stale_after
+        self.acquired_at = {source: None for source in sources}
+
+    def threshold(self, source):
+        if isinstance(self.stale_after, dict):
+            return self.stale_after[source]
+        return self.stale_after
+
+    def acquired(self, source, started, finished=None):
+        """Records data for source requested at started (clock.time())
+
+        Returns the acquisition time.
+        """
+        finished = clock.time() if finished is None else finished
+        self.acquired_at[source] = started + (finished - started) / 2
+        return self.acquired_at[source]
+
+    def stamp(self, source, *vps):
+        """Stamps vps with the acquisition time of source"""
+        acquired = self.acquired_at[source]
+        if acquired is None:
+            return
+        timestamp = indi_timestamp(acquired)
+        for vp in vps:
+            vp.timestamp = timestamp
+
+    def age(self, source, now=None):
+        """Seconds since source was acquired, None if it never was"""
+        acquired = self.acquired_at[source]
+        if acquired is None:
+            return None
+        now = clock.time() if now is None else now
+        return now - acquired
+
+    def stale(self, source, now=None):
+        """True if source is older than its threshold or was never read"""
+        age = self.age(source, now)
+        return age is None or age > self.threshold(source)
+
+    def failed_state(self, source, now=None):
+        """State for the vectors of source after a failed poll
+
+        IDLE as the drivers always did, but ALERT once what they still show
+        is stale so the two do not flap.
+        """
+        age = self.age(source, now)
+        if age is not None and age > self.threshold(source):
+            return IPState.ALERT
+        return IPState.IDLE
+
+    def properties(self, device, group):
+        """Builds the data_age number vector"""
+        numbers = [
+            INumber(
+                source, '%.1f', 0, 1e6, 0, 0, f'{source.title()} Age (s)'
+            )
+            for source in self.sources
+        ]
+        return INumberVector(
+            numbers, device, 'data_age', IPState.IDLE, IPerm.RO, 0, None,
+            'Data Age', group
+        )
+
+    def check(self, driver, publish=None):
+        """Publishes data_age and puts vectors of stale sources in ALERT
+
+        Sources never read since start are left alone (IDLE), they are not
+        stuck, they just have not started. publish sends a vector that went
+        stale, default driver.IDSet.
+        """
+        publish = driver.IDSet if publish is None else publish
+        try:
+            age_nvp = driver.IUFind('data_age')
+        except ValueError:
+            return
+
+        now = clock.time()
+        any_stale = False
+        for source, names in self.sources.items():
+            age = self.age(source, now)
+            age_nvp[source].value = age if age is not None else 0
+            if age is None or age <= self.threshold(source):
+                continue
+            any_stale = True
+            for name in names:
+                try:
+                    vp = driver.IUFind(name)
+                except ValueError:
+                    continue
+                if vp.state != IPState.ALERT:
+                    vp.state = IPState.ALERT
+                    publish(vp)
+
+        age_nvp.state = IPState.ALERT if any_stale else IPState.OK
+        # Driver time, what the ages were taken at
+        age_nvp.timestamp = indi_timestamp(now)
+        driver.IDSet(age_nvp)
@@ -0,0 +1,179 @@
+"""interlock.py
+
+Rule engine that closes the enclosure when the weather turns bad.
+
+Every weather snapshot is passed to InterlockEngine.evaluate. Each Rule looks
+at one field of the snapshot and trips when the field holds one of its bad
+values for trip_after consecutive snapshots. A tripped rule only clears once
+the field has stayed good for clear_after seconds, which keeps a moist/raining
+sensor on the edge from flapping.
+
+When the engine is armed and a rule trips, or it is armed while a rule is
+tripped, every Action runs once, in order.
+An action that fails (raises or returns something falsy, like the mtnpy
+command_* calls) stays pending and is retried on the next snapshot for as
+long as any rule is tripped. evaluate is a coroutine so an action may
+return an awaitable (the async client's commands), it is awaited before the
+next action runs.
+
+Latency is measured from the moment the snapshot was requested from the
+hardware to the moment the last close command was sent, and compared against
+budget seconds.
+"""
+import inspect
+import time
+
+
+class Rule():
+    """A bad weather condition
+
+    Parameters
+    ----------
+    name : str
+        Name of the rule, also used as the light name
+    field : str
+        Key of the snapshot to look at
+    values : iterable of str
+        Values of field that are bad
+    trip_after : int
+        Consecutive bad snapshots needed to trip
+    clear_after : float
+        Seconds field must stay good before the rule clears
+    """
+    def __init__(self, name, field, values, trip_after=1, clear_after=600):
+        self.name = name
+        self.field = field
+        self.values = set(values)
+        self.trip_after = trip_after
+        self.clear_after = clear_after
+        self.tripped = False
+        self._bad_count = 0
+        self._good_since = None
+
+    def check(self, snapshot, now):
+        """Updates the rule with a snapshot, returns True if it just tripped"""
+        bad = snapshot.get(self.field) in self.values
+        if bad:
+            self._bad_count += 1
+            self._good_since = None
+            if not self.tripped and self._bad_count >= self.trip_after:
+                self.tripped = True
+                return True
+            return False
+
+        self._bad_count = 0
+        if self.tripped:
+            if self._good_since is None:
+                self._good_since = now
+            elif now - self._good_since >= self.clear_after:
+                self.tripped = False
+                self._good_since = None
+
+        return False
+
+    def reset(self):
+        self.tripped = False
+        self._bad_count = 0
+        self._good_since = None
+
+
+class Action():
+    """A close command, func is called without arguments and may return an
+    awaitable"""
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+
+
+class InterlockEngine():
+    """Trips actions from rules, see module docstring
+
+    Parameters
+    ----------
+    rules : list of Rule
+    actions : list of Action
+        Run in order when a rule trips
+    budget : float
+        Latency budget in seconds from acquisition to last command sent
+    """
+    def __init__(self, rules, actions, budget=1.0):
+        self.rules = rules
+        self.actions = actions
+        self.budget = budget
+        self.armed = False
+        self.pending = []
+        self.last_latency = None
+        self.max_latency = None
+        self.trips = 0
+
+    @property
+    def tripped(self):
+        return any(rule.tripped for rule in self.rules)
+
+    def arm(self):
+        """Arms, a rule that is already tripped queues the actions for the
+        next snapshot"""
+        self.armed = True
+        if self.tripped:
+            self.trips += 1
+            self.pending = list(self.actions)
+
+    def disarm(self):
+        """Disarms and forgets any trip so arming again starts clean"""
+        self.armed = False
+        self.pending = []
+        for rule in self.rules:
+            rule.reset()
+
+    async def evaluate(self, snapshot, acquired, now=None):
+        """Checks the rules against snapshot and runs actions if needed
+
+        Parameters
+        ----------
+        snapshot : dict
+            Latest weather data
+        acquired : float
+            time.monotonic() when the snapshot was requested
+
+        Returns
+        -------
+        list of (Action, ok) run during this call
+        """
+        now = time.monotonic() if now is None else now
+        tripped_now = [rule for rule in self.rules if rule.check(snapshot, now)]
+        if not self.armed:
+            return []
+
+        if tripped_now:
+            self.trips += 1
+            self.pending = list(self.actions)
+        elif not self.tripped:
+            # Cleared before the pending actions managed to run
+            self.pending = []
+        if not self.pending:
+            return []
+
+        ran = []
+        for action in list(self.pending):
+            try:
+                ok = action.func()
+                if inspect.isawaitable(ok):
+                    ok = await ok
+                ok = bool(ok)
+            except Exception:
+                ok = False
+            if ok:
+                self.pending.remove(action)
+            ran.append((action, ok))
+
+        if tripped_now:
+            # Only the reaction to a fresh trip is a latency sample
+            self.last_latency = time.monotonic() - acquired
+            if self.max_latency is None or self.last_latency > self.max_latency:
+                self.max_latency = self.last_latency
+
+        return ran
+
+    def over_budget(self):
+        """True if the last measured latency was over budget"""
+        return self.last_latency is not None and self.last_latency > self.budget
@@ -0,0 +1,199 @@
+"""log.py
+
+Leveled logging for the drivers.
+
+IDMessage goes to every connected client and its f-string is built whether
+anyone wants it or not, so debug chatter (switch echoes, "Updating ...")
+used to cost every client a message on every click. A DriverLog is a
+standard library logger per device:
+
+    log.debug('commands values=%s names=%s', values, names)
+
+Arguments are only formatted when the level is enabled, a disabled debug
+call is one integer comparison. What passes the level goes to
+
+    clients : IDMessage, '[LEVEL] message' like the drivers always did
+    file    : <device>.log in the state directory, rotated at file_kb so
+              it never holds more than about twice that
+
+Both the level and the outputs are switch vectors in the Engineering group,
+so debug output can be turned on for a running driver and off again.
+
+Properties
+----------
+SP : log_level
+     Debug, Info, Warning, Error (one of many)
+SP : log_output
+     Clients, File (any of many)
+"""
+import logging
+import logging.handlers
+
+from pyindi.device import (
+    IPerm, IPState, ISRule, ISState, ISwitch, ISwitchVector
+)
+
+from indidrivers.paths import state_file
+
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
+
+
+class ClientHandler(logging.Handler):
+    """Sends records to the clients of driver with IDMessage"""
+    def __init__(self):
+        super().__init__()
+        self.driver = None
+        self.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+
+    def emit(self, record):
+        if self.driver is None:
+            return
+        try:
+            self.driver.IDMessage(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class DriverLog():
+    """Logger, outputs and switch vectors of one device
+
+    Parameters
+    ----------
+    device : str
+        Device name, also used for the logger and file name
+    level : str
+        Initial level, a key of LEVELS
+    clients : bool
+        Send messages to clients with IDMessage
+    file : bool
+        Write messages to the log file in the state directory
+    file_kb : int
+        Size at which the log file is rotated
+    """
+    def __init__(self, device, level='info', clients=True, file=True,
+                 file_kb=1024):
+        self.device = device
+        slug = device.lower().replace(' ', '_')
+        self.logger = logging.getLogger(f'indidrivers.{slug}')
+        self.logger.propagate = False
+        # Never fall back to stderr when both outputs are off
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.setLevel(LEVELS[level])
+
+        self.client = ClientHandler()
+        self.file = logging.handlers.RotatingFileHandler(
+            state_file(f'{slug}.log'), maxBytes=file_kb * 1024, backupCount=1,
+            delay=True
+        )
+        self.file.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s %(message)s'
+        ))
+        self.set_outputs(clients, file)
+
+        # Bound once so a call costs no more than the logger's own
+        self.debug = self.logger.debug
+        self.info = self.logger.info
+        self.warning = self.logger.warning
+        self.error = self.logger.error
+        self.exception = self.logger.exception
+
+    def attach(self, driver):
+        """Sets the driver whose IDMessage the clients output uses"""
+        self.client.driver = driver
+
+    @property
+    def level(self):
+        for name, level in LEVELS.items():
+            if level == self.logger.level:
+                return name
+        return None
+
+    def set_outputs(self, clients, file):
+        for handler, on in ((self.client, clients), (self.file, file)):
+            if on:
+                self.logger.addHandler(handler)
+            else:
+                self.logger.removeHandler(handler)
+                if handler is self.file:
+                    handler.close()
+
+        return
+
+    def configure(self, driver, level='info', clients=True, file=True,
+                  file_kb=1024):
+        """Applies a reloaded log config, updating the switches if defined"""
+        self.logger.setLevel(LEVELS[level])
+        self.file.maxBytes = file_kb * 1024
+        self.set_outputs(clients, file)
+        try:
+            level_sp = driver.IUFind('log_level')
+            output_sp = driver.IUFind('log_output')
+        except ValueError:
+            return
+        for s in level_sp:
+            s.value = 'On' if s.name == level else 'Off'
+        output_sp['clients'].value = 'On' if clients else 'Off'
+        output_sp['file'].value = 'On' if file else 'Off'
+        driver.IDSet(level_sp)
+        driver.IDSet(output_sp)
+
+        return
+
+    def outputs(self):
+        """Returns (clients, file), True for outputs in use"""
+        handlers = self.logger.handlers
+        return self.client in handlers, self.file in handlers
+
+    def properties(self, group):
+        """Builds the log_level and log_output switch vectors"""
+        level_s = [
+            ISwitch(
+                name, ISState.ON if name == self.level else ISState.OFF,
+                name.title()
+            )
+            for name in LEVELS
+        ]
+        level_sp = ISwitchVector(
+            level_s, self.device, 'log_level', IPState.OK, ISRule.ONEOFMANY,
+            IPerm.RW, 0, 'Log Level', group
+        )
+        clients, file = self.outputs()
+        output_s = [
+            ISwitch('clients', ISState.ON if clients else ISState.OFF,
+                    'Clients'),
+            ISwitch('file', ISState.ON if file else ISState.OFF, 'File'),
+        ]
+        output_sp = ISwitchVector(
+            output_s, self.device, 'log_output', IPState.OK, ISRule.NOFMANY,
+            IPerm.RW, 0, 'Log Output', group
+        )
+
+        return level_sp, output_sp
+
+    def handle_switch(self, driver, device, name, values, names):
+        """Handles log_level and log_output, returns False for others"""
+        if name == 'log_level':
+            sp = driver.IUUpdate(device, name, values, names)
+            for s in sp:
+                if s.value == 'On':
+                    self.logger.setLevel(LEVELS[s.name])
+        elif name == 'log_output':
+            sp = driver.IUUpdate(device, name, values, names)
+            self.set_outputs(
+                sp['clients'].value == 'On', sp['file'].value == 'On'
+            )
+        else:
+            return False
+
+        driver.IDSet(sp)
+        self.info('Logging %s to %s', self.level, ', '.join(
+            output for output, on in zip(('clients', 'file'), self.outputs())
+            if on
+        ) or 'nowhere')
+
+        return True
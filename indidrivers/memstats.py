@@ -0,0 +1,154 @@
+"""memstats.py
+
+Runtime memory statistics of a driver.
+
+The drivers run for weeks under indiserver, so a slow leak only shows after
+days. Every device publishes its own memory use in the Engineering group:
+
+    rss         resident memory now, from /proc/self/statm
+    rss_peak    highest resident memory since start (ru_maxrss)
+    traced      bytes allocated by Python and still alive (tracemalloc)
+    traced_peak highest traced since start
+
+tracemalloc slows every allocation down, so it only runs when the driver is
+started with INDIDRIVERS_TRACEMALLOC=1 (tools/soak.py does), otherwise
+traced and traced_peak stay 0. While tracing, the first update takes a
+baseline snapshot and memory_growth lists the source lines that allocated
+the most since then, which is where to look when rss keeps climbing.
+
+Properties
+----------
+NP : memory
+     RSS (MB), RSS Peak (MB), Traced (MB), Traced Peak (MB)
+TP : memory_growth
+     Growth 1 .. Growth N
+"""
+import os
+import resource
+import sys
+import tracemalloc
+
+from pyindi.device import (
+    INumber, INumberVector, IPerm, IPState, IText, ITextVector
+)
+
+MB = 2**20
+
+
+def rss_bytes():
+    """Resident memory of this process, falls back to the peak without /proc"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return rss_peak_bytes()
+
+
+def rss_peak_bytes():
+    """Highest resident memory of this process"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MemoryStats():
+    """memory and memory_growth vectors for one device
+
+    Parameters
+    ----------
+    device : str
+        Device name to attach to
+    top : int
+        Number of growing source lines published
+    tracing : bool or None
+        Run tracemalloc, default from INDIDRIVERS_TRACEMALLOC
+    """
+    def __init__(self, device, top=3, tracing=None):
+        self.device = device
+        self.top = top
+        if tracing is None:
+            tracing = os.environ.get('INDIDRIVERS_TRACEMALLOC') == '1'
+        self.tracing = tracing
+        self.baseline = None
+        if tracing and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def properties(self, group):
+        """Builds the memory NP and memory_growth TP"""
+        numbers = [
+            INumber('rss', '%.1f', 0, 1e6, 0, 0, 'RSS (MB)'),
+            INumber('rss_peak', '%.1f', 0, 1e6, 0, 0, 'RSS Peak (MB)'),
+            INumber('traced', '%.2f', 0, 1e6, 0, 0, 'Traced (MB)'),
+            INumber('traced_peak', '%.2f', 0, 1e6, 0, 0, 'Traced Peak (MB)'),
+        ]
+        nvp = INumberVector(
+            numbers, self.device, 'memory', IPState.IDLE, IPerm.RO, 0, None,
+            'Memory', group
+        )
+        texts = [
+            IText(f'growth_{i}', '', f'Growth {i}')
+            for i in range(1, self.top + 1)
+        ]
+        tvp = ITextVector(
+            texts, self.device, 'memory_growth', IPState.IDLE, IPerm.RO, 0,
+            None, 'Memory Growth', group
+        )
+
+        return nvp, tvp
+
+    def growth(self):
+        """Returns '+size KB  count blocks  file:line' since the baseline"""
+        if not self.tracing:
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ])
+        if self.baseline is None:
+            self.baseline = snapshot
+            return []
+
+        lines = []
+        for diff in snapshot.compare_to(self.baseline, 'lineno'):
+            if len(lines) == self.top:
+                break
+            if diff.size_diff <= 0:
+                continue
+            frame = diff.traceback[0]
+            filename = frame.filename.rsplit('/', 1)[-1]
+            lines.append(
+                f'+{diff.size_diff / 1024:.1f} KB  {diff.count_diff:+d} '
+                f'blocks  {filename}:{frame.lineno}'
+            )
+
+        return lines
+
+    def update(self, driver):
+        """Publishes memory and, while tracing, memory_growth"""
+        try:
+            nvp = driver.IUFind('memory')
+        except ValueError:
+            return
+
+        nvp['rss'].value = rss_bytes() / MB
+        nvp['rss_peak'].value = rss_peak_bytes() / MB
+        if self.tracing:
+            traced, peak = tracemalloc.get_traced_memory()
+            nvp['traced'].value = traced / MB
+            nvp['traced_peak'].value = peak / MB
+        nvp.state = IPState.OK
+        driver.IDSet(nvp)
+
+        if not self.tracing:
+            return
+        try:
+            tvp = driver.IUFind('memory_growth')
+        except ValueError:
+            return
+        lines = self.growth()
+        for i in range(1, self.top + 1):
+            tvp[f'growth_{i}'].value = lines[i - 1] if i <= len(lines) else ''
+        tvp.state = IPState.OK
+        driver.IDSet(tvp)
+
+        return
@@ -0,0 +1,283 @@
+"""metrics.py
+
+OpenMetrics exporter for driver health and telemetry.
+
+Monitoring used to need its own INDI client to see the weather. A driver can
+instead serve http://host:port/metrics itself. Everything in a scrape comes
+from memory, what the last polls left behind, so a scrape never reaches the
+hardware and only holds the event loop for as long as it takes to format
+a few hundred lines.
+
+DriverMetrics collects, per data source of a device
+    indi_polls_total               polls made
+    indi_poll_errors_total         polls that failed
+    indi_poll_latency_seconds      histogram of poll round trips
+    indi_push_events_total         change events received instead
+    indi_data_age_seconds          from the device's Freshness
+and, for the vectors it is told to export
+    indi_vector_state              0 Idle, 1 Ok, 2 Busy, 3 Alert
+    indi_value                     every numeric element (numbers, numeric
+                                   text, switches as 0/1, lights as their
+                                   state)
+
+MetricsServer serves one or more devices, so a process hosting several can
+expose them on a single port. Drivers start it when their config has a
+metrics port:
+
+    {"metrics": {"host": "0.0.0.0", "port": 9461}}
+"""
+import asyncio
+import math
+
+from pyindi.device import IPState
+
+from indidrivers.publish import as_float
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATES = {
+    IPState.IDLE: 0,
+    IPState.OK: 1,
+    IPState.BUSY: 2,
+    IPState.ALERT: 3,
+}
+SWITCHES = {'Off': 0, 'On': 1}
+FAMILIES = {
+    'indi_polls': ('counter', 'Polls made'),
+    'indi_poll_errors': ('counter', 'Polls that failed'),
+    'indi_poll_latency_seconds': ('histogram', 'Poll round trip time'),
+    'indi_push_events': ('counter', 'Change events received'),
+    'indi_data_age_seconds': ('gauge', 'Seconds since data was acquired'),
+    'indi_vector_state': ('gauge', '0 Idle, 1 Ok, 2 Busy, 3 Alert'),
+    'indi_value': ('gauge', 'Latest value of a numeric element'),
+}
+
+
+def state_value(state):
+    """Number for an IPState, also accepts the 'Ok'... strings"""
+    for s, n in STATES.items():
+        if state == s or state == s.value:
+            return n
+    return None
+
+
+def format_value(value):
+    """OpenMetrics text for a sample value, NaN, +Inf and -Inf spelled the
+    way it wants them rather than Python's nan and inf"""
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(int(value))
+
+
+def element_value(value):
+    """Number for an element value, None if it has none"""
+    number = as_float(value)
+    if number is not None:
+        return number
+    number = SWITCHES.get(getattr(value, 'value', value))
+    if number is not None:
+        return number
+    return state_value(value)
+
+
+def labels(**kwargs):
+    """{key="value",...} with OpenMetrics escaping"""
+    escaped = (
+        f'{k}="' + str(v).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n') + '"'
+        for k, v in kwargs.items()
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class PollStats():
+    """Counts and latency histogram of one source"""
+    def __init__(self):
+        self.polls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, seconds, ok):
+        self.polls += 1
+        if not ok:
+            self.errors += 1
+        self.total += seconds
+        for i, le in enumerate(BUCKETS):
+            if seconds <= le:
+                self.buckets[i] += 1
+
+        return
+
+
+class DriverMetrics():
+    """Metrics of one device, see module docstring
+
+    Parameters
+    ----------
+    device : str
+        Device name, the device label of every sample
+    vectors : list
+        Names of the vectors whose state and values are exported
+    freshness : indidrivers.freshness.Freshness or None
+        Exports data age of its sources
+    """
+    def __init__(self, device, vectors=(), freshness=None):
+        self.device = device
+        self.vectors = list(vectors)
+        self.freshness = freshness
+        self.driver = None
+        self.sources = {}
+        self.events = {}
+
+    def attach(self, driver):
+        """Sets the driver whose vectors are exported"""
+        self.driver = driver
+
+    def polled(self, source, seconds, ok=True):
+        """Records a poll of source that took seconds"""
+        if source not in self.sources:
+            self.sources[source] = PollStats()
+        self.sources[source].add(seconds, ok)
+
+    def pushed(self, source):
+        """Records a change event of source"""
+        self.events[source] = self.events.get(source, 0) + 1
+
+    def samples(self):
+        """Yields (family, suffix, labels, value) for every sample"""
+        for source, stats in self.sources.items():
+            l = dict(device=self.device, source=source)
+            yield 'indi_polls', '_total', labels(**l), stats.polls
+            yield 'indi_poll_errors', '_total', labels(**l), stats.errors
+            for le, count in zip(BUCKETS, stats.buckets):
+                yield ('indi_poll_latency_seconds', '_bucket',
+                       labels(**l, le=le), count)
+            yield ('indi_poll_latency_seconds', '_bucket',
+                   labels(**l, le='+Inf'), stats.polls)
+            yield 'indi_poll_latency_seconds', '_count', labels(**l), \
+                stats.polls
+            yield 'indi_poll_latency_seconds', '_sum', labels(**l), \
+                stats.total
+        for source, events in self.events.items():
+            yield 'indi_push_events', '_total', labels(
+                device=self.device, source=source
+            ), events
+
+        if self.freshness is not None:
+            for source in self.freshness.sources:
+                age = self.freshness.age(source)
+                if age is not None:
+                    yield ('indi_data_age_seconds', '', labels(
+                        device=self.device, source=source
+                    ), age)
+
+        if self.driver is None:
+            return
+        for name in self.vectors:
+            try:
+                vp = self.driver.IUFind(name)
+            except ValueError:
+                continue
+            state = state_value(vp.state)
+            if state is not None:
+                yield 'indi_vector_state', '', labels(
+                    device=self.device, vector=name
+                ), state
+            for element in vp:
+                value = element_value(element.value)
+                if value is None:
+                    continue
+                yield 'indi_value', '', labels(
+                    device=self.device, vector=name, element=element.name
+                ), value
+
+        return
+
+
+def render(metrics):
+    """OpenMetrics text for a list of DriverMetrics"""
+    families = {family: [] for family in FAMILIES}
+    for m in metrics:
+        for family, suffix, l, value in m.samples():
+            families[family].append(
+                f'{family}{suffix}{l} {format_value(value)}'
+            )
+
+    lines = []
+    for family, samples in families.items():
+        if not samples:
+            continue
+        kind, help_text = FAMILIES[family]
+        lines.append(f'# TYPE {family} {kind}')
+        lines.append(f'# HELP {family} {help_text}')
+        lines += samples
+    lines.append('# EOF')
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer():
+    """Minimal HTTP server answering GET /metrics
+
+    Parameters
+    ----------
+    metrics : list
+        DriverMetrics to serve
+    host, port : str, int
+        Where to listen, port None leaves the server off
+    """
+    def __init__(self, metrics, host='localhost', port=None):
+        self.metrics = list(metrics)
+        self.host = host
+        self.port = port
+        self.scrapes = 0
+        self._server = None
+        self._starting = None
+
+    def ensure_started(self):
+        """Starts listening on the running loop, once"""
+        if self.port is None:
+            return
+        if self._starting is None:
+            self._starting = asyncio.ensure_future(self.start())
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # Headers are not needed, just consume them
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and \
+                    parts[1].split('?')[0] == '/metrics':
+                self.scrapes += 1
+                status, body = '200 OK', render(self.metrics).encode()
+                content_type = CONTENT_TYPE
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+                content_type = 'text/plain'
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+                .encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
@@ -0,0 +1,431 @@
+"""operations.py
+
+Coordinated opening and closing of the observatory.
+
+Closing up meant Close All on the upper dome, Close on the mirror cover and
+switching off the flatfield lamps, one device at a time, each watched until
+it was done before clicking the next. A Coordinator runs a whole plan from
+one switch. Plans are dependency graphs of steps
+
+    close   lamps_off, mirror_cover, dome       all at once
+    open    weather -> dome -> mirror_cover     in that order, the mirror
+                                                is only uncovered under an
+                                                open dome in safe weather
+
+A step starts as soon as the steps it comes after are done, steps without
+an order between them run in parallel. A step first requests its source;
+when the data already shows it done nothing is sent. Otherwise it sends its
+command(s) and requests the source every interval seconds until the
+device's own state shows it done (the states the drivers follow: all three
+dome parts Opened or Closed, mirror_cover_state, the lamp flags), for at
+most its timeout. A check step (weather) sends nothing and fails unless the
+data shows it done. A step after a failed one is skipped, the others carry
+on.
+
+Every step reports its duration split into commands and motion, and the
+plan its wall-clock total next to the sum of the steps, what running them
+one after another would at least have taken. Every status requested is
+handed to on_data, so the summary vectors follow the motion closely too.
+
+Abort stops coordinating, devices already moving finish their motion (stop
+them from their own drivers).
+
+Properties
+----------
+SP : operations
+     Open, Close, Abort. BUSY while running, OK when done, ALERT when a step
+     failed or it was aborted
+LP : operation_steps
+     One light per step: IDLE not run, BUSY running, OK done, ALERT failed
+     or skipped
+TP : operation_report
+     Operation, Result, one line per step
+NP : operation_timing
+     Total, Steps Sum and one duration per step (s)
+"""
+import asyncio
+import collections
+
+from pyindi.device import (
+    ILight, ILightVector, INumber, INumberVector, IPerm, IPState, ISRule,
+    ISState, ISwitch, ISwitchVector, IText, ITextVector
+)
+
+from indidrivers import clock
+from indidrivers.backend import invoke
+from indidrivers.summary import CONDITIONS, SOURCES, condition_state
+
+Step = collections.namedtuple('Step', 'name label source calls done after')
+
+
+def parts_are(state):
+    """Done when the dome slit and both windscreens are in state"""
+    return lambda data: all(
+        data.get(f'{part}_state') == state
+        for part in ('domeslit', 'upperws', 'lowerws')
+    )
+
+
+def mirror_cover_is(state):
+    return lambda data: data.get('mirror_cover_state') == state
+
+
+def lamps_off(data):
+    return not data.get('halogen_lamps') and not data.get('uband_lamps')
+
+
+def weather_safe(data):
+    """No condition the weather driver would light ALERT"""
+    return all(
+        condition_state(data.get(f'{condition}_condition')) != IPState.ALERT
+        for condition in CONDITIONS
+    )
+
+
+# Operation to its steps, a step's after names steps listed before it
+PLANS = {
+    'close': [
+        Step(
+            'lamps_off', 'Lamps Off', 'flatfield',
+            [('command_halogen', False), ('command_uband', False)],
+            lamps_off, ()
+        ),
+        Step(
+            'mirror_cover', 'Mirror Cover', 'mirror_cover',
+            [('command_close',)], mirror_cover_is('Closed'), ()
+        ),
+        Step(
+            'dome', 'Dome', 'upperdome', [('command_all_close',)],
+            parts_are('Closed'), ()
+        ),
+    ],
+    'open': [
+        Step('weather', 'Weather', 'weather', [], weather_safe, ()),
+        Step(
+            'dome', 'Dome', 'upperdome', [('command_all_open',)],
+            parts_are('Opened'), ('weather',)
+        ),
+        Step(
+            'mirror_cover', 'Mirror Cover', 'mirror_cover',
+            [('command_open',)], mirror_cover_is('Opened'), ('dome',)
+        ),
+    ],
+}
+# Every step of every plan, in the order they are shown
+STEPS = {step.name: step.label for plan in PLANS.values() for step in plan}
+
+
+class StepFailed(Exception):
+    """A command failed, a check did not pass or a step timed out"""
+
+
+class Coordinator():
+    """Runs the plans in PLANS, see module docstring
+
+    Parameters
+    ----------
+    device : str
+        Device name to attach to
+    telescope : callable
+        Returns the telescope serving a source of indidrivers.summary
+        SOURCES, called for every request since connections get replaced
+    on_data : callable or None
+        Called with (source, data) for every status requested
+    interval : float
+        Seconds between status requests while a step is moving
+    timeouts : dict
+        Step name to the seconds it may take
+    log : indidrivers.log.DriverLog or None
+        Where progress and failures are reported
+    call : coroutine function
+        Makes the hardware calls, the driver's Watchdog.call so they share
+        its worker with the polls
+    """
+    def __init__(self, device, telescope, on_data=None, interval=0.25,
+                 timeouts=None, log=None, call=invoke):
+        self.device = device
+        self.telescope = telescope
+        self.call = call
+        self.on_data = on_data
+        self.interval = interval
+        self.timeouts = dict(timeouts or {})
+        self.log = log
+        self.task = None
+        self.operation = ''
+        self.result = ''
+        self.states = {name: IPState.IDLE for name in STEPS}
+        self.reports = {name: '' for name in STEPS}
+        self.durations = {name: 0.0 for name in STEPS}
+        self.step_started = {}
+        self.started = None
+        self.total = 0.0
+
+    def configure(self, interval=0.25, timeouts=None):
+        """Applies a reloaded operations config"""
+        self.interval = interval
+        self.timeouts = dict(timeouts or {})
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def properties(self, group):
+        """Builds the operations SP, operation_steps LP, operation_report TP
+        and operation_timing NP"""
+        svp = ISwitchVector(
+            [
+                ISwitch('open', ISState.OFF, 'Open'),
+                ISwitch('close', ISState.OFF, 'Close'),
+                ISwitch('abort', ISState.OFF, 'Abort'),
+            ],
+            self.device, 'operations', IPState.IDLE, ISRule.ATMOST1, IPerm.RW,
+            0, 'Operations', group
+        )
+        lvp = ILightVector(
+            [
+                ILight(name, self.states[name], label)
+                for name, label in STEPS.items()
+            ],
+            self.device, 'operation_steps', IPState.IDLE, 0, None, 'Steps',
+            group
+        )
+        texts = [
+            IText('operation', self.operation, 'Operation'),
+            IText('result', self.result, 'Result'),
+        ] + [
+            IText(name, self.reports[name], label)
+            for name, label in STEPS.items()
+        ]
+        tvp = ITextVector(
+            texts, self.device, 'operation_report', IPState.IDLE, IPerm.RO, 0,
+            None, 'Report', group
+        )
+        numbers = [
+            INumber('total', '%.1f', 0, 1e6, 0, self.total, 'Total (s)'),
+            INumber(
+                'steps_sum', '%.1f', 0, 1e6, 0, sum(self.durations.values()),
+                'Steps Sum (s)'
+            ),
+        ] + [
+            INumber(name, '%.1f', 0, 1e6, 0, self.durations[name],
+                    f'{label} (s)')
+            for name, label in STEPS.items()
+        ]
+        nvp = INumberVector(
+            numbers, self.device, 'operation_timing', IPState.IDLE, IPerm.RO,
+            0, None, 'Timing', group
+        )
+
+        return svp, lvp, tvp, nvp
+
+    def handle_switch(self, driver, device, name, values, names):
+        """Starts or aborts a plan, returns False for other switches"""
+        if name != 'operations':
+            return False
+
+        pressed = {n for n, v in zip(names, values) if v == 'On'}
+        if 'abort' in pressed:
+            if self.running:
+                self.task.cancel()
+            return True
+        operation = next((n for n in PLANS if n in pressed), None)
+        if operation is None:
+            return True
+        if self.running:
+            self.report(
+                'warning', '%s running, ignoring %s', self.operation,
+                operation
+            )
+            return True
+        self.task = asyncio.ensure_future(self.run(driver, operation))
+
+        return True
+
+    async def run(self, driver, operation):
+        """Runs the steps of operation, in parallel where they can"""
+        plan = PLANS[operation]
+        self.operation = operation
+        self.result = 'running'
+        for name in STEPS:
+            self.states[name] = IPState.IDLE
+            self.reports[name] = ''
+            self.durations[name] = 0.0
+        self.step_started = {}
+        self.started = started = clock.monotonic()
+        self.set_switch(driver, operation, IPState.BUSY)
+        self.publish(driver)
+
+        tasks = {}
+        for step in plan:
+            tasks[step.name] = asyncio.ensure_future(
+                self.run_step(driver, step, tasks)
+            )
+        try:
+            results = await asyncio.gather(*tasks.values())
+        except asyncio.CancelledError:
+            for task in tasks.values():
+                task.cancel()
+            self.result = 'aborted'
+            for step in plan:
+                if self.states[step.name] == IPState.BUSY:
+                    self.set_step(driver, step, IPState.ALERT, 'aborted')
+        else:
+            self.result = 'done' if all(results) else 'failed'
+
+        self.total = clock.monotonic() - started
+        steps_sum = sum(self.durations[step.name] for step in plan)
+        self.publish(driver)
+        self.set_switch(
+            driver, None,
+            IPState.OK if self.result == 'done' else IPState.ALERT
+        )
+        self.report(
+            'info' if self.result == 'done' else 'warning',
+            '%s %s in %.1f s, steps took %.1f s one after another: %s',
+            operation.title(), self.result, self.total, steps_sum, ', '.join(
+                f'{step.name} {self.durations[step.name]:.1f} s'
+                for step in plan
+            )
+        )
+
+    async def run_step(self, driver, step, tasks):
+        """Runs step once the steps it comes after are done
+
+        Returns True if it is done.
+        """
+        for name in step.after:
+            if not await asyncio.shield(tasks[name]):
+                self.set_step(driver, step, IPState.ALERT, f'skipped, {name} '
+                              'not done')
+                return False
+
+        started = self.step_started[step.name] = clock.monotonic()
+        self.set_step(driver, step, IPState.BUSY, 'running')
+        try:
+            data = await self.request(step.source)
+            if step.done(data):
+                self.durations[step.name] = clock.monotonic() - started
+                self.set_step(driver, step, IPState.OK, 'already done')
+                return True
+            if not step.calls:
+                raise StepFailed(f'{step.label.lower()} not ok')
+
+            await self.send(step)
+            sent = clock.monotonic()
+            deadline = started + self.timeouts.get(step.name, 60)
+            while True:
+                try:
+                    data = await self.request(step.source)
+                except Exception as e:
+                    # Keep watching until the deadline, the motion goes on
+                    self.report('debug', '%s: %s', step.name, e)
+                    data = None
+                if data is not None and step.done(data):
+                    break
+                now = clock.monotonic()
+                if now >= deadline:
+                    raise StepFailed(
+                        f'not done after {now - started:.0f} s'
+                    )
+                await clock.sleep_until(now + self.interval)
+        except StepFailed as e:
+            self.durations[step.name] = clock.monotonic() - started
+            self.set_step(driver, step, IPState.ALERT, f'failed, {e}')
+            self.report('error', '%s %s', step.name, e)
+            return False
+        except Exception as e:
+            self.durations[step.name] = clock.monotonic() - started
+            self.set_step(driver, step, IPState.ALERT, f'failed, {e}')
+            self.report('error', '%s failed: %s', step.name, e)
+            return False
+
+        finished = clock.monotonic()
+        self.durations[step.name] = finished - started
+        self.set_step(
+            driver, step, IPState.OK,
+            f'done in {finished - started:.1f} s (commands '
+            f'{(sent - started) * 1000:.0f} ms, motion {finished - sent:.1f} '
+            's)'
+        )
+        return True
+
+    async def request(self, source):
+        """Requests the status of source and hands it to on_data"""
+        subsystem, method = SOURCES[source]
+        data = await self.call(
+            getattr(getattr(self.telescope(source), subsystem), method)
+        )
+        if self.on_data is not None:
+            self.on_data(source, data)
+        return data
+
+    async def send(self, step):
+        """Sends the commands of step"""
+        subsystem = getattr(
+            self.telescope(step.source), SOURCES[step.source][0]
+        )
+        for method, *args in step.calls:
+            try:
+                ok = await self.call(getattr(subsystem, method), *args)
+            except Exception as e:
+                raise StepFailed(f'{method} failed: {e}')
+            if ok is False:
+                raise StepFailed(f'{method} returned False')
+
+    def report(self, level, message, *args):
+        if self.log is not None:
+            getattr(self.log, level)(message, *args)
+
+    def set_step(self, driver, step, state, text):
+        self.states[step.name] = state
+        self.reports[step.name] = text
+        self.publish(driver)
+
+    def set_switch(self, driver, operation, state):
+        """Shows the running operation on, state the vector state"""
+        try:
+            svp = driver.IUFind('operations')
+        except ValueError:
+            return
+        for switch in svp:
+            switch.value = 'On' if switch.name == operation else 'Off'
+        svp.state = state
+        driver.IDSet(svp)
+
+    def publish(self, driver):
+        """Publishes operation_steps, operation_report and
+        operation_timing, call about once a second while running"""
+        try:
+            lvp = driver.IUFind('operation_steps')
+            tvp = driver.IUFind('operation_report')
+            nvp = driver.IUFind('operation_timing')
+        except ValueError:
+            return
+        if self.result == 'running':
+            state = IPState.BUSY
+        elif self.result == 'done':
+            state = IPState.OK
+        else:
+            state = IPState.ALERT
+
+        now = clock.monotonic()
+        if self.result == 'running':
+            # Steps still moving count up
+            self.total = now - self.started
+            for name, started in self.step_started.items():
+                if self.states[name] == IPState.BUSY:
+                    self.durations[name] = now - started
+        for name in STEPS:
+            lvp[name].value = self.states[name]
+            tvp[name].value = self.reports[name]
+            nvp[name].value = self.durations[name]
+        lvp.state = state
+        tvp['operation'].value = self.operation
+        tvp['result'].value = self.result
+        tvp.state = state
+        nvp['total'].value = self.total
+        nvp['steps_sum'].value = sum(self.durations.values())
+        nvp.state = state
+        driver.IDSet(lvp)
+        driver.IDSet(tvp)
+        driver.IDSet(nvp)
@@ -0,0 +1,262 @@
+"""outqueue.py
+
+Coalescing output for slow consumers.
+
+pyindi takes whatever IDSet and IDMessage hand it and writes it out as fast
+as indiserver reads. When indiserver or a client behind it stops reading,
+the 500 ms and 1 s loops keep adding messages nobody reads: the output
+grows without bound, or, once the pipe is full and written to directly,
+the driver freezes on a write.
+
+An OutputQueue sits in front of both:
+
+    output = OutputQueue(MYDEVICE, log=log)
+    output.attach(driver)       # before driver.start()
+
+IDSet only marks the vector pending and returns, there is one pending slot
+per vector. A vector set again before it went out is coalesced: it goes out
+once with its newest values, in the place of the first set. So that clients
+still see a state change (BUSY to OK, say), a slot whose vector changed
+state also keeps the last set in the state it changed from, and that goes
+out first. The vectors are the driver's own objects, so the state,
+timestamp and values of a set are kept and put back on the vector while
+pyindi writes it. Messages are kept up to max_messages, the oldest are
+dropped. A task hands pending sets and messages to pyindi in the order they
+became pending, but only while pyindi's backlog is under max_backlog
+messages, otherwise it waits retry seconds and looks again. A slow consumer
+thus gets fewer updates of the same vectors instead of a growing backlog,
+and the poll loops never wait.
+
+The backlog is the length of pyindi's outq, and pyindi counts as backed up
+too while its stdout writer holds more than WRITE_BUFFER bytes. A pyindi
+without either has everything handed on at once, still coalesced within
+one pass of the loop.
+
+Properties
+----------
+NP : output_queue
+     Pending, Backlog, Sent, Coalesced, Dropped. BUSY while backed up.
+"""
+import asyncio
+import collections
+
+from pyindi.device import INumber, INumberVector, IPerm, IPState
+
+# Bytes in pyindi's stdout transport buffer that count as backed up, the
+# asyncio default high-water mark
+WRITE_BUFFER = 64 * 1024
+
+
+def snapshot(vp):
+    """What a set of vp sends: (state, timestamp, element values)"""
+    return (vp.state, vp.timestamp, [element.value for element in vp])
+
+
+def restore(vp, values):
+    """Puts a snapshot back on vp"""
+    vp.state, vp.timestamp, elements = values
+    for element, value in zip(vp, elements):
+        element.value = value
+
+
+class OutputQueue():
+    """Coalescing queue in front of a driver's IDSet and IDMessage, see
+    module docstring
+
+    Parameters
+    ----------
+    device : str
+        Device name to attach to
+    max_backlog : int
+        Messages pyindi may have unwritten before the queue holds back
+    max_messages : int
+        IDMessages kept while held back, the oldest are dropped
+    retry : float
+        Seconds between looks at the backlog while held back
+    log : indidrivers.log.DriverLog or None
+        Where to report backing up and recovering
+    """
+    def __init__(self, device, max_backlog=50, max_messages=100, retry=0.1,
+                 log=None):
+        self.device = device
+        self.max_backlog = max_backlog
+        self.retry = retry
+        self.log = log
+        self.max_messages = max_messages
+        # ('set', vector name) -> (vector, msg, snapshot it changed from or
+        # None, newest snapshot) and ('message', n) -> (args, kwargs), in
+        # pending order
+        self.pending = collections.OrderedDict()
+        self.messages = collections.deque() # keys of pending messages
+        self.count = 0
+        self.driver = None
+        self.idset = None
+        self.idmessage = None
+        self.task = None
+        self.wake = None
+        self.backed_up = False
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def configure(self, max_backlog=50, max_messages=100, retry=0.1):
+        """Applies a reloaded output config"""
+        self.max_backlog = max_backlog
+        self.retry = retry
+        self.max_messages = max_messages
+        while len(self.messages) > self.max_messages:
+            self.drop_message()
+
+    def attach(self, driver):
+        """Puts the queue in front of driver's IDSet and IDMessage"""
+        self.driver = driver
+        self.idset = driver.IDSet
+        self.idmessage = driver.IDMessage
+        driver.IDSet = self.set
+        driver.IDMessage = self.message
+
+    def properties(self, group):
+        """Builds the output_queue NP"""
+        numbers = [
+            INumber(name, '%.0f', 0, 1e12, 0, 0, label)
+            for name, label in (
+                ('pending', 'Pending'), ('backlog', 'Backlog'),
+                ('sent', 'Sent'), ('coalesced', 'Coalesced'),
+                ('dropped', 'Dropped'),
+            )
+        ]
+        return INumberVector(
+            numbers, self.device, 'output_queue', IPState.IDLE, IPerm.RO, 0,
+            None, 'Output Queue', group
+        )
+
+    def set(self, vp, msg=None):
+        """IDSet, vp goes out once with its newest values, after the state
+        it changed from if it did"""
+        key = ('set', vp.name)
+        values = snapshot(vp)
+        if key in self.pending:
+            self.coalesced += 1
+            _, previous, before, newest = self.pending[key]
+            # A message that came with the replaced set still goes out
+            if msg is None:
+                msg = previous
+            if newest[0] != vp.state:
+                before = newest
+            self.pending[key] = (vp, msg, before, values)
+        else:
+            self.pending[key] = (vp, msg, None, values)
+        self.kick()
+
+    def message(self, *args, **kwargs):
+        """IDMessage, the oldest unsent message goes when max_messages are
+        waiting"""
+        while self.messages and len(self.messages) >= self.max_messages:
+            self.drop_message()
+        self.count += 1
+        key = ('message', self.count)
+        self.messages.append(key)
+        self.pending[key] = (args, kwargs)
+        self.kick()
+
+    def drop_message(self):
+        """Forgets the oldest pending message"""
+        del self.pending[self.messages.popleft()]
+        self.dropped += 1
+
+    def kick(self):
+        """Wakes the task handing output on, starts it the first time"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Not running yet, nothing can be backed up
+            while self.pending:
+                self.send_next()
+            return
+        if self.task is None or self.task.done():
+            self.wake = asyncio.Event()
+            self.task = asyncio.ensure_future(self.run())
+        self.wake.set()
+
+    def backlog(self):
+        """Messages pyindi has not written yet, None if it cannot tell"""
+        outq = getattr(self.driver, 'outq', None)
+        if hasattr(outq, 'qsize'):
+            return outq.qsize()
+        return None
+
+    def congested(self):
+        """True while pyindi is too far behind to be handed more"""
+        backlog = self.backlog()
+        if backlog is not None and backlog >= self.max_backlog:
+            return True
+        writer = getattr(self.driver, 'writer', None)
+        transport = getattr(writer, 'transport', None)
+        if hasattr(transport, 'get_write_buffer_size'):
+            return transport.get_write_buffer_size() >= WRITE_BUFFER
+        return False
+
+    def send_next(self):
+        """Hands the oldest pending set or message to pyindi"""
+        key, entry = self.pending.popitem(last=False)
+        if key[0] == 'message':
+            self.messages.popleft()
+            args, kwargs = entry
+            self.idmessage(*args, **kwargs)
+        else:
+            vp, msg, before, values = entry
+            if before is not None:
+                self.write(vp, before)
+                self.sent += 1
+            self.write(vp, values, msg)
+        self.sent += 1
+
+    def write(self, vp, values, msg=None):
+        """Hands vp to pyindi as it was when values were taken"""
+        # Written as it was set, then back to what the driver has now
+        current = snapshot(vp)
+        restore(vp, values)
+        try:
+            self.idset(vp, msg)
+        finally:
+            restore(vp, current)
+
+    async def run(self):
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            while self.pending:
+                if self.congested():
+                    if not self.backed_up:
+                        self.backed_up = True
+                        if self.log is not None:
+                            self.log.warning(
+                                'Output backed up (%s unwritten), coalescing',
+                                self.backlog()
+                            )
+                    await asyncio.sleep(self.retry)
+                    continue
+                if self.backed_up:
+                    self.backed_up = False
+                    if self.log is not None:
+                        self.log.info(
+                            'Output flowing again, %d coalesced, %d dropped '
+                            'so far', self.coalesced, self.dropped
+                        )
+                self.send_next()
+
+    def update(self, driver):
+        """Publishes output_queue"""
+        try:
+            nvp = driver.IUFind('output_queue')
+        except ValueError:
+            return
+        nvp['pending'].value = len(self.pending)
+        nvp['backlog'].value = self.backlog() or 0
+        nvp['sent'].value = self.sent
+        nvp['coalesced'].value = self.coalesced
+        nvp['dropped'].value = self.dropped
+        nvp.state = IPState.BUSY if self.backed_up else IPState.OK
+        driver.IDSet(nvp)
+
+        return
@@ -0,0 +1,25 @@
+"""paths.py
+
+Where drivers keep files that outlive a single run (phase statistics,
+profiles, logs...). Defaults to ~/.local/state/indidrivers and can be moved
+with the INDIDRIVERS_STATE_DIR environment variable.
+"""
+import os
+from pathlib import Path
+
+
+def state_dir():
+    """Returns the state directory, creating it if needed"""
+    path = os.environ.get('INDIDRIVERS_STATE_DIR')
+    if path:
+        path = Path(path)
+    else:
+        path = Path.home() / '.local' / 'state' / 'indidrivers'
+    path.mkdir(parents=True, exist_ok=True)
+
+    return path
+
+
+def state_file(name):
+    """Returns the path of a file called name in the state directory"""
+    return state_dir() / name
@@ -0,0 +1,353 @@
+"""phases.py
+
+Timing model for mechanism phases (dome slit opening, mirror cover closing...).
+
+A PhaseTimer is fed the current phase on every poll. When the phase changes
+it records how long the previous one took, provided the mechanism moved on to
+the next phase of its sequence, or, after the last phase, the data shows the
+end of the sequence (the caller says which sequence ended, e.g. Idle with
+every part Opened ends open_all). A Stop, a Fault or a new command cut the
+phase short and would only pollute the statistics. Each phase keeps a
+DurationStats, an incrementally updated log-spaced histogram, so medians and
+p99 are available without keeping every sample around.
+
+From those statistics the timer gives
+    eta      : seconds until the whole sequence is done
+    slow     : True once the running phase has exceeded its p99
+
+Statistics are saved to a small JSON file whenever a sample is recorded so
+they survive driver restarts.
+
+Properties
+----------
+phase_timing_properties builds
+    NP : phase_timing
+         ETA, Elapsed, Expected, P99
+    LP : phase_alerts
+         One light per phase, ALERT when the phase last ran slow
+"""
+import json
+import math
+
+from pyindi.device import (
+    ILight, ILightVector, INumber, INumberVector, IPerm, IPState
+)
+
+from indidrivers import clock
+
+
+class DurationStats():
+    """Incremental distribution of phase durations in seconds"""
+    BINS_PER_DECADE = 20
+    MIN_SECONDS = 0.1
+    DECADES = 5 # 0.1 s to 10000 s
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.bins = [0] * (self.BINS_PER_DECADE * self.DECADES + 1)
+
+    def _bin(self, seconds):
+        """Returns the histogram bin for seconds"""
+        if seconds <= self.MIN_SECONDS:
+            return 0
+        index = int(
+            math.log10(seconds / self.MIN_SECONDS) * self.BINS_PER_DECADE
+        ) + 1
+
+        return min(index, len(self.bins) - 1)
+
+    def _edge(self, index):
+        """Returns the upper edge in seconds of bin index"""
+        return self.MIN_SECONDS * 10 ** (index / self.BINS_PER_DECADE)
+
+    def add(self, seconds):
+        """Adds a sample, O(1)"""
+        self.count += 1
+        delta = seconds - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (seconds - self.mean)
+        self.bins[self._bin(seconds)] += 1
+        if self.minimum is None or seconds < self.minimum:
+            self.minimum = seconds
+        if self.maximum is None or seconds > self.maximum:
+            self.maximum = seconds
+
+        return
+
+    @property
+    def stddev(self):
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self._m2 / (self.count - 1))
+
+    def quantile(self, q):
+        """Returns an estimate of quantile q, None if no samples"""
+        if not self.count:
+            return None
+
+        wanted = q * self.count
+        seen = 0
+        for index, n in enumerate(self.bins):
+            seen += n
+            if seen >= wanted:
+                # Never report beyond what has actually been seen
+                return min(self._edge(index), self.maximum)
+
+        return self.maximum
+
+    @property
+    def median(self):
+        return self.quantile(0.5)
+
+    @property
+    def p99(self):
+        return self.quantile(0.99)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'm2': self._m2,
+            'min': self.minimum,
+            'max': self.maximum,
+            'bins': self.bins,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls()
+        stats.count = d['count']
+        stats.mean = d['mean']
+        stats._m2 = d['m2']
+        stats.minimum = d['min']
+        stats.maximum = d['max']
+        if len(d['bins']) == len(stats.bins):
+            stats.bins = d['bins']
+
+        return stats
+
+
+class PhaseTimer():
+    """Times phases of a mechanism from its state transitions
+
+    Parameters
+    ----------
+    sequences : dict
+        Name of each sequence to the ordered list of phases it goes through,
+        e.g. {'open': ['domeslit_opening', 'upper_windscreen_opening']}
+    path : pathlib.Path or None
+        JSON file to load and save the statistics, None to keep in memory
+    min_samples : int
+        Samples a phase needs before its p99 is used for the slow alert
+    """
+    def __init__(self, sequences, path=None, min_samples=10):
+        self.sequences = sequences
+        self.path = path
+        self.min_samples = min_samples
+        self.stats = {}
+        for phases in sequences.values():
+            for phase in phases:
+                self.stats[phase] = DurationStats()
+        self.phase = None
+        self.started = None
+        self.slow_phases = set() # Phases whose last run went past p99
+        self._load()
+
+    def _load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            saved = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return
+        for phase, d in saved.items():
+            if phase in self.stats:
+                self.stats[phase] = DurationStats.from_dict(d)
+
+        return
+
+    def _save(self):
+        if self.path is None:
+            return
+        try:
+            self.path.write_text(json.dumps(
+                {phase: s.to_dict() for phase, s in self.stats.items()}
+            ))
+        except OSError:
+            pass
+
+        return
+
+    def sequence_of(self, phase):
+        """Returns the list of phases that phase is part of"""
+        for phases in self.sequences.values():
+            if phase in phases:
+                return phases
+        return None
+
+    def sequence_name(self, phase):
+        """Returns the name of the sequence phase is part of"""
+        for name, phases in self.sequences.items():
+            if phase in phases:
+                return name
+        return None
+
+    def _completed(self, phase, next_phase, ended):
+        """True if moving from phase to next_phase finishes phase normally"""
+        phases = self.sequence_of(phase)
+        index = phases.index(phase)
+        if index + 1 < len(phases):
+            return next_phase == phases[index + 1]
+        # Last phase of a sequence finishes only at the end of its sequence
+        return next_phase is None and ended == self.sequence_name(phase)
+
+    def update(self, phase, now=None, ended=None):
+        """Feed the current phase, None or any unknown name means not moving
+
+        ended is the name of the sequence whose end the data shows (None if
+        it shows none), only then does leaving the last phase count.
+
+        Returns the duration of the phase that just completed normally,
+        otherwise None.
+        """
+        now = clock.monotonic() if now is None else now
+        if phase not in self.stats:
+            phase = None
+        if phase == self.phase:
+            return None
+
+        duration = None
+        if self.phase is not None and \
+                self._completed(self.phase, phase, ended):
+            duration = now - self.started
+            stats = self.stats[self.phase]
+            stats.add(duration)
+            if self._is_slow(self.phase, duration):
+                self.slow_phases.add(self.phase)
+            else:
+                self.slow_phases.discard(self.phase)
+            self._save()
+
+        self.phase = phase
+        self.started = now if phase is not None else None
+
+        return duration
+
+    def _is_slow(self, phase, seconds):
+        stats = self.stats[phase]
+        if stats.count < self.min_samples:
+            return False
+        return seconds > stats.p99
+
+    def elapsed(self, now=None):
+        """Seconds spent in the current phase, 0 when not moving"""
+        if self.phase is None:
+            return 0.0
+        now = clock.monotonic() if now is None else now
+        return now - self.started
+
+    def expected(self, phase=None):
+        """Median duration of phase (default current), None if unknown"""
+        phase = self.phase if phase is None else phase
+        if phase is None:
+            return None
+        return self.stats[phase].median
+
+    def eta(self, now=None):
+        """Seconds until the current sequence completes, None if unknown
+
+        Remaining time of the running phase (never negative) plus the median
+        of every phase still to come.
+        """
+        if self.phase is None:
+            return 0.0
+
+        phases = self.sequence_of(self.phase)
+        remaining = 0.0
+        for phase in phases[phases.index(self.phase):]:
+            expected = self.stats[phase].median
+            if expected is None:
+                return None
+            if phase == self.phase:
+                expected = max(expected - self.elapsed(now), 0.0)
+            remaining += expected
+
+        return remaining
+
+    def slow(self, now=None):
+        """True if the running phase has already exceeded its p99"""
+        if self.phase is None:
+            return False
+        return self._is_slow(self.phase, self.elapsed(now))
+
+
+def phase_timing_properties(device, group, phases):
+    """Builds the phase_timing NP and phase_alerts LP
+
+    Parameters
+    ----------
+    device : str
+        Device name to attach to
+    group : str
+        Group to attach to
+    phases : dict
+        Light name to label of every timed phase
+    """
+    numbers = [
+        INumber('eta', '%.1f', 0, 10000, 0, 0, 'ETA (s)'),
+        INumber('elapsed', '%.1f', 0, 10000, 0, 0, 'Phase Elapsed (s)'),
+        INumber('expected', '%.1f', 0, 10000, 0, 0, 'Phase Expected (s)'),
+        INumber('p99', '%.1f', 0, 10000, 0, 0, 'Phase P99 (s)'),
+    ]
+    nvp = INumberVector(
+        numbers, device, 'phase_timing', IPState.IDLE, IPerm.RO, 0, None,
+        'Phase Timing', group
+    )
+    lights = [
+        ILight(name, IPState.IDLE, label) for name, label in phases.items()
+    ]
+    lvp = ILightVector(
+        lights, device, 'phase_alerts', IPState.IDLE, 0, None,
+        'Slow Phase', group
+    )
+
+    return nvp, lvp
+
+
+def update_phase_properties(timer, nvp, lvp, now=None):
+    """Copies the timer state into the phase_timing and phase_alerts vps"""
+    eta = timer.eta(now)
+    expected = timer.expected()
+    p99 = timer.stats[timer.phase].p99 if timer.phase else None
+    nvp['eta'].value = eta if eta is not None else 0
+    nvp['elapsed'].value = timer.elapsed(now)
+    nvp['expected'].value = expected if expected is not None else 0
+    nvp['p99'].value = p99 if p99 is not None else 0
+
+    slow = timer.slow(now)
+    if timer.phase is None:
+        nvp.state = IPState.IDLE
+    elif slow:
+        nvp.state = IPState.ALERT
+    else:
+        nvp.state = IPState.BUSY
+
+    for light in lvp:
+        if timer.stats[light.name].count < timer.min_samples:
+            light.value = IPState.IDLE
+        elif light.name in timer.slow_phases or (
+            slow and light.name == timer.phase
+        ):
+            light.value = IPState.ALERT
+        else:
+            light.value = IPState.OK
+    if any(light.value == IPState.ALERT for light in lvp):
+        lvp.state = IPState.ALERT
+    else:
+        lvp.state = IPState.OK
+
+    return slow
@@ -0,0 +1,166 @@
+"""profiling.py
+
+On demand CPU profiling of a running driver.
+
+A driver started by indiserver cannot easily have a profiler attached, so
+every device gets an Engineering switch that runs cProfile for a bounded
+window. When the window ends (or Stop is pressed) the stats are written to
+the state directory and the hottest functions, by time spent in the function
+itself, are published in a read only text vector. Nothing is installed while
+the profiler is off, so it costs nothing until someone presses Start.
+
+Properties
+----------
+SP : profiling
+     Start, Stop
+     BUSY while profiling, OK once a profile was written
+TP : profile
+     File, Hot 1 .. Hot N
+"""
+import asyncio
+import cProfile
+import io
+import pstats
+import time
+
+from pyindi.device import (
+    IPerm, IPState, ISRule, ISState, ISwitch, ISwitchVector, IText,
+    ITextVector
+)
+
+from indidrivers.paths import state_file
+
+
+class ProfilerControl():
+    """Start/stop switch and results for one device
+
+    Parameters
+    ----------
+    device : str
+        Device name, also used in the file name
+    window : float
+        Seconds a profile runs unless stopped earlier
+    top : int
+        Number of hot functions published
+    log : indidrivers.log.DriverLog or None
+        Where to report starting and writing a profile
+    """
+    def __init__(self, device, window=30.0, top=5, log=None):
+        self.device = device
+        self.window = window
+        self.top = top
+        self.log = log
+        self.profile = None
+        self.path = None
+        self._timer = None
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def properties(self, group):
+        """Builds the profiling switch and profile text vectors"""
+        switches = [
+            ISwitch('start', ISState.OFF, f'Start ({self.window:.0f}s)'),
+            ISwitch('stop', ISState.OFF, 'Stop')
+        ]
+        svp = ISwitchVector(
+            switches, self.device, 'profiling', IPState.IDLE, ISRule.ATMOST1,
+            IPerm.RW, 0, 'Profiling', group
+        )
+        texts = [IText('file', '', 'File')] + [
+            IText(f'hot_{i}', '', f'Hot {i}') for i in range(1, self.top + 1)
+        ]
+        tvp = ITextVector(
+            texts, self.device, 'profile', IPState.IDLE, IPerm.RO, 0, None,
+            'Profile', group
+        )
+
+        return svp, tvp
+
+    def handle_switch(self, driver, device, name, values, names):
+        """Handles the profiling switch, returns False for other switches"""
+        if name != 'profiling':
+            return False
+
+        svp = driver.IUUpdate(device, name, values, names)
+        if svp['start'].value == 'On':
+            self.start(driver)
+        else:
+            self.stop(driver)
+
+        return True
+
+    def start(self, driver):
+        if self.running:
+            return
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        self._timer = asyncio.get_event_loop().call_later(
+            self.window, self.stop, driver
+        )
+        self._set_switch(driver, IPState.BUSY, 'On')
+        if self.log is not None:
+            self.log.info('Profiling for %.0fs', self.window)
+
+    def stop(self, driver):
+        """Stops profiling, writes the stats and publishes the hot list"""
+        if not self.running:
+            self._set_switch(driver, IPState.IDLE, 'Off')
+            return
+        self.profile.disable()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        slug = self.device.lower().replace(' ', '_')
+        stamp = time.strftime('%Y%m%dT%H%M%S')
+        self.path = state_file(f'{slug}_{stamp}.prof')
+        self.profile.dump_stats(str(self.path))
+        hot = hot_functions(self.profile, self.top)
+        self.profile = None
+
+        try:
+            tvp = driver.IUFind('profile')
+        except ValueError:
+            tvp = None
+        if tvp is not None:
+            tvp['file'].value = str(self.path)
+            for i in range(1, self.top + 1):
+                tvp[f'hot_{i}'].value = hot[i - 1] if i <= len(hot) else ''
+            tvp.state = IPState.OK
+            driver.IDSet(tvp)
+        self._set_switch(driver, IPState.OK, 'Off')
+        if self.log is not None:
+            self.log.info('Profile written to %s', self.path)
+
+    def _set_switch(self, driver, state, start):
+        try:
+            svp = driver.IUFind('profiling')
+        except ValueError:
+            return
+        svp['start'].value = start
+        svp['stop'].value = 'Off'
+        svp.state = state
+        driver.IDSet(svp)
+
+
+def hot_functions(profile, top):
+    """Returns 'tottime ms  calls  file:line(function)' for the top functions"""
+    stats = pstats.Stats(profile, stream=io.StringIO())
+    rows = sorted(
+        stats.stats.items(), key=lambda item: item[1][2], reverse=True
+    )
+    hot = []
+    for (filename, line, function), (_, calls, tottime, _, _) in rows:
+        if len(hot) == top:
+            break
+        if filename == '~' and "of 'select." in function:
+            continue # Event loop waiting for something to do, not work
+        filename = filename.rsplit('/', 1)[-1]
+        hot.append(
+            f'{tottime * 1000:.1f} ms  {calls} calls  '
+            f'{filename}:{line}({function})'
+        )
+
+    return hot
@@ -0,0 +1,109 @@
+"""publish.py
+
+Deadband and rate limited publishing for noisy vectors.
+
+The weather readings jitter in their last digit every poll. A
+DeadbandPublisher sits in front of IDSet and only lets a vector through when
+
+    - its state changed (always, a state change is never held back)
+    - an element moved more than its deadband away from the value that was
+      last *published* (so slow drifts still get out eventually)
+    - a non numeric element changed at all
+    - max_interval seconds passed since the last publish (heartbeat)
+
+and never more often than every min_interval seconds, except for state
+changes. Element values may be numbers or numeric text.
+"""
+from indidrivers import clock
+
+
+def as_float(value):
+    """Returns value as a float or None if it is not numeric"""
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class DeadbandPublisher():
+    """Decides when a vector is worth sending, see module docstring
+
+    Parameters
+    ----------
+    deadbands : dict
+        Element name to deadband, elements not listed use default_deadband
+    min_interval : float
+        Seconds that must pass between two publishes of a vector
+    max_interval : float
+        Seconds after which a vector is published even if unchanged
+    default_deadband : float
+        Deadband of numeric elements that are not in deadbands
+    """
+    def __init__(self, deadbands=None, min_interval=0.0, max_interval=30.0,
+                 default_deadband=0.0):
+        self.deadbands = dict(deadbands or {})
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_deadband = default_deadband
+        self._last = {} # vp name -> (time, state, {element: value})
+        self.sent = 0
+        self.suppressed = 0
+
+    def should_publish(self, vp, now=None):
+        """True if vp should be sent now"""
+        now = clock.monotonic() if now is None else now
+        last = self._last.get(vp.name)
+        if last is None:
+            return True
+
+        last_time, last_state, last_values = last
+        if vp.state != last_state:
+            return True
+        if now - last_time < self.min_interval:
+            return False
+        if now - last_time >= self.max_interval:
+            return True
+
+        for element in vp:
+            previous = last_values.get(element.name)
+            if element.value == previous:
+                continue
+            new, old = as_float(element.value), as_float(previous)
+            if new is None or old is None:
+                return True
+            deadband = self.deadbands.get(element.name, self.default_deadband)
+            if abs(new - old) > deadband:
+                return True
+
+        return False
+
+    def published(self, vp, now=None):
+        """Records that vp was just sent"""
+        now = clock.monotonic() if now is None else now
+        self._last[vp.name] = (
+            now, vp.state, {element.name: element.value for element in vp}
+        )
+
+    def publish(self, driver, vp, now=None):
+        """Sends vp with driver.IDSet if needed, returns True if it was sent"""
+        if not self.should_publish(vp, now):
+            self.suppressed += 1
+            return False
+
+        driver.IDSet(vp)
+        self.published(vp, now)
+        self.sent += 1
+
+        return True
+
+    def forget(self, name=None):
+        """Forgets what was published (all vectors if name is None)
+
+        Use when clients need everything again, e.g. after getProperties.
+        """
+        if name is None:
+            self._last.clear()
+        else:
+            self._last.pop(name, None)
@@ -0,0 +1,171 @@
+"""push.py
+
+Change events from the telemetry server instead of polling.
+
+A poll finds a change up to a whole period after it happened and asks the
+controller again and again while nothing moves. With a telemetry://
+backend a driver can instead subscribe (see indidrivers.telemetry): the
+server samples the subsystem next to the controller every sample seconds
+and sends only the fields that changed, so a change reaches the driver
+within about sample plus one network trip and an idle subsystem costs one
+empty keepalive line every keepalive seconds.
+
+    push = Push({'upperdome': ('upperdome', 'request_all')},
+                telescope='Kuiper', log=log, **config['push'])
+
+    def ISGetProperties(self, device=None):
+        push.ensure_started(self.pushed)
+
+    @device.repeat(clock.period_ms(1000))
+    def update(self):
+        if push.active():
+            return
+        watchdog.start('poll', self.poll)
+
+The handler gets (channel, data, received) for every event, data is the
+whole merged result or an Exception if the call failed on the server, and
+may be a coroutine function. Events that arrive while the handler is still
+busy with the last one are coalesced, it only ever gets the latest data.
+
+Push is active while subscribed and something (an event or a keepalive)
+arrived within misses keepalives. Otherwise the driver polls as before
+and the subscription is retried every retry seconds: a server without
+subscriptions, a dropped connection and one that went quiet all end up
+polling. Other backends (mtnpy, sim) never push.
+
+Times are real (time.monotonic), like the watchdog's.
+"""
+import asyncio
+import functools
+import time
+
+from indidrivers import clock
+from indidrivers.backend import backend_for, invoke, telemetry_address
+
+
+class Push():
+    """Subscriptions of one driver, see module docstring
+
+    Parameters
+    ----------
+    channels : dict
+        Channel name to (subsystem, method) to subscribe to
+    enabled : bool
+        False to always poll
+    sample : float or dict
+        Seconds between the server's samples, or channel name to seconds
+    keepalive : float
+        Seconds of no change after which the server sends an empty event
+    misses : int
+        Keepalives that may go missing before falling back to polling
+    retry : float
+        Seconds between attempts to subscribe while polling
+    backend : str or None
+        None reads the backend of telescope, only telemetry:// pushes
+    telescope : str or None
+        Telescope the channels are on (see indidrivers.backend.backend_for),
+        None for INDIDRIVERS_BACKEND
+    log : indidrivers.log.DriverLog or None
+        Where to report switching between push and polling
+    """
+    def __init__(self, channels, enabled=True, sample=0.05, keepalive=2.0,
+                 misses=3, retry=30.0, backend=None, telescope=None,
+                 log=None):
+        self.channels = dict(channels)
+        self.enabled = enabled
+        self.sample = sample
+        self.keepalive = keepalive
+        self.misses = misses
+        self.retry = retry
+        if backend is None and telescope is not None:
+            backend = backend_for(telescope)
+        self.address = telemetry_address(backend)
+        self.log = log
+        self.handler = None
+        self.client = None
+        self.subscribed = False
+        self.task = None
+        self.latest = {}
+        self.dispatching = set()
+
+    def configure(self, enabled=True, sample=0.05, keepalive=2.0, misses=3,
+                  retry=30.0):
+        """Applies a reloaded push config, subscribes again if running"""
+        self.enabled = enabled
+        self.sample = sample
+        self.keepalive = keepalive
+        self.misses = misses
+        self.retry = retry
+        self.stop()
+        if self.handler is not None:
+            self.ensure_started(self.handler)
+
+    def ensure_started(self, handler):
+        """Starts subscribing with handler, once the loop is running"""
+        self.handler = handler
+        if self.task is not None or not self.enabled or self.address is None:
+            return
+        self.task = asyncio.ensure_future(self.run())
+
+    def active(self):
+        """True while events arrive, polls are not needed"""
+        if not self.subscribed or not self.client.connected:
+            return False
+        quiet = time.monotonic() - self.client.last_message
+        return quiet < self.keepalive * self.misses
+
+    async def run(self):
+        """Subscribes, watches the subscription, retries after it dropped"""
+        from indidrivers.telemetry import AsyncTelemetryClient
+        while True:
+            self.client = AsyncTelemetryClient(*self.address)
+            try:
+                for channel, (subsystem, method) in self.channels.items():
+                    sample = self.sample
+                    if isinstance(sample, dict):
+                        sample = sample[channel]
+                    _, data = await self.client.subscribe(
+                        subsystem, method, (),
+                        functools.partial(self.received, channel), sample,
+                        self.keepalive
+                    )
+                    self.received(channel, data)
+                self.subscribed = True
+                if self.log is not None:
+                    self.log.info('Receiving change events, polling paused')
+                while self.active():
+                    await asyncio.sleep(self.keepalive)
+                if self.log is not None:
+                    self.log.warning('Change events stopped, polling')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.log is not None:
+                    self.log.debug('Cannot subscribe, polling: %s', e)
+            finally:
+                self.subscribed = False
+                self.client.close()
+            await asyncio.sleep(self.retry)
+
+    def received(self, channel, data):
+        """Client callback, hands the latest data to the handler"""
+        self.latest[channel] = (data, clock.time())
+        if channel not in self.dispatching:
+            self.dispatching.add(channel)
+            asyncio.ensure_future(self.dispatch(channel))
+
+    async def dispatch(self, channel):
+        try:
+            while channel in self.latest:
+                data, received = self.latest.pop(channel)
+                await invoke(self.handler, channel, data, received)
+        except Exception as e:
+            if self.log is not None:
+                self.log.error('Handling %s event failed: %s', channel, e)
+        finally:
+            self.dispatching.discard(channel)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
@@ -0,0 +1,228 @@
+"""reload.py
+
+Configuration reload without restarting the driver.
+
+Restarting a driver to change a deadband or a poll period drops every
+client's state, reconnects to the controller and re-sends every definition.
+A ConfigReloader instead watches the driver's JSON file (mtime checked
+every few seconds) and has a Reload switch for when the file lives
+somewhere the watcher cannot see. Either way it loads the file and hands
+the new config to the driver's apply function, which changes schedules,
+thresholds and mappings in place and re-defines only vectors whose
+structure changed.
+
+An apply function checks the whole config with check_config before it
+changes anything, so a rejected config leaves the driver running the old
+one, as the reloader then reports:
+
+    check_config(new, configures=[('output', output.configure)],
+                 numbers=['stale_after'], choices={'log.level': LEVELS})
+
+Each reload is timed (load + apply, wall clock) and published with what
+changed, so the cost of a reload is visible next to the one of a restart.
+
+Properties
+----------
+SP : reload
+     Reload
+NP : reload_stats
+     Reloads, Last (ms), Max (ms)
+TP : reload_changes
+     Changed, the config keys that changed in the last reload
+"""
+import inspect
+import time
+
+from pyindi.device import (
+    INumber, INumberVector, IPerm, IPState, ISRule, ISState, ISwitch,
+    ISwitchVector, IText, ITextVector
+)
+
+
+def changed_keys(old, new, prefix=''):
+    """Dotted keys whose value differs between two config dicts"""
+    keys = []
+    for key in sorted(set(old) | set(new), key=str):
+        a, b = old.get(key), new.get(key)
+        if a == b:
+            continue
+        if isinstance(a, dict) and isinstance(b, dict):
+            keys += changed_keys(a, b, f'{prefix}{key}.')
+        else:
+            keys.append(f'{prefix}{key}')
+
+    return keys
+
+
+def lookup(config, key):
+    """Value of the dotted key in config, raises ValueError if missing"""
+    value = config
+    for part in key.split('.'):
+        try:
+            value = value[part]
+        except (KeyError, TypeError):
+            raise ValueError(f'missing {key}')
+    return value
+
+
+def numeric(value):
+    """True for a number, or a dict or list of numbers at any depth"""
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, float)):
+        return True
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, list):
+        return all(numeric(v) for v in value)
+    return False
+
+
+def check_config(new, configures=(), numbers=(), choices=None):
+    """Raises ValueError if new cannot be applied
+
+    Parameters
+    ----------
+    new : dict
+        Config to check
+    configures : list of (str, callable)
+        Dotted key of a section and the configure method it is passed to as
+        keyword arguments, which must take all of them
+    numbers : list of str
+        Dotted keys whose values must be numbers, or dicts or lists of them
+    choices : dict or None
+        Dotted key to the values it may take
+    """
+    for key, allowed in (choices or {}).items():
+        value = lookup(new, key)
+        if value not in allowed:
+            raise ValueError(
+                f"{key} is {value!r}, one of {', '.join(map(str, allowed))}"
+            )
+    for key, configure in configures:
+        try:
+            inspect.signature(configure).bind(**lookup(new, key))
+        except TypeError as e:
+            raise ValueError(f'{key}: {e}')
+    for key in numbers:
+        if not numeric(lookup(new, key)):
+            raise ValueError(f'{key} is not a number')
+
+
+def mtime(path):
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+class ConfigReloader():
+    """Watches and reloads a config, see module docstring
+
+    Parameters
+    ----------
+    device : str
+        Device name to attach to
+    path : pathlib.Path
+        Config file to watch
+    load : callable
+        Returns the new config
+    apply : callable
+        apply(driver, new) applies it, returns a list of notes (e.g. keys
+        that need a restart), may raise to reject the config
+    current : dict
+        Config the driver is running with
+    log : indidrivers.log.DriverLog
+        Where to report reloads
+    """
+    def __init__(self, device, path, load, apply, current, log):
+        self.device = device
+        self.log = log
+        self.path = path
+        self.load = load
+        self.apply = apply
+        self.current = current
+        self.mtime = mtime(path)
+        self.count = 0
+        self.last_ms = 0.0
+        self.max_ms = 0.0
+
+    def properties(self, group):
+        """Builds the reload switch, reload_stats and reload_changes"""
+        svp = ISwitchVector(
+            [ISwitch('reload', ISState.OFF, 'Reload')], self.device, 'reload',
+            IPState.IDLE, ISRule.ATMOST1, IPerm.RW, 0, 'Config', group
+        )
+        nvp = INumberVector(
+            [
+                INumber('count', '%.0f', 0, 1e9, 0, 0, 'Reloads'),
+                INumber('last_ms', '%.2f', 0, 1e6, 0, 0, 'Last (ms)'),
+                INumber('max_ms', '%.2f', 0, 1e6, 0, 0, 'Max (ms)'),
+            ],
+            self.device, 'reload_stats', IPState.IDLE, IPerm.RO, 0, None,
+            'Reload Cost', group
+        )
+        tvp = ITextVector(
+            [IText('changed', '', 'Changed')], self.device, 'reload_changes',
+            IPState.IDLE, IPerm.RO, 0, None, 'Reload Changes', group
+        )
+
+        return svp, nvp, tvp
+
+    def handle_switch(self, driver, device, name, values, names):
+        """Handles the reload switch, returns False for other switches"""
+        if name != 'reload':
+            return False
+
+        svp = driver.IUUpdate(device, name, values, names)
+        if svp['reload'].value == 'On':
+            ok = self.reload(driver)
+            svp.state = IPState.OK if ok else IPState.ALERT
+            svp['reload'].value = 'Off'
+        driver.IDSet(svp)
+
+        return True
+
+    def check(self, driver):
+        """Reloads if the file changed since the last look"""
+        current = mtime(self.path)
+        if current == self.mtime:
+            return False
+        self.mtime = current
+        return self.reload(driver)
+
+    def reload(self, driver):
+        """Loads and applies the config, returns True if it was applied"""
+        start = time.perf_counter()
+        try:
+            new = self.load()
+            changes = changed_keys(self.current, new)
+            notes = self.apply(driver, new) if changes else []
+        except Exception as e:
+            self.log.error('Config rejected, keeping the old one: %s', e)
+            return False
+        elapsed = (time.perf_counter() - start) * 1000
+        self.current = new
+        self.count += 1
+        self.last_ms = elapsed
+        self.max_ms = max(self.max_ms, elapsed)
+        self.log.info(
+            'Config reloaded in %.2f ms: %s', elapsed,
+            ', '.join(changes + list(notes)) or 'nothing changed'
+        )
+
+        try:
+            nvp = driver.IUFind('reload_stats')
+            tvp = driver.IUFind('reload_changes')
+        except ValueError:
+            return True
+        nvp['count'].value = self.count
+        nvp['last_ms'].value = self.last_ms
+        nvp['max_ms'].value = self.max_ms
+        nvp.state = IPState.OK
+        tvp['changed'].value = ', '.join(changes + list(notes)) or 'Nothing'
+        tvp.state = IPState.OK
+        driver.IDSet(nvp)
+        driver.IDSet(tvp)
+
+        return True
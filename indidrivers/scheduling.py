@@ -0,0 +1,124 @@
+"""scheduling.py
+
+Poll periods that adapt to how fast a sensor channel is changing.
+
+A driver polls on a short fixed tick (@device.repeat(tick)) and asks each
+channel's AdaptivePoller whether it is due. After every successful read the
+poller looks at the new sample and moves its period between min_period and
+max_period:
+
+    activity = largest |change| / scale over the numeric fields
+               1 if a discrete field (e.g. rain_condition) changed
+               1 if a field holds an urgent value or is within margin of a
+                 numeric threshold
+    level    = exponentially weighted average of activity (capped at 1)
+    period   = max_period - (max_period - min_period) * level
+
+so a channel that is flat slows down to max_period while one that moves, or
+sits near an alert threshold, is polled at min_period. A channel something
+safety critical depends on can be held at min_period with fast.
+"""
+from indidrivers import clock
+
+from indidrivers.publish import as_float
+
+
+class AdaptivePoller():
+    """Adaptive poll period for one sensor channel
+
+    Parameters
+    ----------
+    min_period, max_period : float
+        Bounds of the period in seconds
+    scales : dict
+        Numeric field to the change between two polls that counts as moving
+    discrete : list
+        Fields where any change counts as moving
+    urgent : dict
+        Field to values that mean we are near an alert (poll fast)
+    thresholds : dict
+        Numeric field to [threshold, margin], poll fast inside the margin
+    smoothing : float
+        Weight of the newest activity in the running average (0-1)
+    """
+    def __init__(self, min_period, max_period, scales=None, discrete=None,
+                 urgent=None, thresholds=None, smoothing=0.3):
+        self.min_period = min_period
+        self.max_period = max_period
+        self.scales = dict(scales or {})
+        self.discrete = list(discrete or [])
+        self.urgent = {k: set(v) for k, v in (urgent or {}).items()}
+        self.thresholds = dict(thresholds or {})
+        self.smoothing = smoothing
+        self.level = 1.0 # Start fast until we know the channel
+        self.period = min_period
+        self.next_due = 0.0
+        self.fast = False
+        self._last = None
+
+    def reconfigure(self, min_period, max_period, scales=None, discrete=None,
+                    urgent=None, thresholds=None, smoothing=0.3):
+        """Changes the settings in place, keeping what was learned so far"""
+        self.min_period = min_period
+        self.max_period = max_period
+        self.scales = dict(scales or {})
+        self.discrete = list(discrete or [])
+        self.urgent = {k: set(v) for k, v in (urgent or {}).items()}
+        self.thresholds = dict(thresholds or {})
+        self.smoothing = smoothing
+        self.period = min(max(self.period, min_period), max_period)
+
+        return
+
+    def due(self, now=None):
+        """True if the channel should be polled now"""
+        now = clock.monotonic() if now is None else now
+        return now >= self.next_due
+
+    def activity(self, data):
+        """Returns how active the channel is in data, 0 (flat) to 1"""
+        activity = 0.0
+        for field, values in self.urgent.items():
+            if data.get(field) in values:
+                return 1.0
+        for field, (threshold, margin) in self.thresholds.items():
+            value = as_float(data.get(field))
+            if value is not None and abs(value - threshold) <= margin:
+                return 1.0
+
+        if self._last is None:
+            return 1.0
+        for field in self.discrete:
+            if data.get(field) != self._last.get(field):
+                return 1.0
+        for field, scale in self.scales.items():
+            new = as_float(data.get(field))
+            old = as_float(self._last.get(field))
+            if new is None or old is None or scale <= 0:
+                continue
+            activity = max(activity, abs(new - old) / scale)
+
+        return min(activity, 1.0)
+
+    def sample(self, data, now=None):
+        """Feed a successful read, returns the new period"""
+        now = clock.monotonic() if now is None else now
+        activity = self.activity(data)
+        self.level += self.smoothing * (activity - self.level)
+        if activity >= 1.0:
+            # React at once, only slowing down is smoothed
+            self.level = 1.0
+        self._last = dict(data)
+        self.period = (
+            self.max_period - (self.max_period - self.min_period) * self.level
+        )
+        if self.fast:
+            self.period = self.min_period
+        self.next_due = now + self.period
+
+        return self.period
+
+    def failed(self, now=None):
+        """Feed a failed read, try again after the current period"""
+        now = clock.monotonic() if now is None else now
+        self.next_due = now + self.period
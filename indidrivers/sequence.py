@@ -0,0 +1,466 @@
+"""sequence.py
+
+Flatfield calibration sequences run by the driver.
+
+Taking 90Prime flats meant a script switching halogen_power and uband_power
+through the commands vector and guessing from the 500 ms polls when a lamp
+was really on, padding every step with idle margin. A LampSequencer takes a
+whole block at once, written to the sequence text vector
+
+    halogen 30 5; uband 60 10
+
+one step per lamp with its on and settle seconds, and runs it when Start is
+pressed. Each step goes through the phases
+
+    switch on   command the lamp on, then request the lamp status every
+                confirm_interval until it shows on
+    settle      settle seconds of warm-up, counted from the answer that
+                showed the lamp on, so never short
+    on          on seconds, the window for the flats
+    switch off  command the lamp off and confirm it the same way, unless
+                the next step uses the same lamp, which then stays on
+
+Waits are deadlines in driver time (indidrivers.clock), not poll ticks, so
+a step takes what was planned plus its two confirmations. sequence_status
+shows the step and phase (flats are taken while the phase is on) and, per
+finished step, the actual against the planned times. sequence_timing has
+the totals.
+
+Abort, a failed command or a lamp not confirmed within confirm_timeout ends
+the sequence, every lamp it switched on is switched off again.
+
+Outside a sequence switch_lamps commands the lamps from the commands
+switch, with the values it had when clicked: a poll that publishes the
+lamps while a command is on its way changes the switch, not the commands.
+
+Properties
+----------
+TP : sequence
+     Steps, 'lamp on settle' separated by ';' (read write)
+SP : sequence_control
+     Start, Abort. BUSY while running, OK when done, ALERT when aborted or
+     failed
+TP : sequence_status
+     Step, Phase, Step 1 .. Step MAX_STEPS
+NP : sequence_timing
+     Planned, Elapsed, Remaining (s)
+"""
+import asyncio
+import collections
+
+from pyindi.device import (
+    INumber, INumberVector, IPerm, IPState, ISRule, ISState, ISwitch,
+    ISwitchVector, IText, ITextVector
+)
+
+from indidrivers import clock
+from indidrivers.backend import invoke
+
+# Lamp to (command method, status field) of the flatfield subsystem
+LAMPS = {
+    'halogen': ('command_halogen', 'halogen_lamps'),
+    'uband': ('command_uband', 'uband_lamps'),
+}
+MAX_STEPS = 10
+
+Step = collections.namedtuple('Step', 'lamp on settle')
+
+
+def parse_steps(text):
+    """Steps of 'halogen 30 5; uband 60 10', raises ValueError"""
+    steps = []
+    for part in text.replace('\n', ';').split(';'):
+        words = part.split()
+        if not words:
+            continue
+        if len(words) != 3:
+            raise ValueError(f"'{part.strip()}' is not 'lamp on settle'")
+        lamp = words[0].lower()
+        if lamp not in LAMPS:
+            raise ValueError(
+                f"Unknown lamp {words[0]}, one of {', '.join(LAMPS)}"
+            )
+        on, settle = float(words[1]), float(words[2])
+        if on < 0 or settle < 0:
+            raise ValueError(f"'{part.strip()}' has a negative time")
+        steps.append(Step(lamp, on, settle))
+    if not steps:
+        raise ValueError('No steps')
+    if len(steps) > MAX_STEPS:
+        raise ValueError(f'{len(steps)} steps, at most {MAX_STEPS}')
+    return steps
+
+
+def planned(steps):
+    """Seconds of settle and on in steps"""
+    return sum(step.settle + step.on for step in steps)
+
+
+class SequenceFailed(Exception):
+    """A lamp command failed or was not confirmed"""
+
+
+async def switch_lamps(subsystem, lamps, call=invoke, trace=None, log=None):
+    """Commands every lamp in lamps on or off, lamps switched on first
+
+    Parameters
+    ----------
+    subsystem : callable
+        Returns the flatfield subsystem
+    lamps : dict
+        Lamp (a key of LAMPS) to True for on, False for off, as clicked
+    call : coroutine function
+        Makes the hardware calls, the driver's Watchdog.call
+    trace : indidrivers.tracing.Trace or None
+        Gets a step for every command
+    log : indidrivers.log.DriverLog or None
+        Where failed commands are reported
+
+    Returns
+    -------
+    bool
+        True if every command succeeded
+    """
+    ok = True
+    ons = [lamp for lamp in LAMPS if lamps.get(lamp) is True]
+    offs = [lamp for lamp in reversed(list(LAMPS)) if lamps.get(lamp) is False]
+    for lamp, on in [(lamp, True) for lamp in ons] + \
+            [(lamp, False) for lamp in offs]:
+        method, _ = LAMPS[lamp]
+        if trace is not None:
+            trace.step(method, on=on)
+        try:
+            if not await call(getattr(subsystem(), method), on):
+                raise SequenceFailed(f'{method}({on}) did not succeed')
+        except Exception as e:
+            ok = False
+            if log is not None:
+                log.error(
+                    'Could not turn %s %s: %s', 'on' if on else 'off', lamp, e
+                )
+
+    return ok
+
+
+class LampSequencer():
+    """Lamp sequences of one flatfield, see module docstring
+
+    Parameters
+    ----------
+    device : str
+        Device name to attach to
+    subsystem : callable
+        Returns the flatfield subsystem, called for every request since the
+        driver may replace its connection
+    on_data : callable or None
+        Called with every lamp status requested for a confirmation, so the
+        driver can publish it like a poll
+    confirm_interval : float
+        Seconds between lamp status requests while confirming
+    confirm_timeout : float
+        Seconds a lamp has to show the commanded state
+    log : indidrivers.log.DriverLog or None
+        Where progress and failures are reported
+    call : coroutine function
+        Makes the hardware calls, the driver's Watchdog.call so they share
+        its worker with the polls
+    """
+    def __init__(self, device, subsystem, on_data=None, confirm_interval=0.05,
+                 confirm_timeout=5.0, log=None, call=invoke):
+        self.device = device
+        self.subsystem = subsystem
+        self.call = call
+        self.on_data = on_data
+        self.confirm_interval = confirm_interval
+        self.confirm_timeout = confirm_timeout
+        self.log = log
+        self.steps = []
+        self.task = None
+        self.ending = False # Switching off after abort, not to be cancelled
+        self.lit = set() # Lamps the running sequence switched on
+        self.reports = []
+        self.step = ''
+        self.phase = 'idle'
+        self.planned = 0.0
+        self.started = None
+        self.finished = None
+        self.eta = None
+
+    def configure(self, confirm_interval=0.05, confirm_timeout=5.0):
+        """Applies a reloaded sequence config"""
+        self.confirm_interval = confirm_interval
+        self.confirm_timeout = confirm_timeout
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def properties(self, group):
+        """Builds the sequence TP, sequence_control SP, sequence_status TP
+        and sequence_timing NP"""
+        text = '; '.join(
+            f'{step.lamp} {step.on:g} {step.settle:g}' for step in self.steps
+        )
+        sequence_tvp = ITextVector(
+            [IText('steps', text, 'Steps (lamp on settle; ...)')],
+            self.device, 'sequence', IPState.IDLE, IPerm.RW, 0, None,
+            'Sequence', group
+        )
+        control_svp = ISwitchVector(
+            [
+                ISwitch('start', ISState.OFF, 'Start'),
+                ISwitch('abort', ISState.OFF, 'Abort'),
+            ],
+            self.device, 'sequence_control', IPState.IDLE, ISRule.ATMOST1,
+            IPerm.RW, 0, 'Run Sequence', group
+        )
+        texts = [
+            IText('step', self.step, 'Step'),
+            IText('phase', self.phase, 'Phase'),
+        ] + [
+            IText(
+                f'step_{i + 1}',
+                self.reports[i] if i < len(self.reports) else '',
+                f'Step {i + 1}'
+            )
+            for i in range(MAX_STEPS)
+        ]
+        status_tvp = ITextVector(
+            texts, self.device, 'sequence_status', IPState.IDLE, IPerm.RO, 0,
+            None, 'Sequence Status', group
+        )
+        timing_nvp = INumberVector(
+            [
+                INumber(name, '%.2f', 0, 1e6, 0, 0, label)
+                for name, label in (
+                    ('planned', 'Planned (s)'), ('elapsed', 'Elapsed (s)'),
+                    ('remaining', 'Remaining (s)'),
+                )
+            ],
+            self.device, 'sequence_timing', IPState.IDLE, IPerm.RO, 0, None,
+            'Sequence Timing', group
+        )
+
+        return sequence_tvp, control_svp, status_tvp, timing_nvp
+
+    def handle_text(self, driver, device, name, values, names):
+        """Takes a new sequence, returns False for other text vectors"""
+        if name != 'sequence':
+            return False
+
+        tvp = driver.IUUpdate(device, name, values, names)
+        try:
+            steps = parse_steps(tvp['steps'].value)
+        except ValueError as e:
+            tvp.state = IPState.ALERT
+            self.report('error', 'Sequence not accepted: %s', e)
+        else:
+            self.steps = steps
+            tvp.state = IPState.OK
+            self.report(
+                'info', 'Sequence of %d steps, %.1f s planned', len(steps),
+                planned(steps)
+            )
+        driver.IDSet(tvp)
+
+        return True
+
+    def handle_switch(self, driver, device, name, values, names):
+        """Starts or aborts a sequence, returns False for other switches"""
+        if name != 'sequence_control':
+            return False
+
+        pressed = {n for n, v in zip(names, values) if v == 'On'}
+        if 'abort' in pressed:
+            if self.running and not self.ending:
+                self.task.cancel()
+        elif 'start' in pressed:
+            if self.running:
+                self.report('warning', 'A sequence is already running')
+            elif not self.steps:
+                self.report('error', 'No sequence to run, set one first')
+            else:
+                self.task = asyncio.ensure_future(
+                    self.run(driver, list(self.steps))
+                )
+                return True
+        self.set_control(driver, start=self.running)
+
+        return True
+
+    async def run(self, driver, steps):
+        """Runs steps, see module docstring"""
+        self.reports = []
+        self.lit = set()
+        self.planned = planned(steps)
+        self.started = clock.monotonic()
+        self.finished = None
+        self.eta = self.started + self.planned
+        self.ending = False
+        self.set_control(driver, IPState.BUSY, start=True)
+        result = 'done'
+        try:
+            for i, step in enumerate(steps):
+                following = steps[i + 1:]
+                await self.run_step(driver, i, len(steps), step, following)
+        except asyncio.CancelledError:
+            result = 'aborted'
+        except Exception as e:
+            result = 'failed'
+            self.report('error', 'Sequence failed: %s', e)
+        if result != 'done':
+            self.ending = True
+            await self.switch_off(driver)
+
+        self.finished = clock.monotonic()
+        elapsed = self.finished - self.started
+        self.set_phase(driver, result)
+        self.update(driver)
+        self.set_control(
+            driver, IPState.OK if result == 'done' else IPState.ALERT
+        )
+        self.ending = False
+        self.report(
+            'info' if result == 'done' else 'warning',
+            'Sequence %s in %.2f s, %.2f s planned', result, elapsed,
+            self.planned
+        )
+
+    async def run_step(self, driver, index, count, step, following):
+        """Runs one step, adds its report"""
+        self.step = f'{index + 1}/{count} {step.lamp}'
+        rest = planned(following)
+        started = clock.monotonic()
+        if step.lamp in self.lit:
+            lit = started
+            switched_on = 'was on'
+        else:
+            self.eta = started + step.settle + step.on + rest
+            self.set_phase(driver, 'switch on')
+            lit = await self.switch(step.lamp, True)
+            switched_on = f'on after {(lit - started) * 1000:.0f} ms'
+
+        self.eta = lit + step.settle + step.on + rest
+        self.set_phase(driver, 'settle')
+        await clock.sleep_until(lit + step.settle)
+        settled = clock.monotonic()
+
+        self.eta = settled + step.on + rest
+        self.set_phase(driver, 'on')
+        await clock.sleep_until(settled + step.on)
+        ended = clock.monotonic()
+
+        if following and following[0].lamp == step.lamp:
+            switched_off = 'stays on'
+        else:
+            self.set_phase(driver, 'switch off')
+            off = await self.switch(step.lamp, False)
+            switched_off = f'off after {(off - ended) * 1000:.0f} ms'
+        total = clock.monotonic() - started
+
+        self.reports.append(
+            f'{step.lamp} {total:.2f}/{step.settle + step.on:.2f} s: '
+            f'{switched_on}, settle {settled - lit:.2f}/{step.settle:.2f} s, '
+            f'on {ended - settled:.2f}/{step.on:.2f} s, {switched_off}'
+        )
+
+    async def switch(self, lamp, on):
+        """Commands lamp and waits until its status shows it
+
+        Returns the driver time of the answer that showed it.
+        """
+        method, field = LAMPS[lamp]
+        # Switched off again on abort even if never confirmed, or if the
+        # abort came while the command was on its way
+        if on:
+            self.lit.add(lamp)
+        sent = clock.monotonic()
+        try:
+            ok = await self.call(getattr(self.subsystem(), method), on)
+        except Exception as e:
+            raise SequenceFailed(f'{method}({on}) failed: {e}')
+        if ok is False:
+            raise SequenceFailed(f'{method}({on}) returned False')
+        if not on:
+            self.lit.discard(lamp)
+
+        deadline = sent + self.confirm_timeout
+        while True:
+            data = await self.call(self.subsystem().request_all)
+            now = clock.monotonic()
+            if self.on_data is not None:
+                self.on_data(data)
+            if bool(data.get(field)) == on:
+                return now
+            if now >= deadline:
+                raise SequenceFailed(
+                    f"{lamp} not {'on' if on else 'off'} after "
+                    f'{self.confirm_timeout:g} s'
+                )
+            await clock.sleep_until(now + self.confirm_interval)
+
+    async def switch_off(self, driver):
+        """Switches off every lamp the sequence switched on"""
+        self.set_phase(driver, 'switch off')
+        for lamp in sorted(self.lit):
+            try:
+                await self.switch(lamp, False)
+            except Exception as e:
+                self.report('error', 'Could not switch off %s: %s', lamp, e)
+
+    def report(self, level, message, *args):
+        if self.log is not None:
+            getattr(self.log, level)(message, *args)
+
+    def set_phase(self, driver, phase):
+        """Publishes sequence_status with the current phase"""
+        self.phase = phase
+        try:
+            tvp = driver.IUFind('sequence_status')
+        except ValueError:
+            return
+        tvp['step'].value = self.step
+        tvp['phase'].value = phase
+        for i in range(MAX_STEPS):
+            tvp[f'step_{i + 1}'].value = \
+                self.reports[i] if i < len(self.reports) else ''
+        if phase in ('aborted', 'failed'):
+            tvp.state = IPState.ALERT
+        elif phase == 'done':
+            tvp.state = IPState.OK
+        else:
+            tvp.state = IPState.BUSY
+        driver.IDSet(tvp)
+        self.update(driver)
+
+    def set_control(self, driver, state=None, start=False):
+        """Publishes sequence_control, Start is on while running, state
+        None keeps the state"""
+        try:
+            svp = driver.IUFind('sequence_control')
+        except ValueError:
+            return
+        svp['start'].value = 'On' if start else 'Off'
+        svp['abort'].value = 'Off'
+        if state is not None:
+            svp.state = state
+        driver.IDSet(svp)
+
+    def update(self, driver):
+        """Publishes sequence_timing, call about once a second"""
+        if self.started is None:
+            return
+        try:
+            nvp = driver.IUFind('sequence_timing')
+        except ValueError:
+            return
+        now = clock.monotonic() if self.finished is None else self.finished
+        nvp['planned'].value = self.planned
+        nvp['elapsed'].value = now - self.started
+        nvp['remaining'].value = \
+            0.0 if self.finished is not None else max(0.0, self.eta - now)
+        if self.finished is None:
+            nvp.state = IPState.BUSY
+        else:
+            nvp.state = IPState.OK if self.phase == 'done' else IPState.ALERT
+        driver.IDSet(nvp)
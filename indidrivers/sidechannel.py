@@ -0,0 +1,223 @@
+"""sidechannel.py
+
+Binary snapshots on a local UNIX socket for engineering scripts.
+
+A script that wants the upperdome IO byte or the weather readings several
+times a second pays for it over INDI: every update is XML through
+indiserver, parsed back into strings. A SideChannel serves the same data
+as fixed size struct-packed records on a UNIX socket in the state directory
+(<device>.sock) instead, to any number of local readers:
+
+    side = SideChannel(MYDEVICE, ['upperdome'], [
+        ('upperdome_io_byte', 'B'), ('upperdome_fault_byte', 'B'), ...
+    ])
+    side.ensure_started()                        # ISGetProperties
+    side.publish('upperdome', data, acquired)    # every poll/event
+
+It is fed the data the driver already acquired for its properties, it never
+asks the hardware for anything, so snapshots come at the acquisition rate:
+every poll, or every change event with push (up to every push sample
+seconds).
+
+On connecting, a reader gets one line of JSON describing the records
+
+    {"device": "Upper Dome", "version": 1, "format": "<QdBBBB??...",
+     "size": 31, "fields": ["sequence", "timestamp", "source", ...],
+     "sources": ["upperdome"]}
+
+and then a record per snapshot, size bytes each:
+
+    sequence   Q  counts snapshots from 1, a gap means a reader missed some
+    timestamp  d  acquisition time of the data (Unix seconds, driver time)
+    source     B  index in sources of the source that was acquired
+    ...           one value per schema field, the latest of every source
+
+Fields are struct codes: d (NaN until known or when not a number), an
+integer code (0 until known), or ? (bool). The schema of a driver is fixed,
+a reader can hard code it and check version and fields.
+
+Snapshots are never queued for a reader that does not keep up: while more
+than max_buffer bytes are waiting for it, its snapshots are dropped (the
+sequence shows the gap) rather than holding up the driver.
+
+Properties
+----------
+NP : side_channel
+     Readers, Snapshots, Dropped
+"""
+import asyncio
+import json
+import math
+import struct
+from pathlib import Path
+
+from pyindi.device import INumber, INumberVector, IPerm, IPState
+
+from indidrivers.paths import state_file
+
+VERSION = 1
+HEADER = [('sequence', 'Q'), ('timestamp', 'd'), ('source', 'B')]
+
+
+def pack_value(code, value):
+    """value as struct code wants it, the field's unknown value for None or
+    anything it cannot take"""
+    if code == '?':
+        return bool(value)
+    if code in 'efd':
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return math.nan
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class SideChannel():
+    """Snapshot stream of one device, see module docstring
+
+    Parameters
+    ----------
+    device : str
+        Device name, also used for the socket name
+    sources : list
+        Names of the data sources that publish, in source index order
+    schema : list
+        (field, struct code) for every field of a record, fields are keys of
+        the sources' data
+    enabled : bool
+        Serve the socket at all
+    path : str or None
+        Socket path, None for <device>.sock in the state directory
+    max_buffer : int
+        Bytes waiting for a reader above which its snapshots are dropped
+    log : indidrivers.log.DriverLog or None
+        Where to report readers and failing to listen
+    """
+    def __init__(self, device, sources, schema, enabled=False, path=None,
+                 max_buffer=64 * 1024, log=None):
+        self.device = device
+        self.sources = list(sources)
+        self.schema = list(schema)
+        self.enabled = enabled
+        self.path = Path(path) if path else state_file(
+            f"{device.lower().replace(' ', '_')}.sock"
+        )
+        self.max_buffer = max_buffer
+        self.log = log
+        self.record = struct.Struct(
+            '<' + ''.join(code for _, code in HEADER + self.schema)
+        )
+        self.values = [pack_value(code, None) for _, code in self.schema]
+        self.readers = set()
+        self.sequence = 0
+        self.dropped = 0
+        self._server = None
+        self._starting = None
+
+    def configure(self, enabled=False, path=None, max_buffer=64 * 1024):
+        """Applies a reloaded side_channel config, enabled and path need a
+        restart"""
+        self.max_buffer = max_buffer
+
+    def description(self):
+        """The JSON line a reader gets first"""
+        return json.dumps({
+            'device': self.device,
+            'version': VERSION,
+            'format': self.record.format,
+            'size': self.record.size,
+            'fields': [name for name, _ in HEADER + self.schema],
+            'sources': self.sources,
+        }) + '\n'
+
+    def properties(self, group):
+        """Builds the side_channel NP"""
+        numbers = [
+            INumber(name, '%.0f', 0, 1e12, 0, 0, label)
+            for name, label in (
+                ('readers', 'Readers'), ('snapshots', 'Snapshots'),
+                ('dropped', 'Dropped'),
+            )
+        ]
+        return INumberVector(
+            numbers, self.device, 'side_channel', IPState.IDLE, IPerm.RO, 0,
+            None, 'Side Channel', group
+        )
+
+    def ensure_started(self):
+        """Starts listening on the running loop, once"""
+        if not self.enabled:
+            return
+        if self._starting is None:
+            self._starting = asyncio.ensure_future(self.start())
+
+    async def start(self):
+        try:
+            # A socket left behind by a previous run is in the way
+            self.path.unlink(missing_ok=True)
+            self._server = await asyncio.start_unix_server(
+                self._handle, str(self.path)
+            )
+        except OSError as e:
+            if self.log is not None:
+                self.log.error('Cannot serve %s: %s', self.path, e)
+            return
+        if self.log is not None:
+            self.log.info('Serving snapshots on %s', self.path)
+
+    async def _handle(self, reader, writer):
+        writer.write(self.description().encode())
+        self.readers.add(writer)
+        try:
+            # Readers have nothing to say, wait for them to go away
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self.readers.discard(writer)
+            writer.close()
+
+    def publish(self, source, data, acquired):
+        """Sends a snapshot with the latest data of source, acquired at
+        acquired, to every reader"""
+        for i, (name, code) in enumerate(self.schema):
+            if name in data:
+                self.values[i] = pack_value(code, data[name])
+        self.sequence += 1
+        if not self.readers:
+            return
+        record = self.record.pack(
+            self.sequence, acquired, self.sources.index(source), *self.values
+        )
+        for writer in list(self.readers):
+            if writer.is_closing():
+                self.readers.discard(writer)
+            elif writer.transport.get_write_buffer_size() > self.max_buffer:
+                self.dropped += 1
+            else:
+                writer.write(record)
+
+        return
+
+    def update(self, driver):
+        """Publishes side_channel"""
+        try:
+            nvp = driver.IUFind('side_channel')
+        except ValueError:
+            return
+        nvp['readers'].value = len(self.readers)
+        nvp['snapshots'].value = self.sequence
+        nvp['dropped'].value = self.dropped
+        nvp.state = IPState.OK if self._server is not None else IPState.IDLE
+        driver.IDSet(nvp)
+
+        return
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self.path.unlink(missing_ok=True)
@@ -0,0 +1,286 @@
+"""simulator.py
+
+Simulated Kuiper and Bok telescopes with the same subsystems and calls the
+drivers use from mtnpy, for benchmarks, load tests and running drivers away
+from the mountain.
+
+Subsystems
+----------
+upperdome              : request_all, command_all_open, command_all_close,
+                         command_stop
+mirror_cover           : request_state, command_open, command_close
+boltwood               : request_all
+onewire                : request_all
+ninety_prime_flatfield : request_all, command_halogen, command_uband
+
+Mechanisms move through the same state messages as the real ones, in driver
+time (indidrivers.clock). speed divides every mechanism duration so a whole
+Open All can take seconds.
+Weather readings follow a slow random walk, set_rain(True) on the boltwood
+forces rain.
+"""
+import math
+import random
+import threading
+
+from indidrivers import clock
+
+
+class _Subsystem():
+    def __init__(self, speed=1.0, clock=clock.monotonic):
+        self.speed = speed
+        self.clock = clock
+        self.lock = threading.Lock()
+
+    def duration(self, seconds):
+        return seconds / self.speed
+
+
+class SimUpperDome(_Subsystem):
+    """Domeslit, upper and lower windscreens opening/closing in sequence"""
+    OPEN = [
+        ('Domeslit Opening', 'domeslit', 20.0),
+        ('Upper Windscreen Opening', 'upperws', 12.0),
+        ('Lower Windscreen Opening', 'lowerws', 12.0),
+    ]
+    CLOSE = [
+        ('Lower Windscreen Closing', 'lowerws', 12.0),
+        ('Upper Windscreen Closing', 'upperws', 12.0),
+        ('Domeslit Closing', 'domeslit', 20.0),
+    ]
+
+    def __init__(self, speed=1.0, clock=clock.monotonic):
+        super().__init__(speed, clock)
+        self.parts = {'domeslit': 'Closed', 'upperws': 'Closed',
+                      'lowerws': 'Closed'}
+        self.faulted = False
+        self._sequence = None
+        self._started = None
+
+    def _advance(self):
+        """Moves the running sequence on to where it should be by now"""
+        if self._sequence is None:
+            return None
+        elapsed = self.clock() - self._started
+        target = 'Opened' if self._sequence is self.OPEN else 'Closed'
+        for message, part, seconds in self._sequence:
+            seconds = self.duration(seconds)
+            if elapsed < seconds:
+                self.parts[part] = 'Partially Opened'
+                return message
+            elapsed -= seconds
+            self.parts[part] = target
+        self._sequence = None
+
+        return None
+
+    def _start(self, sequence):
+        with self.lock:
+            self._advance()
+            self._sequence = sequence
+            self._started = self.clock()
+        return True
+
+    def command_all_open(self):
+        return self._start(self.OPEN)
+
+    def command_all_close(self):
+        return self._start(self.CLOSE)
+
+    def command_stop(self):
+        with self.lock:
+            self._advance()
+            self._sequence = None
+        return True
+
+    def request_all(self):
+        with self.lock:
+            message = self._advance()
+        if self.faulted:
+            message = 'Fault'
+        state_integer = 0
+        if message is not None:
+            state_integer = [m for m, _, _ in self.OPEN + self.CLOSE].index(
+                message
+            ) + 1
+        data = {
+            'upperdome_state_message': message or 'Idle',
+            'upperdome_state_integer': state_integer,
+            'upperdome_io_byte': 0,
+            'upperdome_fault_byte': 0x80 if self.faulted else 0,
+            'local_mode_sw': False,
+            'upperdome_faulted': self.faulted,
+        }
+        io_byte = 0
+        for bit, (part, state) in enumerate(self.parts.items()):
+            opened, closed = state == 'Opened', state == 'Closed'
+            data[f'{part}_state'] = state
+            data[f'{part}_opened_limitsw'] = opened
+            data[f'{part}_closed_limitsw'] = closed
+            data[f'{part}_faulted'] = False
+            io_byte |= (opened << (2 * bit)) | (closed << (2 * bit + 1))
+        data['upperdome_io_byte'] = io_byte
+
+        return data
+
+
+class SimMirrorCover(_Subsystem):
+    """Mirror cover petals, opening or closing takes travel seconds"""
+    def __init__(self, speed=1.0, clock=clock.monotonic, travel=30.0):
+        super().__init__(speed, clock)
+        self.travel = travel
+        self.position = 0.0 # 0 closed, 1 opened
+        self._direction = 0
+        self._since = clock()
+
+    def _advance(self):
+        now = self.clock()
+        rate = 1.0 / self.duration(self.travel)
+        self.position += self._direction * rate * (now - self._since)
+        self._since = now
+        if self.position >= 1.0 or self.position <= 0.0:
+            self.position = min(max(self.position, 0.0), 1.0)
+            self._direction = 0
+
+    def _move(self, direction):
+        with self.lock:
+            self._advance()
+            self._direction = direction
+        return True
+
+    def command_open(self):
+        return self._move(1)
+
+    def command_close(self):
+        return self._move(-1)
+
+    def request_state(self):
+        with self.lock:
+            self._advance()
+            position = self.position
+        if position >= 1.0:
+            state = 'Opened'
+        elif position <= 0.0:
+            state = 'Closed'
+        else:
+            state = 'Partially Opened'
+
+        return {'mirror_cover_state': state}
+
+
+class _RandomWalk():
+    def __init__(self, value, step, low, high):
+        self.value = value
+        self.step = step
+        self.low = low
+        self.high = high
+
+    def next(self):
+        self.value += random.gauss(0, self.step)
+        self.value = min(max(self.value, self.low), self.high)
+        return round(self.value, 1)
+
+
+class SimBoltwood(_Subsystem):
+    """Boltwood cloud sensor with random walk readings"""
+    def __init__(self, speed=1.0, clock=clock.monotonic):
+        super().__init__(speed, clock)
+        self.raining = False
+        self.walks = {
+            'outside_temperature': _RandomWalk(8.0, 0.05, -20, 35),
+            'outside_humidity': _RandomWalk(30.0, 0.2, 0, 100),
+            'wind_speed': _RandomWalk(10.0, 0.5, 0, 100),
+            'sky_temperature': _RandomWalk(-30.0, 0.1, -50, 20),
+            'boltwood_sensor_temperature': _RandomWalk(9.0, 0.05, -20, 40),
+        }
+
+    def set_rain(self, raining):
+        self.raining = raining
+
+    def request_all(self):
+        with self.lock:
+            data = {name: walk.next() for name, walk in self.walks.items()}
+        temperature = data['outside_temperature']
+        humidity = max(data['outside_humidity'], 1.0)
+        data['outside_dew_point'] = round(dew_point(temperature, humidity), 1)
+        data['boltwood_heater'] = 5.0
+        sky = data['sky_temperature'] - temperature
+        data['cloud_condition'] = (
+            'Clear' if sky < -25 else 'Cloudy' if sky < -15 else 'Very Cloudy'
+        )
+        wind = data['wind_speed']
+        data['wind_condition'] = (
+            'Calm' if wind < 20 else 'Windy' if wind < 40 else 'Very Windy'
+        )
+        data['rain_condition'] = 'Raining' if self.raining else 'Dry'
+        data['daylight_condition'] = 'Dark'
+
+        return data
+
+
+class SimOnewire(_Subsystem):
+    """Onewire temperature and humidity sensors inside the dome"""
+    def __init__(self, speed=1.0, clock=clock.monotonic):
+        super().__init__(speed, clock)
+        self.walks = {
+            'tube_temperature': _RandomWalk(9.0, 0.02, -20, 35),
+            'dome_temperature': _RandomWalk(9.5, 0.02, -20, 35),
+            'dome_humidity': _RandomWalk(25.0, 0.1, 0, 100),
+        }
+
+    def request_all(self):
+        with self.lock:
+            data = {name: walk.next() for name, walk in self.walks.items()}
+        data['dome_dew_point'] = round(
+            dew_point(data['dome_temperature'], max(data['dome_humidity'], 1.0)),
+            1
+        )
+
+        return data
+
+
+class SimFlatfield(_Subsystem):
+    """90Prime flatfield halogen and U band lamps"""
+    def __init__(self, speed=1.0, clock=clock.monotonic):
+        super().__init__(speed, clock)
+        self.lamps = {'halogen_lamps': False, 'uband_lamps': False}
+
+    def command_halogen(self, on):
+        self.lamps['halogen_lamps'] = bool(on)
+        return True
+
+    def command_uband(self, on):
+        self.lamps['uband_lamps'] = bool(on)
+        return True
+
+    def request_all(self):
+        return dict(self.lamps)
+
+
+class SimKuiper():
+    """Stand-in for mtnpy.Kuiper"""
+    def __init__(self, speed=1.0, clock=clock.monotonic):
+        self.upperdome = SimUpperDome(speed, clock)
+        self.mirror_cover = SimMirrorCover(speed, clock)
+        self.boltwood = SimBoltwood(speed, clock)
+        self.onewire = SimOnewire(speed, clock)
+
+
+class SimBok():
+    """Stand-in for mtnpy.Bok"""
+    def __init__(self, speed=1.0, clock=clock.monotonic):
+        self.ninety_prime_flatfield = SimFlatfield(speed, clock)
+
+
+class SimObservatory(SimKuiper, SimBok):
+    """Every simulated subsystem behind one object, for a shared stand-in"""
+    def __init__(self, speed=1.0, clock=clock.monotonic):
+        SimKuiper.__init__(self, speed, clock)
+        SimBok.__init__(self, speed, clock)
+
+
+def dew_point(temperature, humidity):
+    """Magnus formula dew point in C from C and %"""
+    a, b = 17.62, 243.12
+    gamma = math.log(humidity / 100.0) + a * temperature / (b + temperature)
+    return b * gamma / (a - gamma)
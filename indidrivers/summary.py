@@ -0,0 +1,285 @@
+"""summary.py
+
+One compact view of the whole observatory.
+
+A dashboard or the observing scheduler that only wants to know "is it safe
+and is it open?" used to define four devices and follow dozens of vectors,
+each with its own timestamp. An ObservatorySummary keeps the latest data of
+every source
+
+    weather       boltwood request_all
+    upperdome     upperdome request_all
+    mirror_cover  mirror_cover request_state
+    flatfield     ninety_prime_flatfield request_all
+
+and boils it down to four vectors. They are rebuilt from all sources at
+once and every vector sent in one pass carries the same timestamp, the
+acquisition time of the newest data, so a client never mixes a dome state
+from one moment with weather from another. Vectors are only sent when
+something in them changed (a DeadbandPublisher without heartbeat), an idle
+observatory sends nothing.
+
+A source whose request failed or whose data went stale (see
+indidrivers.freshness) turns the Data light ALERT and with it safe, its
+last values stay on display.
+
+Properties
+----------
+LP : safe
+     Weather (worst condition, as the weather driver lights them), Dome
+     (ALERT when faulted or in local mode), Mirror Cover (ALERT on Error),
+     Data (ALERT while a source failed or is stale). The vector takes the
+     worst light.
+LP : open
+     Dome Slit, Upper Windscreen, Lower Windscreen, Mirror Cover: Opened OK,
+     Partially Opened BUSY, Closed IDLE, anything else ALERT. The vector is
+     OK when all are open, IDLE when all are closed, BUSY in between.
+TP : status
+     Weather, Dome, Mirror Cover, Lamps as text
+NP : conditions
+     Outside Temperature, Humidity, Dew Point, Wind Speed
+"""
+import math
+
+from pyindi.device import (
+    ILight, ILightVector, INumber, INumberVector, IPerm, IPState, IText,
+    ITextVector
+)
+
+from indidrivers.derived import worst
+from indidrivers.freshness import indi_timestamp
+from indidrivers.publish import DeadbandPublisher, as_float
+
+# Source name to (subsystem, method)
+SOURCES = {
+    'weather': ('boltwood', 'request_all'),
+    'upperdome': ('upperdome', 'request_all'),
+    'mirror_cover': ('mirror_cover', 'request_state'),
+    'flatfield': ('ninety_prime_flatfield', 'request_all'),
+}
+
+# Weather condition values, as the weather driver lights them
+WEATHER_OK = {'calm', 'clear', 'dry', 'dark'}
+WEATHER_BUSY = {'cloudy', 'windy', 'moist', 'light'}
+CONDITIONS = ['cloud', 'wind', 'rain', 'daylight']
+
+OPEN_STATES = {
+    'Opened': IPState.OK,
+    'Partially Opened': IPState.BUSY,
+    'Closed': IPState.IDLE,
+}
+PARTS = [
+    ('domeslit', 'Dome Slit'),
+    ('upperws', 'Upper Windscreen'),
+    ('lowerws', 'Lower Windscreen'),
+]
+
+READINGS = [
+    ('outside_temperature', '%.1f', 'Temperature (C)'),
+    ('outside_humidity', '%.0f', 'Humidity (%)'),
+    ('outside_dew_point', '%.1f', 'Dew Point (C)'),
+    ('wind_speed', '%.1f', 'Wind Speed (km/h)'),
+]
+
+
+def condition_state(value):
+    """State of a boltwood condition such as 'Very Windy'"""
+    value = str(value).lower()
+    if value in WEATHER_OK:
+        return IPState.OK
+    if value in WEATHER_BUSY:
+        return IPState.BUSY
+    return IPState.ALERT
+
+
+def lamps_text(data):
+    """'Off', 'Halogen', 'U Band' or both"""
+    lamps = [
+        label for key, label in (
+            ('halogen_lamps', 'Halogen'), ('uband_lamps', 'U Band')
+        )
+        if data.get(key)
+    ]
+    return ', '.join(lamps) or 'Off'
+
+
+class ObservatorySummary():
+    """Latest data of every source and the summary vectors, see module
+    docstring
+
+    Parameters
+    ----------
+    device : str
+        Device name to attach to
+    freshness : indidrivers.freshness.Freshness
+        Acquisition times of the sources in SOURCES
+    deadbands : dict
+        Element name of conditions to deadband
+    """
+    def __init__(self, device, freshness, deadbands=None):
+        self.device = device
+        self.freshness = freshness
+        self.data = {source: {} for source in SOURCES}
+        self.failed = set()
+        self.publisher = DeadbandPublisher(deadbands, max_interval=math.inf)
+
+    def properties(self, group):
+        """Builds the safe and open LPs, status TP and conditions NP"""
+        safe_l = [
+            ILight(name, IPState.IDLE, label) for name, label in (
+                ('weather', 'Weather'), ('dome', 'Dome'),
+                ('mirror_cover', 'Mirror Cover'), ('data', 'Data')
+            )
+        ]
+        safe_lvp = ILightVector(
+            safe_l, self.device, 'safe', IPState.IDLE, 0, None, 'Safe', group
+        )
+        open_l = [ILight(name, IPState.IDLE, label) for name, label in PARTS]
+        open_l.append(ILight('mirror_cover', IPState.IDLE, 'Mirror Cover'))
+        open_lvp = ILightVector(
+            open_l, self.device, 'open', IPState.IDLE, 0, None, 'Open', group
+        )
+        status_t = [
+            IText(name, '', label) for name, label in (
+                ('weather', 'Weather'), ('dome', 'Dome'),
+                ('mirror_cover', 'Mirror Cover'), ('lamps', 'Lamps')
+            )
+        ]
+        status_tvp = ITextVector(
+            status_t, self.device, 'status', IPState.IDLE, IPerm.RO, 0, None,
+            'Status', group
+        )
+        conditions_n = [
+            INumber(name, fmt, -1e6, 1e6, 0, 0, label)
+            for name, fmt, label in READINGS
+        ]
+        conditions_nvp = INumberVector(
+            conditions_n, self.device, 'conditions', IPState.IDLE, IPerm.RO,
+            0, None, 'Conditions', group
+        )
+        # Clients defining the device need everything again
+        self.publisher.forget()
+
+        return safe_lvp, open_lvp, status_tvp, conditions_nvp
+
+    def update(self, source, data):
+        """Keeps data of source, an Exception if the request failed"""
+        if isinstance(data, Exception):
+            self.failed.add(source)
+            return
+        self.failed.discard(source)
+        self.data[source] = data
+
+    def data_ok(self):
+        """False while a source failed or is stale, None while some have
+        not been read yet"""
+        if self.failed:
+            return False
+        if any(
+            self.freshness.acquired_at[source] is None for source in SOURCES
+        ):
+            return None
+        return not any(self.freshness.stale(source) for source in SOURCES)
+
+    def fill_safe(self, lvp):
+        weather = self.data['weather']
+        dome = self.data['upperdome']
+        mirror_cover = self.data['mirror_cover']
+        if weather:
+            lvp['weather'].value = worst(
+                condition_state(weather.get(f'{condition}_condition'))
+                for condition in CONDITIONS
+            )
+        if dome:
+            bad = dome.get('upperdome_faulted') or dome.get('local_mode_sw')
+            lvp['dome'].value = IPState.ALERT if bad else IPState.OK
+        if mirror_cover:
+            bad = mirror_cover.get('mirror_cover_state') == 'Error'
+            lvp['mirror_cover'].value = IPState.ALERT if bad else IPState.OK
+        ok = self.data_ok()
+        if ok is not None:
+            lvp['data'].value = IPState.OK if ok else IPState.ALERT
+        lvp.state = worst(light.value for light in lvp)
+
+    def fill_open(self, lvp):
+        states = {
+            name: self.data['upperdome'].get(f'{name}_state')
+            for name, _ in PARTS
+        }
+        states['mirror_cover'] = \
+            self.data['mirror_cover'].get('mirror_cover_state')
+        for name, state in states.items():
+            if state is not None:
+                lvp[name].value = OPEN_STATES.get(state, IPState.ALERT)
+        lights = [light.value for light in lvp]
+        if IPState.ALERT in lights:
+            lvp.state = IPState.ALERT
+        elif all(light == IPState.OK for light in lights):
+            lvp.state = IPState.OK
+        elif all(light == IPState.IDLE for light in lights):
+            lvp.state = IPState.IDLE
+        else:
+            lvp.state = IPState.BUSY
+
+    def fill_status(self, tvp):
+        weather = self.data['weather']
+        dome = self.data['upperdome']
+        mirror_cover = self.data['mirror_cover']
+        flatfield = self.data['flatfield']
+        if weather:
+            tvp['weather'].value = ', '.join(
+                str(weather.get(f'{condition}_condition'))
+                for condition in CONDITIONS
+            )
+        if dome:
+            tvp['dome'].value = dome.get('upperdome_state_message', '')
+        if mirror_cover:
+            tvp['mirror_cover'].value = \
+                mirror_cover.get('mirror_cover_state', '')
+        if flatfield:
+            tvp['lamps'].value = lamps_text(flatfield)
+        tvp.state = IPState.ALERT if self.failed else IPState.OK
+
+    def fill_conditions(self, nvp):
+        weather = self.data['weather']
+        for element in nvp:
+            value = as_float(weather.get(element.name))
+            if value is not None:
+                element.value = value
+        if 'weather' in self.failed or self.freshness.stale('weather'):
+            nvp.state = IPState.ALERT if weather else IPState.IDLE
+        else:
+            nvp.state = IPState.OK
+
+    def publish(self, driver):
+        """Rebuilds the vectors and sends the ones that changed, all
+        stamped alike
+
+        Returns the number of vectors sent.
+        """
+        try:
+            vps = [
+                driver.IUFind(name)
+                for name in ('safe', 'open', 'status', 'conditions')
+            ]
+        except ValueError:
+            return 0
+        safe_lvp, open_lvp, status_tvp, conditions_nvp = vps
+        self.fill_safe(safe_lvp)
+        self.fill_open(open_lvp)
+        self.fill_status(status_tvp)
+        self.fill_conditions(conditions_nvp)
+
+        acquired = [
+            t for t in self.freshness.acquired_at.values() if t is not None
+        ]
+        if not acquired:
+            # Nothing to say before the first data, the definitions are IDLE
+            return 0
+        timestamp = indi_timestamp(max(acquired))
+        sent = 0
+        for vp in vps:
+            vp.timestamp = timestamp
+            sent += self.publisher.publish(driver, vp)
+
+        return sent
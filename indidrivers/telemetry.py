@@ -0,0 +1,650 @@
+"""telemetry.py
+
+Pipelined telemetry requests over one persistent connection.
+
+Every driver poll is a request/response round trip to the controller, so a
+snapshot of boltwood, onewire, upperdome and mirror_cover costs four round
+trips. This module speaks a small line based protocol where each request
+carries an id, any number of requests can be in flight on the same
+connection, and replies are matched back to their request by id:
+
+    -> {"id": 1, "subsystem": "boltwood", "method": "request_all", "args": []}
+    -> {"id": 2, "subsystem": "onewire", "method": "request_all", "args": []}
+    <- {"id": 2, "result": {...}}
+    <- {"id": 1, "error": "timed out"}
+
+TelemetryClient.request_many writes a whole batch at once and then collects
+the replies, so a snapshot costs about one round trip.
+
+TelemetryServer is the other end. It wraps any telescope object (mtnpy
+Kuiper/Bok or one from indidrivers.simulator) and serves the requests
+concurrently. Used with mtnpy it is a gateway running next to the
+controller; with the simulator and a delay it is the local stand-in server
+for benchmarks (tools/bench_telemetry.py) and tests:
+
+    python -m indidrivers.telemetry --sim --port 7700 --delay 0.05
+
+RemoteTelescope makes a client look like an mtnpy telescope, so drivers can
+use it without changes (telescope.boltwood.request_all()).
+
+AsyncTelemetryClient and AsyncRemoteTelescope are the same on asyncio
+streams for drivers running with INDIDRIVERS_CLIENT=async (see
+indidrivers.backend). One reader task hands each reply to the future of its
+request, so any number of coroutines share the connection and each only
+waits for its own replies, nothing blocks the event loop:
+
+    data = await telescope.boltwood.request_all()
+
+A request with "subscribe" (seconds) is a subscription. The first reply is
+the result as usual, then the server calls the method every that many
+seconds next to the controller and pushes only what changed, and an empty
+event after keepalive seconds of no change so the client can tell a quiet
+subsystem from a dead connection:
+
+    -> {"id": 3, "subsystem": "upperdome", "method": "request_all",
+        "args": [], "subscribe": 0.05, "keepalive": 2}
+    <- {"id": 3, "result": {...}}
+    <- {"event": 3, "changed": {"upperdome_state_message": "Idle"}}
+    <- {"event": 3}
+    <- {"event": 3, "error": "timed out"}
+    -> {"id": 4, "unsubscribe": 3}
+
+AsyncTelemetryClient.subscribe keeps the merged result and hands it to a
+callback on every event (see indidrivers.push).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import socket
+import threading
+import time
+
+# Fastest a subscription samples, whatever the client asks for
+MIN_SAMPLE = 0.01
+
+
+class TelemetryError(Exception):
+    """The server answered a request with an error"""
+
+
+class TelemetryClient():
+    """Blocking client, one persistent connection, pipelined requests
+
+    Parameters
+    ----------
+    host, port : str, int
+        Where the TelemetryServer listens
+    timeout : float
+        Seconds any one socket operation (connecting, sending, each read)
+        may take, so a batch whose replies keep coming can take longer
+    """
+    def __init__(self, host='localhost', port=7700, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def connect(self):
+        self.close()
+        self._sock = socket.create_connection(
+            (self.host, self.port), timeout=self.timeout
+        )
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile('rb')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = self._file = None
+
+    def request(self, subsystem, method, *args):
+        """Single request, raises TelemetryError if the server failed it"""
+        result = self.request_many([(subsystem, method, args)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def request_many(self, calls):
+        """Sends all calls at once and waits for every reply
+
+        Parameters
+        ----------
+        calls : list of (subsystem, method, args)
+
+        Returns
+        -------
+        list
+            Result of each call in the same order, or a TelemetryError
+            instance for calls that failed on the server. Connection
+            problems raise OSError and drop the connection so the next call
+            reconnects.
+        """
+        with self._lock:
+            if self._sock is None:
+                self.connect()
+            ids = []
+            lines = []
+            for subsystem, method, args in calls:
+                request_id = next(self._ids)
+                ids.append(request_id)
+                lines.append(json.dumps({
+                    'id': request_id, 'subsystem': subsystem,
+                    'method': method, 'args': list(args)
+                }))
+            try:
+                self._sock.sendall(('\n'.join(lines) + '\n').encode())
+                replies = self._collect(set(ids))
+            except (OSError, ValueError):
+                self.close()
+                raise
+
+        return [replies[request_id] for request_id in ids]
+
+    def _collect(self, waiting):
+        replies = {}
+        while waiting:
+            line = self._file.readline()
+            if not line:
+                raise ConnectionError('telemetry server closed connection')
+            reply = json.loads(line)
+            request_id = reply.get('id')
+            if request_id not in waiting:
+                continue # Stale reply from a batch that timed out
+            waiting.discard(request_id)
+            if 'error' in reply:
+                replies[request_id] = TelemetryError(reply['error'])
+            else:
+                replies[request_id] = reply.get('result')
+
+        return replies
+
+
+class _RemoteSubsystem():
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __getattr__(self, method):
+        def call(*args):
+            return self._client.request(self._name, method, *args)
+        call.__name__ = method
+        return call
+
+
+class RemoteTelescope():
+    """Looks like an mtnpy telescope, forwards calls to a TelemetryClient"""
+    # Would otherwise be taken for a subsystem by is_async
+    asynchronous = False
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, subsystem):
+        if subsystem.startswith('_'):
+            raise AttributeError(subsystem)
+        return _RemoteSubsystem(self.client, subsystem)
+
+    def request_many(self, calls):
+        return self.client.request_many(calls)
+
+    def close(self):
+        self.client.close()
+
+
+class AsyncTelemetryClient():
+    """asyncio client, one persistent connection shared by all coroutines
+
+    Parameters
+    ----------
+    host, port : str, int
+        Server to connect to
+    timeout : float
+        Seconds to wait for a connection or a reply
+    """
+    def __init__(self, host='localhost', port=7700, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._writer = None
+        self._reader_task = None
+        self._connecting = None
+        self._ids = itertools.count(1)
+        self._waiting = {} # id -> future
+        self._subscriptions = {} # id -> [callback, merged result]
+        self.last_message = None
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    async def connect(self):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout
+        )
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._writer = writer
+        self._reader_task = asyncio.ensure_future(self._read(reader))
+
+    async def _ensure_connected(self):
+        # Coroutines arriving together share one connection attempt
+        if self._writer is not None:
+            return
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self.connect())
+        try:
+            await asyncio.shield(self._connecting)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+
+    def close(self):
+        """Drops the connection, requests in flight fail with OSError"""
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = self._reader_task = None
+        self._subscriptions.clear()
+        self._fail(ConnectionError('telemetry connection closed'))
+
+    def _fail(self, error):
+        for future in self._waiting.values():
+            if not future.done():
+                future.set_exception(error)
+        self._waiting.clear()
+
+    async def _read(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionError('telemetry server closed connection')
+                self.last_message = time.monotonic()
+                reply = json.loads(line)
+                if 'event' in reply:
+                    self._event(reply)
+                    continue
+                future = self._waiting.pop(reply.get('id'), None)
+                if future is None or future.done():
+                    continue # Stale reply of a request that timed out
+                if 'error' in reply:
+                    future.set_exception(TelemetryError(reply['error']))
+                else:
+                    future.set_result(reply.get('result'))
+        except asyncio.CancelledError:
+            raise
+        except (OSError, ValueError) as e:
+            self._writer = self._reader_task = None
+            self._subscriptions.clear()
+            self._fail(e)
+
+    def _event(self, reply):
+        subscription = self._subscriptions.get(reply['event'])
+        if subscription is None:
+            return # Unsubscribed meanwhile
+        callback, merged = subscription
+        if 'error' in reply:
+            callback(TelemetryError(reply['error']))
+            return
+        if 'result' in reply:
+            subscription[1] = merged = reply['result']
+        elif isinstance(merged, dict):
+            merged.update(reply.get('changed', {}))
+        callback(merged)
+
+    async def request(self, subsystem, method, *args):
+        """Single request, raises TelemetryError if the server failed it"""
+        result = (await self.request_many([(subsystem, method, args)]))[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def request_many(self, calls):
+        """Sends all calls at once and waits for every reply
+
+        Same results as TelemetryClient.request_many. A reply that takes
+        longer than timeout raises asyncio.TimeoutError, the connection is
+        kept since later replies still find their requests by id.
+        """
+        await self._ensure_connected()
+        loop = asyncio.get_running_loop()
+        ids = []
+        futures = []
+        lines = []
+        for subsystem, method, args in calls:
+            request_id = next(self._ids)
+            future = loop.create_future()
+            self._waiting[request_id] = future
+            ids.append(request_id)
+            futures.append(future)
+            lines.append(json.dumps({
+                'id': request_id, 'subsystem': subsystem,
+                'method': method, 'args': list(args)
+            }))
+        try:
+            self._writer.write(('\n'.join(lines) + '\n').encode())
+            await self._writer.drain()
+            await asyncio.wait_for(
+                asyncio.gather(*futures, return_exceptions=True), self.timeout
+            )
+        except OSError:
+            self.close()
+            raise
+        except asyncio.TimeoutError:
+            for request_id in ids:
+                self._waiting.pop(request_id, None)
+            raise
+
+        results = []
+        for future in futures:
+            e = future.exception()
+            if isinstance(e, (OSError, ValueError)):
+                raise e
+            results.append(e if e is not None else future.result())
+
+        return results
+
+    async def subscribe(self, subsystem, method, args, callback, sample,
+                        keepalive=2.0):
+        """Subscribes to a call, see module docstring
+
+        Returns (subscription id, first result). From then on callback
+        gets the merged result on every event, a TelemetryError if the call
+        failed on the server.
+        """
+        await self._ensure_connected()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[request_id] = future
+        self._writer.write((json.dumps({
+            'id': request_id, 'subsystem': subsystem, 'method': method,
+            'args': list(args), 'subscribe': sample, 'keepalive': keepalive
+        }) + '\n').encode())
+        try:
+            await self._writer.drain()
+            result = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self._waiting.pop(request_id, None)
+            raise
+        except OSError:
+            self.close()
+            raise
+        self._subscriptions[request_id] = [callback, result]
+
+        return request_id, result
+
+    async def unsubscribe(self, subscription):
+        if self._subscriptions.pop(subscription, None) is None:
+            return
+        self._writer.write((json.dumps({
+            'id': next(self._ids), 'unsubscribe': subscription
+        }) + '\n').encode())
+        await self._writer.drain()
+
+
+class _AsyncRemoteSubsystem():
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __getattr__(self, method):
+        async def call(*args):
+            return await self._client.request(self._name, method, *args)
+        call.__name__ = method
+        return call
+
+
+class AsyncRemoteTelescope():
+    """RemoteTelescope whose methods are coroutines"""
+    asynchronous = True
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, subsystem):
+        if subsystem.startswith('_'):
+            raise AttributeError(subsystem)
+        return _AsyncRemoteSubsystem(self.client, subsystem)
+
+    async def request_many(self, calls):
+        return await self.client.request_many(calls)
+
+    def close(self):
+        self.client.close()
+
+
+class TelemetryServer():
+    """Serves telemetry requests for a telescope object
+
+    Parameters
+    ----------
+    telescope : object
+        Anything with mtnpy style subsystems
+    host, port : str, int
+        Where to listen, port 0 picks a free port
+    delay : float
+        Extra seconds before each reply, stands in for network latency
+    """
+    def __init__(self, telescope, host='localhost', port=7700, delay=0.0):
+        self.telescope = telescope
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.requests = 0
+        self.events = 0
+        self.sent = 0 # bytes
+        self._server = None
+        self._loop = None
+        self._connections = {} # Handler task -> writer
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def start_in_thread(self):
+        """Runs the server on its own loop in a daemon thread, returns port"""
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+
+        return self.port
+
+    def stop(self):
+        """Stops a server started with start_in_thread"""
+        if self._loop is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self.close(), self._loop)
+        future.result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def close(self):
+        """Stops listening and drops every connection"""
+        self._server.close()
+        tasks = []
+        for task, writer in list(self._connections.items()):
+            writer.close() # Handler sees EOF and finishes on its own
+            tasks.append(task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _handle(self, reader, writer):
+        self._connections[asyncio.current_task()] = writer
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tasks = set()
+        subscriptions = {} # id -> task
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.requests += 1
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    continue
+                if 'unsubscribe' in request:
+                    task = subscriptions.pop(request['unsubscribe'], None)
+                    if task is not None:
+                        task.cancel()
+                    continue
+                if 'subscribe' in request:
+                    task = asyncio.ensure_future(
+                        self._subscribe(request, writer)
+                    )
+                    subscriptions[request.get('id')] = task
+                else:
+                    task = asyncio.ensure_future(self._reply(request, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+            self._connections.pop(asyncio.current_task(), None)
+
+    async def _send(self, writer, message):
+        data = (json.dumps(message) + '\n').encode()
+        self.sent += len(data)
+        writer.write(data)
+        await writer.drain()
+
+    async def _reply(self, request, writer):
+        reply = {'id': request.get('id')}
+        try:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            reply['result'] = await asyncio.get_event_loop().run_in_executor(
+                None, self.call, request['subsystem'], request['method'],
+                request.get('args', [])
+            )
+        except Exception as e:
+            reply['error'] = f'{type(e).__name__}: {e}'
+        await self._send(writer, reply)
+
+    async def _subscribe(self, request, writer):
+        """Samples a call and pushes what changed, see module docstring"""
+        subscription = request.get('id')
+        sample = max(float(request['subscribe']), MIN_SAMPLE)
+        keepalive = float(request.get('keepalive', 2.0))
+        loop = asyncio.get_event_loop()
+        last = error = sent = None
+        while True:
+            failed = None
+            try:
+                result = await loop.run_in_executor(
+                    None, self.call, request['subsystem'], request['method'],
+                    request.get('args', [])
+                )
+            except Exception as e:
+                failed = f'{type(e).__name__}: {e}'
+            now = time.monotonic()
+
+            message = {'event': subscription}
+            if sent is None:
+                # First reply answers the request, a failure ends it
+                message = {'id': subscription}
+                if failed is not None:
+                    message['error'] = failed
+                    await self._send(writer, message)
+                    return
+                message['result'] = result
+            elif failed is not None:
+                if failed == error and now - sent < keepalive:
+                    message = None
+                else:
+                    message['error'] = failed
+            elif error is not None or not isinstance(result, dict):
+                # Whole result after a failure or when it is not a dict
+                if error is not None or result != last:
+                    message['result'] = result
+                elif now - sent < keepalive:
+                    message = None
+            else:
+                changed = {
+                    key: value for key, value in result.items()
+                    if key not in last or last[key] != value
+                }
+                if changed:
+                    message['changed'] = changed
+                elif now - sent < keepalive:
+                    message = None
+
+            if message is not None:
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                await self._send(writer, message)
+                self.events += 1
+                sent = now
+            if failed is None:
+                last = result
+            error = failed
+            await asyncio.sleep(sample)
+
+    def call(self, subsystem, method, args):
+        """Runs one call on the telescope, only public methods allowed"""
+        if subsystem.startswith('_') or method.startswith('_'):
+            raise AttributeError(f'{subsystem}.{method}')
+        return getattr(getattr(self.telescope, subsystem), method)(*args)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Telemetry server, a gateway to mtnpy or a simulator'
+    )
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=7700)
+    parser.add_argument(
+        '--delay', type=float, default=0.0,
+        help='seconds added to every reply to mimic network latency'
+    )
+    parser.add_argument(
+        '--sim', action='store_true', help='serve the simulator, not mtnpy'
+    )
+    parser.add_argument(
+        '--speed', type=float, default=1.0,
+        help='simulated mechanisms run this many times faster'
+    )
+    parser.add_argument(
+        '--telescope', default='Kuiper', choices=['Kuiper', 'Bok'],
+        help='mtnpy telescope to serve (ignored with --sim)'
+    )
+    args = parser.parse_args()
+
+    if args.sim:
+        from indidrivers.simulator import SimObservatory
+        telescope = SimObservatory(speed=args.speed)
+    else:
+        import mtnpy
+        telescope = getattr(mtnpy, args.telescope)()
+
+    server = TelemetryServer(telescope, args.host, args.port, args.delay)
+    asyncio.run(server.serve_forever())
+
+
+if __name__ == '__main__':
+    main()
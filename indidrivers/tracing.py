@@ -0,0 +1,251 @@
+"""tracing.py
+
+Where the time of a command went, from the client's click to the data that
+shows it done.
+
+"Close All took forever" could be the driver (the command waited behind
+something on the loop), the controller (command_all_close was slow to
+answer), the mechanism, or the poll that finally saw it. A Tracer follows
+every command through spans
+
+    queue      newSwitchVector handled until the hardware call starts
+    <call>     the hardware call, e.g. command_all_close, one per call
+    motion     call returned until the data showing it done was acquired
+               (see indidrivers.freshness)
+    report     that data acquired until the driver handled it, poll round
+               trip or push delivery
+
+under one root span named after the button, all with the same trace id:
+
+    trace = tracer.begin('commands', 'close_all')      # ISNewSwitch
+    trace.step('command_all_close')                    # before the call
+    tracer.wait(trace, lambda data: all_closed(data))  # call returned
+    tracer.confirm(data, acquired)                     # every poll/event
+
+A command that failed or was ignored ends with that status instead
+(tracer.finish), one still in motion when the hardware accepted a newer
+command on the same switch vector ends replaced.
+
+Finished traces go to <device>_traces.json in the state directory in the
+Chrome trace event format (JSON array of complete events, one per line,
+the closing bracket left out as the format allows), which Perfetto
+(ui.perfetto.dev) and chrome://tracing open as is. The file is rotated at
+file_kb. Each trace is also logged with its breakdown and kept in the
+command_traces text vector. Times are driver time (indidrivers.clock).
+
+Properties
+----------
+TP : command_traces
+     Trace 1 .. Trace N, latest first
+"""
+import collections
+import json
+import os
+import secrets
+from datetime import datetime
+
+from pyindi.device import IPerm, IPState, IText, ITextVector
+
+from indidrivers import clock
+from indidrivers.paths import state_file
+
+
+def switched_on(values, names):
+    """Names of the switches a client turned On, e.g. 'close_all'"""
+    return '+'.join(
+        name for name, value in zip(names, values) if value == 'On'
+    ) or 'off'
+
+
+def format_seconds(seconds):
+    if seconds < 1:
+        return f'{seconds * 1000:.0f} ms'
+    return f'{seconds:.1f} s'
+
+
+class Trace():
+    """One command, see module docstring"""
+    def __init__(self, key, name, args):
+        self.key = key
+        self.name = name
+        self.args = args
+        self.trace_id = secrets.token_hex(16)
+        self.start = clock.time()
+        self.spans = [] # (name, start, end, args)
+        self.current = ('queue', self.start, {})
+        self.done = None
+
+    def step(self, name, **args):
+        """Ends the current span and starts span name"""
+        self.step_at(clock.time(), name, **args)
+
+    def step_at(self, t, name, **args):
+        span, start, span_args = self.current
+        # Never before the span it ends, acquisition is a midpoint guess
+        t = max(t, start)
+        self.spans.append((span, start, t, span_args))
+        self.current = (name, t, args)
+
+    def end(self):
+        """Ends the current span, returns the end time"""
+        span, start, span_args = self.current
+        end = max(clock.time(), start)
+        self.spans.append((span, start, end, span_args))
+        self.current = None
+        return end
+
+
+class Tracer():
+    """Traces the commands of one device, see module docstring
+
+    Parameters
+    ----------
+    device : str
+        Device name, also used for the trace file name
+    file : bool
+        Write finished traces to the trace file
+    file_kb : int
+        Size at which the trace file is rotated
+    keep : int
+        Traces kept in command_traces
+    log : indidrivers.log.DriverLog or None
+        Where finished traces are logged
+    """
+    def __init__(self, device, file=True, file_kb=1024, keep=5, log=None):
+        self.device = device
+        self.file = file
+        self.file_kb = file_kb
+        self.keep = keep
+        self.log = log
+        self.path = state_file(
+            f"{device.lower().replace(' ', '_')}_traces.json"
+        )
+        self.pending = {} # key -> Trace
+        self.recent = collections.deque(maxlen=keep)
+        self.driver = None
+        self.tid = 0
+
+    def configure(self, file=True, file_kb=1024):
+        """Applies a reloaded tracing config"""
+        self.file = file
+        self.file_kb = file_kb
+
+    def attach(self, driver):
+        """Publishes command_traces through driver"""
+        self.driver = driver
+
+    def properties(self, group):
+        """Builds the command_traces TP"""
+        recent = list(self.recent)
+        texts = [
+            IText(
+                f'trace_{i + 1}', recent[i] if i < len(recent) else '',
+                f'Trace {i + 1}'
+            )
+            for i in range(self.keep)
+        ]
+        return ITextVector(
+            texts, self.device, 'command_traces', IPState.IDLE, IPerm.RO, 0,
+            None, 'Command Traces', group
+        )
+
+    def begin(self, key, name, **args):
+        """Starts tracing command name sent on switch vector key"""
+        return Trace(key, name, args)
+
+    def wait(self, trace, done):
+        """The hardware accepted the command, motion lasts until done(data)
+        is true for the data of a poll or change event"""
+        previous = self.pending.get(trace.key)
+        if previous is not None:
+            self.finish(previous, 'replaced')
+        trace.done = done
+        trace.step('motion')
+        self.pending[trace.key] = trace
+
+    def confirm(self, data, acquired=None):
+        """Finishes the traces that data (acquired at acquired) shows done"""
+        for trace in list(self.pending.values()):
+            if trace.done is None:
+                continue
+            try:
+                done = trace.done(data)
+            except (KeyError, TypeError):
+                done = False
+            if not done:
+                continue
+            trace.step_at(
+                clock.time() if acquired is None else acquired, 'report'
+            )
+            self.finish(trace, 'ok')
+
+    def finish(self, trace, status, **args):
+        """Ends trace with status (ok, failed, ignored, replaced...)"""
+        if self.pending.get(trace.key) is trace:
+            del self.pending[trace.key]
+        end = trace.end()
+        total = end - trace.start
+        breakdown = ', '.join(
+            f'{span} {format_seconds(stop - start)}'
+            for span, start, stop, _ in trace.spans
+        )
+        summary = (
+            f'{trace.name} {status} in {format_seconds(total)}: {breakdown}'
+        )
+        self.recent.appendleft(
+            f'{datetime.now():%Y-%m-%d %H:%M:%S} {summary} '
+            f'[{trace.trace_id[:8]}]'
+        )
+        if self.log is not None:
+            log = self.log.info if status == 'ok' else self.log.warning
+            log('%s [trace %s]', summary, trace.trace_id)
+        if self.file:
+            self.write(trace, status, end, args)
+        self.publish(status)
+
+    def events(self, trace, status, end, args):
+        """Chrome trace events of a finished trace"""
+        self.tid += 1
+        base = {'cat': self.device, 'ph': 'X', 'pid': os.getpid(),
+                'tid': self.tid}
+        root_args = dict(trace.args, trace_id=trace.trace_id, status=status,
+                         **args)
+        events = [dict(
+            base, name=trace.name, ts=round(trace.start * 1e6),
+            dur=round((end - trace.start) * 1e6), args=root_args
+        )]
+        for span, start, stop, span_args in trace.spans:
+            events.append(dict(
+                base, name=span, ts=round(start * 1e6),
+                dur=round((stop - start) * 1e6),
+                args=dict(span_args, trace_id=trace.trace_id)
+            ))
+        return events
+
+    def write(self, trace, status, end, args):
+        """Appends a finished trace to the trace file"""
+        try:
+            if self.path.exists() and \
+                    self.path.stat().st_size > self.file_kb * 1024:
+                self.path.replace(self.path.with_suffix('.json.1'))
+            new = not self.path.exists()
+            with open(self.path, 'a') as f:
+                if new:
+                    f.write('[\n')
+                for event in self.events(trace, status, end, args):
+                    f.write(json.dumps(event, default=str) + ',\n')
+        except OSError as e:
+            if self.log is not None:
+                self.log.error('Cannot write %s: %s', self.path, e)
+
+    def publish(self, status):
+        if self.driver is None:
+            return
+        try:
+            tvp = self.driver.IUFind('command_traces')
+        except ValueError:
+            return
+        for element, text in zip(tvp, self.recent):
+            element.value = text
+        tvp.state = IPState.OK if status == 'ok' else IPState.ALERT
+        self.driver.IDSet(tvp)
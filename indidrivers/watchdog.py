@@ -0,0 +1,312 @@
+"""watchdog.py
+
+Heartbeats of a driver's poll tasks and recovery of the ones that stall.
+
+The mtnpy calls block. When one hangs (a controller that accepts the
+connection and never answers) the poll never returns, and since it ran on
+the event loop the whole driver froze with its last values on display.
+
+A Watchdog runs each poll as an asyncio task whose hardware calls go to a
+worker thread (or, with the async client, are awaited on the loop):
+
+    @device.repeat(clock.period_ms(1000))
+    def update(self):
+        watchdog.start('update', self.poll)
+
+    async def poll(self):
+        data = await watchdog.call(telescope.upperdome.request_all)
+
+start does nothing while the previous run is still going, so a slow call
+never stacks up runs. Every run that finishes, failed or not, is a
+heartbeat. check (once a second) compares how long each task's current run
+has been going with its deadline, and after misses deadlines
+
+    - cancels the run, the repeat starts a fresh one on its next tick
+    - abandons the worker thread stuck in the call and starts a new one
+      (a coroutine call is simply cancelled with the run)
+    - calls reconnect, which replaces the driver's connection
+
+Each recovery is logged and kept in watchdog_events with how long the task
+had stalled and how long recovering took.
+
+Commands go through call as well, so with the sync client the worker is the
+only thread that ever uses the connection (mtnpy is not thread safe), and a
+command waits for a running poll instead of running next to it. Calls still
+queued behind a stalled one fail with ConnectionError when its worker is
+abandoned.
+
+While a driver receives change events (indidrivers.push) instead of
+polling, each event is a heartbeat of the poll too.
+
+Times are real (time.monotonic), a hang does not speed up with
+INDIDRIVERS_TIME_SCALE.
+
+Properties
+----------
+NP : heartbeat
+     one element per task (seconds since its last run finished), Loop Lag
+     (s), Recoveries
+TP : watchdog_events
+     Event 1 .. Event N, latest first
+"""
+import asyncio
+import collections
+import functools
+import inspect
+import queue
+import threading
+import time
+from datetime import datetime
+
+from pyindi.device import (
+    INumber, INumberVector, IPerm, IPState, IText, ITextVector
+)
+
+
+def resolve(future, result, error):
+    """Completes future unless its run was cancelled meanwhile"""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class Worker(threading.Thread):
+    """Daemon thread running blocking calls one at a time
+
+    Unlike a ThreadPoolExecutor's threads a daemon does not keep the driver
+    from exiting while it is stuck in a call.
+    """
+    def __init__(self):
+        super().__init__(name='watchdog', daemon=True)
+        self.calls = queue.SimpleQueue()
+
+    def submit(self, function):
+        """Queues function, returns an asyncio future of its result"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.calls.put((loop, future, function))
+        return future
+
+    def stop(self):
+        """Ends the thread once it is done with the call it is in, returns
+        the calls still queued behind it as (loop, future, function)"""
+        queued = []
+        while True:
+            try:
+                item = self.calls.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                queued.append(item)
+        self.calls.put(None)
+        return queued
+
+    def run(self):
+        while True:
+            item = self.calls.get()
+            if item is None:
+                return
+            loop, future, function = item
+            result = error = None
+            try:
+                result = function()
+            except Exception as e:
+                error = e
+            loop.call_soon_threadsafe(resolve, future, result, error)
+
+
+class Watchdog():
+    """Runs and watches poll tasks, see module docstring
+
+    Parameters
+    ----------
+    device : str
+        Device name to attach to
+    deadlines : dict
+        Task name to the seconds a run may take
+    misses : int
+        Deadlines a task may miss before it is recovered
+    reconnect : callable or None
+        Replaces the driver's connection after a stall
+    log : indidrivers.log.DriverLog or None
+        Where to report recoveries
+    keep : int
+        Recovery events kept in watchdog_events
+    interval : float
+        Seconds between calls of check, to measure loop lag
+    """
+    def __init__(self, device, deadlines, misses=3, reconnect=None, log=None,
+                 keep=5, interval=1.0):
+        self.device = device
+        self.deadlines = dict(deadlines)
+        self.misses = misses
+        self.reconnect = reconnect
+        self.log = log
+        self.keep = keep
+        self.interval = interval
+        now = time.monotonic()
+        # Starting counts as a heartbeat
+        self.last = {name: now for name in self.deadlines}
+        self.started = {name: None for name in self.deadlines}
+        self.tasks = {name: None for name in self.deadlines}
+        self.events = collections.deque(maxlen=keep)
+        self.recoveries = 0
+        self.loop_lag = 0.0
+        self.last_check = None
+        self.worker = None
+
+    def properties(self, group):
+        """Builds the heartbeat NP and watchdog_events TP"""
+        numbers = [
+            INumber(name, '%.1f', 0, 1e9, 0, 0, f'{name.title()} (s)')
+            for name in self.deadlines
+        ]
+        numbers += [
+            INumber('loop_lag', '%.3f', 0, 1e9, 0, 0, 'Loop Lag (s)'),
+            INumber('recoveries', '%.0f', 0, 1e9, 0, self.recoveries,
+                    'Recoveries'),
+        ]
+        nvp = INumberVector(
+            numbers, self.device, 'heartbeat', IPState.IDLE, IPerm.RO, 0,
+            None, 'Heartbeat', group
+        )
+        events = list(self.events)
+        texts = [
+            IText(
+                f'event_{i + 1}', events[i] if i < len(events) else '',
+                f'Event {i + 1}'
+            )
+            for i in range(self.keep)
+        ]
+        tvp = ITextVector(
+            texts, self.device, 'watchdog_events', IPState.IDLE, IPerm.RO, 0,
+            None, 'Recoveries', group
+        )
+
+        return nvp, tvp
+
+    def start(self, name, run):
+        """Starts run() (a coroutine function) as task name if it is not
+        still running
+
+        Returns True if a run was started.
+        """
+        task = self.tasks[name]
+        if task is not None and not task.done():
+            return False
+        self.started[name] = time.monotonic()
+        task = asyncio.ensure_future(run())
+        task.add_done_callback(functools.partial(self.finished, name))
+        self.tasks[name] = task
+        return True
+
+    def beat(self, name):
+        """Heartbeat of task name without a run, e.g. a pushed update"""
+        self.last[name] = time.monotonic()
+
+    def finished(self, name, task):
+        """Done callback of a run, a heartbeat unless it was cancelled"""
+        if task.cancelled():
+            return
+        self.last[name] = time.monotonic()
+        e = task.exception()
+        if e is not None and self.log is not None:
+            self.log.error('%s failed: %s', name, e)
+
+    async def call(self, function, *args):
+        """Runs a blocking function in the worker thread, a coroutine
+        function (async client) is awaited on the loop instead
+
+        Polls and commands alike, one at a time in the order called.
+        """
+        if inspect.iscoroutinefunction(function):
+            return await function(*args)
+        if self.worker is None:
+            self.worker = Worker()
+            self.worker.start()
+        return await self.worker.submit(functools.partial(function, *args))
+
+    def age(self, name, now=None):
+        """Seconds since task name last finished a run"""
+        now = time.monotonic() if now is None else now
+        return now - self.last[name]
+
+    def running(self, name, now=None):
+        """Seconds the current run of task name has taken, 0 if none"""
+        task = self.tasks[name]
+        if task is None or task.done():
+            return 0.0
+        now = time.monotonic() if now is None else now
+        return now - self.started[name]
+
+    def check(self, driver):
+        """Recovers stalled tasks and publishes heartbeat"""
+        now = time.monotonic()
+        if self.last_check is not None:
+            self.loop_lag = max(0.0, now - self.last_check - self.interval)
+        self.last_check = now
+
+        for name, deadline in self.deadlines.items():
+            if self.running(name, now) > deadline * self.misses:
+                self.recover(driver, name, now)
+
+        try:
+            nvp = driver.IUFind('heartbeat')
+        except ValueError:
+            return
+        state = IPState.OK
+        for name, deadline in self.deadlines.items():
+            nvp[name].value = self.age(name)
+            if self.running(name) > deadline:
+                state = IPState.ALERT
+        nvp['loop_lag'].value = self.loop_lag
+        nvp['recoveries'].value = self.recoveries
+        nvp.state = state
+        driver.IDSet(nvp)
+
+        return
+
+    def recover(self, driver, name, now=None):
+        """Cancels task name, replaces the worker and reconnects"""
+        start = time.perf_counter()
+        stalled = self.running(name, now)
+        task = self.tasks[name]
+        if task is not None and not task.done():
+            task.cancel()
+        self.tasks[name] = None
+        # The thread stuck in the call cannot be stopped, leave it behind
+        if self.worker is not None:
+            for _, future, _ in self.worker.stop():
+                resolve(future, None, ConnectionError('connection replaced'))
+            self.worker = None
+        result = 'reconnected'
+        if self.reconnect is not None:
+            try:
+                self.reconnect()
+            except Exception as e:
+                result = f'reconnect failed: {e}'
+        else:
+            result = 'restarted'
+        elapsed = (time.perf_counter() - start) * 1000
+        self.recoveries += 1
+
+        event = (
+            f'{datetime.now():%Y-%m-%d %H:%M:%S} {name} stalled '
+            f'{stalled:.1f}s, {result} in {elapsed:.1f} ms'
+        )
+        self.events.appendleft(event)
+        if self.log is not None:
+            self.log.warning('Watchdog: %s', event)
+        try:
+            tvp = driver.IUFind('watchdog_events')
+        except ValueError:
+            return
+        for element, text in zip(tvp, self.events):
+            element.value = text
+        tvp.state = IPState.ALERT
+        driver.IDSet(tvp)
+
+        return
@@ -0,0 +1,81 @@
+import asyncio
+
+from indidrivers.interlock import Action, InterlockEngine, Rule
+
+
+def make_engine(results):
+    """Engine with a rain rule and one action returning results in turn"""
+    calls = []
+
+    def close():
+        calls.append(len(calls))
+        return results[min(len(calls), len(results)) - 1]
+
+    engine = InterlockEngine(
+        rules=[Rule('rain', 'rain_condition', ['Raining'], clear_after=900)],
+        actions=[Action('close', close)]
+    )
+    return engine, calls
+
+
+def evaluate(engine, condition, now):
+    return asyncio.run(
+        engine.evaluate({'rain_condition': condition}, 0.0, now=now)
+    )
+
+
+def test_trip_runs_actions_once():
+    engine, calls = make_engine([True])
+    engine.arm()
+    assert evaluate(engine, 'Dry', 0) == []
+    assert [ok for _, ok in evaluate(engine, 'Raining', 1)] == [True]
+    assert evaluate(engine, 'Raining', 2) == []
+    assert calls == [0]
+
+
+def test_arm_while_tripped_runs_actions():
+    engine, calls = make_engine([True])
+    evaluate(engine, 'Raining', 0)
+    assert engine.tripped and calls == []
+
+    engine.arm()
+    assert [ok for _, ok in evaluate(engine, 'Raining', 1)] == [True]
+    assert evaluate(engine, 'Raining', 2) == []
+    assert calls == [0]
+
+
+def test_failed_action_is_retried():
+    engine, calls = make_engine([False, False, True])
+    engine.arm()
+    assert [ok for _, ok in evaluate(engine, 'Raining', 0)] == [False]
+    assert [ok for _, ok in evaluate(engine, 'Raining', 1)] == [False]
+    assert [ok for _, ok in evaluate(engine, 'Raining', 2)] == [True]
+    assert evaluate(engine, 'Raining', 3) == []
+    assert len(calls) == 3
+
+
+def test_raising_action_is_retried_while_tripped():
+    state = {'fail': True}
+
+    def close():
+        if state['fail']:
+            raise ConnectionError('no answer')
+        return True
+
+    engine = InterlockEngine(
+        rules=[Rule('rain', 'rain_condition', ['Raining'], clear_after=900)],
+        actions=[Action('close', close)]
+    )
+    engine.arm()
+    assert [ok for _, ok in evaluate(engine, 'Raining', 0)] == [False]
+    state['fail'] = False
+    # Still pending while the rule stays tripped, even once it reads dry
+    assert [ok for _, ok in evaluate(engine, 'Dry', 1)] == [True]
+
+
+def test_disarm_forgets_pending():
+    engine, calls = make_engine([False])
+    engine.arm()
+    evaluate(engine, 'Raining', 0)
+    engine.disarm()
+    assert engine.pending == [] and not engine.tripped
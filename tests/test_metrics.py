@@ -0,0 +1,15 @@
+import math
+
+from indidrivers.metrics import format_value
+
+
+def test_format_value_spells_openmetrics_specials():
+    assert format_value(math.nan) == 'NaN'
+    assert format_value(math.inf) == '+Inf'
+    assert format_value(-math.inf) == '-Inf'
+
+
+def test_format_value_numbers():
+    assert format_value(0.25) == '0.25'
+    assert format_value(3) == '3'
+    assert format_value(True) == '1'
@@ -0,0 +1,99 @@
+from pyindi.device import INumber, INumberVector, IPerm, IPState
+
+from indidrivers.outqueue import OutputQueue
+
+
+class Driver():
+    """Records what the queue hands on, as (state, value) or the message"""
+    def __init__(self):
+        self.out = []
+
+    def IDSet(self, vp, msg=None):
+        self.out.append((vp.name, vp.state, vp['value'].value))
+
+    def IDMessage(self, msg, *args, **kwargs):
+        self.out.append(msg)
+
+
+def vector(name):
+    return INumberVector(
+        [INumber('value', '%.0f', 0, 100, 0, 0, 'Value')], 'Test', name,
+        IPState.IDLE, IPerm.RO, 0, None, name, 'Main'
+    )
+
+
+def queued():
+    """A queue that is not handed on until send_next"""
+    driver = Driver()
+    output = OutputQueue('Test')
+    output.attach(driver)
+    output.kick = lambda: None
+    return output, driver
+
+
+def flush(output):
+    while output.pending:
+        output.send_next()
+
+
+def test_sets_and_messages_in_pending_order():
+    output, driver = queued()
+    a, b = vector('a'), vector('b')
+    output.message('first')
+    output.set(a)
+    output.message('second')
+    output.set(b)
+    flush(output)
+    assert driver.out == [
+        'first', ('a', IPState.IDLE, 0), 'second', ('b', IPState.IDLE, 0),
+    ]
+
+
+def test_same_state_coalesced_in_place():
+    output, driver = queued()
+    a, b = vector('a'), vector('b')
+    output.set(a)
+    output.set(b)
+    a['value'].value = 5
+    output.set(a)
+    flush(output)
+    assert driver.out == [('a', IPState.IDLE, 5), ('b', IPState.IDLE, 0)]
+    assert output.coalesced == 1
+
+
+def test_state_change_not_coalesced():
+    output, driver = queued()
+    a = vector('a')
+    a.state = IPState.BUSY
+    a['value'].value = 1
+    output.set(a)
+    a.state = IPState.OK
+    a['value'].value = 2
+    output.set(a)
+    flush(output)
+    assert driver.out == [('a', IPState.BUSY, 1), ('a', IPState.OK, 2)]
+    # The driver's vector is left as the driver set it
+    assert (a.state, a['value'].value) == (IPState.OK, 2)
+
+
+def test_oldest_message_dropped():
+    output, driver = queued()
+    output.configure(max_messages=2)
+    for msg in ('one', 'two', 'three'):
+        output.message(msg)
+    flush(output)
+    assert driver.out == ['two', 'three']
+    assert output.dropped == 1
+
+
+def test_flapping_state_keeps_one_slot():
+    output, driver = queued()
+    a = vector('a')
+    for i in range(10000):
+        a.state = IPState.OK if i % 2 else IPState.BUSY
+        a['value'].value = i
+        output.set(a)
+    assert len(output.pending) == 1
+    flush(output)
+    # The last state change still reaches clients
+    assert driver.out == [('a', IPState.BUSY, 9998), ('a', IPState.OK, 9999)]
@@ -0,0 +1,45 @@
+from indidrivers.phases import PhaseTimer
+
+SEQUENCES = {
+    'open_all': ['slit_opening', 'windscreen_opening'],
+    'close_all': ['windscreen_closing', 'slit_closing'],
+}
+
+
+def run(timer, phases, ended=None):
+    """Feeds phases one second apart, then idle with ended"""
+    t = 0.0
+    for phase in phases:
+        timer.update(phase, now=t)
+        t += 1.0
+    return timer.update('idle', now=t, ended=ended)
+
+
+def test_sequence_to_its_end_samples_every_phase():
+    timer = PhaseTimer(SEQUENCES)
+    assert run(timer, SEQUENCES['open_all'], ended='open_all') == 1.0
+    assert timer.stats['slit_opening'].count == 1
+    assert timer.stats['windscreen_opening'].count == 1
+
+
+def test_leaving_last_phase_without_its_end_is_not_sampled():
+    for ended in (None, 'close_all'):
+        timer = PhaseTimer(SEQUENCES)
+        assert run(timer, SEQUENCES['open_all'], ended=ended) is None
+        assert timer.stats['slit_opening'].count == 1
+        assert timer.stats['windscreen_opening'].count == 0
+
+
+def test_fault_in_last_phase_is_not_sampled():
+    timer = PhaseTimer(SEQUENCES)
+    timer.update('windscreen_closing', now=0.0)
+    timer.update('slit_closing', now=1.0)
+    assert timer.update('fault', now=2.0) is None
+    assert timer.stats['slit_closing'].count == 0
+
+
+def test_new_command_cuts_phase_short():
+    timer = PhaseTimer(SEQUENCES)
+    timer.update('slit_opening', now=0.0)
+    assert timer.update('windscreen_closing', now=1.0) is None
+    assert timer.stats['slit_opening'].count == 0
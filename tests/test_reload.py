@@ -0,0 +1,39 @@
+import pytest
+
+from indidrivers.reload import check_config
+
+
+def configure(max_backlog=50, retry=0.1):
+    pass
+
+
+CONFIG = {
+    'log': {'level': 'info'},
+    'output': {'max_backlog': 50, 'retry': 0.1},
+    'thresholds': {'spread': [3.0, 1.0]},
+}
+CHECKS = dict(
+    configures=[('output', configure)], numbers=['output.retry', 'thresholds'],
+    choices={'log.level': ('debug', 'info')},
+)
+
+
+def test_valid_config_passes():
+    check_config(CONFIG, **CHECKS)
+
+
+@pytest.mark.parametrize('section, value', [
+    ('log', {'level': 'verbose'}),
+    ('output', {'max_backlog': 50, 'retyr': 0.1}),
+    ('output', {'max_backlog': 50, 'retry': 'fast'}),
+    ('output', 50),
+    ('thresholds', {'spread': [3.0, None]}),
+])
+def test_bad_section_rejected(section, value):
+    with pytest.raises(ValueError):
+        check_config(dict(CONFIG, **{section: value}), **CHECKS)
+
+
+def test_missing_key_rejected():
+    with pytest.raises(ValueError, match='missing output.retry'):
+        check_config(dict(CONFIG, output={'max_backlog': 50}), **CHECKS)
@@ -0,0 +1,23 @@
+import pytest
+
+from indidrivers.scheduling import AdaptivePoller
+
+
+def flat(poller, samples, start=0.0):
+    """Feeds samples of an unchanging channel, returns the last period"""
+    for i in range(samples):
+        period = poller.sample({'temperature': 10.0}, now=start + i)
+    return period
+
+
+def test_flat_channel_slows_to_max_period():
+    poller = AdaptivePoller(0.5, 1, scales={'temperature': 0.5})
+    assert flat(poller, 50) == pytest.approx(1, abs=1e-3)
+
+
+def test_fast_holds_min_period():
+    poller = AdaptivePoller(0.5, 1, scales={'temperature': 0.5})
+    poller.fast = True
+    assert flat(poller, 50) == 0.5
+    poller.fast = False
+    assert flat(poller, 50, start=50) == pytest.approx(1, abs=1e-3)
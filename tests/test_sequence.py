@@ -0,0 +1,95 @@
+import asyncio
+
+from indidrivers.sequence import LampSequencer, Step, switch_lamps
+
+
+class Driver():
+    """No properties, the sequencer publishes nothing"""
+    def IUFind(self, name):
+        raise ValueError(name)
+
+
+class Flatfield():
+    def __init__(self):
+        self.commands = []
+        self.halogen = False
+        self.uband = False
+
+    def command_halogen(self, on):
+        self.commands.append(('halogen', on))
+        self.halogen = on
+        return True
+
+    def command_uband(self, on):
+        self.commands.append(('uband', on))
+        self.uband = on
+        return True
+
+    def request_all(self):
+        return {'halogen_lamps': self.halogen, 'uband_lamps': self.uband}
+
+
+async def slow_on(method, *args):
+    """Calls method, switching on takes long enough to be aborted"""
+    if args == (True,):
+        await asyncio.sleep(10)
+    return method(*args)
+
+
+def test_abort_while_switching_on_switches_off():
+    flatfield = Flatfield()
+    sequencer = LampSequencer(
+        'Test', lambda: flatfield, confirm_interval=0.01, call=slow_on
+    )
+
+    async def abort():
+        task = asyncio.ensure_future(
+            sequencer.run(Driver(), [Step('halogen', 1, 0)])
+        )
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await task
+
+    asyncio.run(abort())
+    assert flatfield.commands == [('halogen', False)]
+    assert sequencer.lit == set()
+
+
+def test_run_forgets_lamps_of_earlier_run():
+    flatfield = Flatfield()
+    sequencer = LampSequencer(
+        'Test', lambda: flatfield, confirm_interval=0.01,
+        call=lambda method, *args: asyncio.sleep(0, method(*args))
+    )
+    sequencer.lit.add('uband')
+    asyncio.run(sequencer.run(Driver(), [Step('halogen', 0, 0)]))
+    assert flatfield.commands == [('halogen', True), ('halogen', False)]
+    assert sequencer.lit == set()
+
+
+def test_poll_during_two_lamp_command():
+    """A poll that publishes the lamps while the first command is on its
+    way does not change what the click commands"""
+    flatfield = Flatfield()
+    switch = {'halogen': True, 'uband': True} # As clicked
+
+    async def slow(method, *args):
+        await asyncio.sleep(0.05)
+        return method(*args)
+
+    async def poll():
+        await asyncio.sleep(0.01)
+        data = flatfield.request_all()
+        switch['halogen'] = data['halogen_lamps']
+        switch['uband'] = data['uband_lamps']
+
+    async def click():
+        lamps = dict(switch)
+        results = await asyncio.gather(
+            switch_lamps(lambda: flatfield, lamps, call=slow), poll()
+        )
+        return results[0]
+
+    assert asyncio.run(click())
+    assert flatfield.commands == [('halogen', True), ('uband', True)]
+    assert (flatfield.halogen, flatfield.uband) == (True, True)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""bench_async.py
+
+How responsive the driver's event loop stays while it polls a slow
+controller, with
+
+    sync/loop   : blocking TelemetryClient called on the loop, how the
+                  drivers polled before the watchdog
+    sync/thread : the same client called in a worker thread, how the
+                  drivers poll with INDIDRIVERS_CLIENT=sync
+    async       : AsyncTelemetryClient awaited on the loop,
+                  INDIDRIVERS_CLIENT=async
+
+A poll of the observatory snapshot is started every --period seconds
+(skipped while the previous one still runs, like Watchdog.start) and a
+probe sleeping 10 ms stands in for everything else the loop does: client
+messages, freshness checks, other repeats. How late the probe wakes up is
+the loop lag a client would see.
+
+    python tools/bench_async.py --delay 0.5 --period 1 --seconds 10
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from indidrivers.simulator import SimObservatory
+from indidrivers.telemetry import (
+    AsyncTelemetryClient, TelemetryClient, TelemetryServer
+)
+
+SNAPSHOT = [
+    ('boltwood', 'request_all', ()),
+    ('onewire', 'request_all', ()),
+    ('upperdome', 'request_all', ()),
+    ('mirror_cover', 'request_state', ()),
+]
+
+PROBE = 0.01
+
+
+def make_poll(mode, port):
+    """Returns (poll coroutine function, close)"""
+    if mode == 'async':
+        client = AsyncTelemetryClient(port=port)
+
+        async def poll():
+            await client.request_many(SNAPSHOT)
+        return poll, client.close
+
+    client = TelemetryClient(port=port)
+    if mode == 'sync/loop':
+        async def poll():
+            client.request_many(SNAPSHOT)
+    else:
+        async def poll():
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, client.request_many, SNAPSHOT)
+    return poll, client.close
+
+
+async def run(mode, port, period, seconds):
+    """Polls and probes for seconds, returns (lags, polls)"""
+    poll, close = make_poll(mode, port)
+    lags = []
+    polls = 0
+    task = None
+    end = time.perf_counter() + seconds
+    next_poll = time.perf_counter()
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        if now >= next_poll:
+            next_poll += period
+            if task is None or task.done():
+                if task is not None:
+                    polls += 1
+                task = asyncio.ensure_future(poll())
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE)
+        lags.append(max(0.0, time.perf_counter() - start - PROBE))
+    if task is not None:
+        await task
+        polls += 1
+    close()
+
+    return lags, polls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument(
+        '--delay', type=float, default=0.5, help='seconds per reply'
+    )
+    parser.add_argument(
+        '--period', type=float, default=1.0, help='seconds between polls'
+    )
+    parser.add_argument('--seconds', type=float, default=10.0)
+    args = parser.parse_args()
+
+    server = TelemetryServer(SimObservatory(), port=0, delay=args.delay)
+    port = server.start_in_thread()
+
+    results = {}
+    for mode in ('sync/loop', 'sync/thread', 'async'):
+        results[mode] = asyncio.run(
+            run(mode, port, args.period, args.seconds)
+        )
+    server.stop()
+
+    print(f'snapshot of {len(SNAPSHOT)} requests, reply delay '
+          f'{args.delay * 1000:.0f} ms, poll every {args.period:.1f} s, '
+          f'{args.seconds:.0f} s')
+    print(f'{"mode":<12} {"lag p50 ms":>11} {"p99 ms":>8} {"max ms":>8} '
+          f'{"probes":>7} {"polls":>6}')
+    for mode, (lags, polls) in results.items():
+        p99 = sorted(lags)[int(0.99 * (len(lags) - 1))]
+        print(f'{mode:<12} {statistics.median(lags) * 1000:>11.1f} '
+              f'{p99 * 1000:>8.1f} {max(lags) * 1000:>8.1f} '
+              f'{len(lags):>7} {polls:>6}')
+
+
+if __name__ == '__main__':
+    main()
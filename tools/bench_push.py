@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""bench_push.py
+
+How long a state change takes to reach a driver, and what an idle
+subsystem costs on the wire, with
+
+    poll : request_all every --period seconds, how the drivers poll
+    push : a subscription sampled every --sample seconds on the server,
+           how the drivers run with a telemetry:// backend and push on
+
+against a local stand-in TelemetryServer serving the simulator with a
+reply delay standing in for the network. Each round switches the 90Prime
+halogen lamp at a random moment and times how long until the observer
+sees it, the command's own round trip included. Idle traffic is what the
+server sends while nothing changes.
+
+    python tools/bench_push.py --delay 0.01 --rounds 20
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from indidrivers.simulator import SimObservatory
+from indidrivers.telemetry import AsyncTelemetryClient, TelemetryServer
+
+SUBSYSTEM = 'ninety_prime_flatfield'
+
+
+class Observer():
+    """Remembers the lamp state and wakes whoever waits for a change"""
+    def __init__(self):
+        self.halogen = None
+        self.changed = asyncio.Event()
+
+    def see(self, data):
+        if isinstance(data, Exception):
+            return
+        if data['halogen_lamps'] != self.halogen:
+            self.halogen = data['halogen_lamps']
+            self.changed.set()
+
+
+async def observe(mode, client, observer, period, sample):
+    """Polls, or subscribes and waits, until cancelled"""
+    if mode == 'push':
+        _, data = await client.subscribe(
+            SUBSYSTEM, 'request_all', (), observer.see, sample, keepalive=2.0
+        )
+        observer.see(data)
+        await asyncio.Event().wait()
+    while True:
+        observer.see(await client.request(SUBSYSTEM, 'request_all'))
+        await asyncio.sleep(period)
+
+
+async def run(mode, server, args):
+    """Returns (latencies, idle bytes per second)"""
+    client = AsyncTelemetryClient(port=server.port)
+    commander = AsyncTelemetryClient(port=server.port)
+    observer = Observer()
+    task = asyncio.ensure_future(
+        observe(mode, client, observer, args.period, args.sample)
+    )
+    await asyncio.sleep(0.5)
+
+    latencies = []
+    for _ in range(args.rounds):
+        await asyncio.sleep(random.uniform(0.1, 1.0))
+        observer.changed.clear()
+        start = time.perf_counter()
+        await commander.request(
+            SUBSYSTEM, 'command_halogen', not observer.halogen
+        )
+        await observer.changed.wait()
+        latencies.append(time.perf_counter() - start)
+
+    sent = server.sent
+    await asyncio.sleep(args.idle)
+    idle = (server.sent - sent) / args.idle
+
+    task.cancel()
+    client.close()
+    commander.close()
+
+    return latencies, idle
+
+
+async def main_async(args):
+    server = TelemetryServer(SimObservatory(), port=0, delay=args.delay)
+    await server.start()
+    results = {}
+    for mode in ('poll', 'push'):
+        results[mode] = await run(mode, server, args)
+    await server.close()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument(
+        '--delay', type=float, default=0.01, help='seconds per reply'
+    )
+    parser.add_argument(
+        '--period', type=float, default=1.0, help='seconds between polls'
+    )
+    parser.add_argument(
+        '--sample', type=float, default=0.05,
+        help='seconds between the server\'s samples'
+    )
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument(
+        '--idle', type=float, default=10.0, help='seconds of idle traffic'
+    )
+    args = parser.parse_args()
+
+    results = asyncio.run(main_async(args))
+
+    print(f'reply delay {args.delay * 1000:.0f} ms, poll every '
+          f'{args.period:.2f} s, push sampled every {args.sample:.2f} s, '
+          f'{args.rounds} changes')
+    print(f'{"mode":<6} {"median ms":>10} {"p95 ms":>8} {"max ms":>8} '
+          f'{"idle B/s":>9}')
+    for mode, (latencies, idle) in results.items():
+        p95 = sorted(latencies)[int(0.95 * (len(latencies) - 1))]
+        print(f'{mode:<6} {statistics.median(latencies) * 1000:>10.1f} '
+              f'{p95 * 1000:>8.1f} {max(latencies) * 1000:>8.1f} '
+              f'{idle:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""bench_readings.py
+
+What the weather readings (out_readings, in_readings, boltwood) cost on the
+wire and in a client, published
+
+    text   : ITextVectors, text_readings on, how the driver always did
+    number : INumberVectors with format, range and units (the default)
+
+Runs the weather driver on the simulated backend under the indiserver
+stand-in (tools/indiserver_standin.py) once per mode, with a throwaway
+config (INDIDRIVERS_CONFIG_DIR), and keeps every readings message it
+sends. Per mode it reports
+
+    msgs        set messages of the readings vectors
+    B/msg       their mean size as sent
+    def B       size of the three definitions
+    parse us    time per message for a client to parse it and get the
+                readings as floats. A text client has to guess: every value
+                is tried as a number and whatever is not one (Yes/No, '')
+                handled. A number client converts, the definition already
+                told it the element is a number.
+
+    python tools/bench_readings.py --seconds 20 --speed 10
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+from indiserver_standin import GET_PROPERTIES, DriverProcess
+
+READINGS = {'out_readings', 'in_readings', 'boltwood'}
+
+
+def text_values(element):
+    """Readings of a setTextVector as floats, a client guessing types"""
+    values = {}
+    for one in element:
+        text = (one.text or '').strip()
+        try:
+            values[one.get('name')] = float(text)
+        except ValueError:
+            if text in ('Yes', 'No'):
+                values[one.get('name')] = float(text == 'Yes')
+            else:
+                values[one.get('name')] = None
+    return values
+
+
+def number_values(element):
+    """Readings of a setNumberVector as floats"""
+    return {one.get('name'): float(one.text) for one in element}
+
+
+async def collect(mode, seconds, speed):
+    """Runs the driver, returns (set messages, definitions) as bytes"""
+    sets, definitions = [], []
+
+    def keep(element, raw, read_at):
+        if element.get('name') not in READINGS:
+            return
+        if element.tag.startswith('set'):
+            sets.append(raw)
+        elif element.tag.startswith('def'):
+            definitions.append(raw)
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(f'{directory}/indi_big61_weather.json', 'w') as f:
+            json.dump({'text_readings': mode == 'text'}, f)
+        driver = DriverProcess(
+            'weather',
+            env={
+                'INDIDRIVERS_CONFIG_DIR': directory,
+                'INDIDRIVERS_STATE_DIR': directory,
+                'INDIDRIVERS_SIM_SPEED': str(speed),
+            },
+            on_element=keep
+        )
+        await driver.start()
+        driver.send(GET_PROPERTIES)
+        await asyncio.sleep(seconds)
+        await driver.stop()
+
+    return sets, definitions
+
+
+def parse_cost(mode, messages, repeat):
+    """Seconds per message to parse and extract the readings"""
+    values = text_values if mode == 'text' else number_values
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for raw in messages:
+            values(ET.fromstring(raw))
+    return (time.perf_counter() - start) / (repeat * len(messages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument(
+        '--seconds', type=float, default=20.0, help='seconds per mode'
+    )
+    parser.add_argument(
+        '--speed', type=float, default=10.0,
+        help='simulated weather changes this many times faster'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=200,
+        help='times every message is parsed for the parse cost'
+    )
+    args = parser.parse_args()
+
+    print(f'weather driver, {args.seconds:.0f} s per mode, sim speed '
+          f'{args.speed:g}')
+    print(f'{"mode":<7} {"msgs":>6} {"B/msg":>7} {"def B":>7} '
+          f'{"parse us":>9}')
+    for mode in ('text', 'number'):
+        sets, definitions = asyncio.run(
+            collect(mode, args.seconds, args.speed)
+        )
+        if not sets:
+            print(f'{mode:<7} no readings received')
+            continue
+        size = statistics.mean(len(raw) for raw in sets)
+        cost = parse_cost(mode, sets, args.repeat)
+        print(f'{mode:<7} {len(sets):>6} {size:>7.1f} '
+              f'{sum(len(raw) for raw in definitions[:3]):>7} '
+              f'{cost * 1e6:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
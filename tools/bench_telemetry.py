@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""bench_telemetry.py
+
+Compares what a full observatory snapshot (boltwood, onewire, upperdome,
+mirror_cover) costs with
+
+    sequential/new  : one connection per request, one after the other, like
+                      the drivers calling mtnpy today
+    sequential/keep : one persistent connection, still one request at a time
+    pipelined       : one persistent connection, all four requests in flight
+                      (TelemetryClient.request_many)
+
+against a local stand-in TelemetryServer serving the simulator with an
+artificial per-reply delay standing in for the network round trip.
+
+    python tools/bench_telemetry.py --delay 0.02 --rounds 50
+"""
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from indidrivers.simulator import SimObservatory
+from indidrivers.telemetry import TelemetryClient, TelemetryServer
+
+SNAPSHOT = [
+    ('boltwood', 'request_all', ()),
+    ('onewire', 'request_all', ()),
+    ('upperdome', 'request_all', ()),
+    ('mirror_cover', 'request_state', ()),
+]
+
+
+def sequential_new(port):
+    for subsystem, method, args in SNAPSHOT:
+        client = TelemetryClient(port=port)
+        client.request(subsystem, method, *args)
+        client.close()
+
+
+def sequential_keep(client):
+    for subsystem, method, args in SNAPSHOT:
+        client.request(subsystem, method, *args)
+
+
+def pipelined(client):
+    client.request_many(SNAPSHOT)
+
+
+def measure(func, rounds):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument(
+        '--delay', type=float, default=0.02, help='seconds per reply (RTT)'
+    )
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    server = TelemetryServer(SimObservatory(), port=0, delay=args.delay)
+    port = server.start_in_thread()
+    client = TelemetryClient(port=port)
+
+    results = {
+        'sequential/new': measure(lambda: sequential_new(port), args.rounds),
+        'sequential/keep': measure(lambda: sequential_keep(client), args.rounds),
+        'pipelined': measure(lambda: pipelined(client), args.rounds),
+    }
+    client.close()
+    server.stop()
+
+    print(f'snapshot of {len(SNAPSHOT)} requests, reply delay '
+          f'{args.delay * 1000:.1f} ms, {args.rounds} rounds')
+    print(f'{"mode":<16} {"median ms":>10} {"p95 ms":>10} {"RTTs":>6}')
+    for mode, times in results.items():
+        median = statistics.median(times)
+        p95 = sorted(times)[int(0.95 * (len(times) - 1))]
+        rtts = median / args.delay if args.delay else float('nan')
+        print(f'{mode:<16} {median * 1000:>10.1f} {p95 * 1000:>10.1f} '
+              f'{rtts:>6.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""indiserver_standin.py
+
+Just enough of indiserver to drive the drivers from the tools in this
+directory, without an INDI installation.
+
+DriverProcess
+    Runs one driver as a subprocess on the simulated backend, the way
+    indiserver does (INDI XML on stdin/stdout), and splits its output into
+    top level elements.
+Relay
+    TCP server that fans every driver message out to all connected clients
+    and forwards what clients send (getProperties, new*Vector) to the driver.
+    Each message is stamped with the time it was read from the driver so
+    clients in the same process can measure relay latency.
+Client
+    Simulated INDI client, connects to the relay, sends getProperties and
+    parses everything it receives.
+XMLStream
+    Incremental parser for the root-less INDI XML stream.
+"""
+import asyncio
+import hashlib
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+DRIVERS = {
+    'weather': REPO / 'indi-big61-weather' / 'indi_big61_weather.py',
+    'upperdome': REPO / 'indi-big61-upperdome' / 'indi_big61_upperdome.py',
+    'mirrorcover': REPO / 'indi-big61-mirrorcover'
+                   / 'indi_big61_mirrorcover.py',
+    'flatfield': REPO / 'indi-bok90-flatfield' / 'indi_bok90_flatfield.py',
+    'summary': REPO / 'indi-observatory-summary'
+               / 'indi_observatory_summary.py',
+}
+GET_PROPERTIES = b'<getProperties version="1.7"/>\n'
+
+
+class XMLStream():
+    """Feeds bytes in, gets complete top level elements out"""
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._parser.feed(b'<stream>')
+        self._depth = 0
+        self._root = None
+
+    def feed(self, data):
+        self._parser.feed(data)
+        elements = []
+        for event, element in self._parser.read_events():
+            if event == 'start':
+                if self._root is None:
+                    self._root = element
+                self._depth += 1
+                continue
+            self._depth -= 1
+            if self._depth == 1:
+                elements.append(element)
+                self._root.remove(element)
+
+        return elements
+
+
+def proc_stats(pid):
+    """Returns (cpu seconds, rss bytes) of pid from /proc"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+
+    return cpu, rss
+
+
+class DriverProcess():
+    """A driver running under the stand-in
+
+    Parameters
+    ----------
+    name : str
+        Key of DRIVERS or a path to a driver script
+    env : dict
+        Extra environment, the backend defaults to the simulator
+    on_element : callable
+        Called with (element, raw bytes, read time) for every message
+    """
+    def __init__(self, name, env=None, on_element=None):
+        self.path = DRIVERS.get(name, name)
+        self.env = dict(os.environ)
+        self.env.setdefault('INDIDRIVERS_BACKEND', 'sim')
+        self.env.update(env or {})
+        self.on_element = on_element
+        self.proc = None
+        self.messages = 0
+        self.bytes = 0
+        self._reader = None
+
+    async def start(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            sys.executable, str(self.path),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            env=self.env, cwd=str(Path(self.path).parent)
+        )
+        self._reader = asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        stream = XMLStream()
+        while True:
+            data = await self.proc.stdout.read(65536)
+            if not data:
+                break
+            now = time.perf_counter()
+            self.bytes += len(data)
+            for element in stream.feed(data):
+                self.messages += 1
+                if self.on_element is not None:
+                    self.on_element(element, canonical(element), now)
+
+    def send(self, data):
+        self.proc.stdin.write(data)
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    def stats(self):
+        """(cpu seconds, rss bytes) of the driver"""
+        return proc_stats(self.pid)
+
+    async def stop(self):
+        if self.proc.returncode is None:
+            self.proc.terminate()
+            await self.proc.wait()
+        self._reader.cancel()
+
+
+class Relay():
+    """Fans driver output out to TCP clients, see module docstring"""
+    def __init__(self, driver, host='localhost', port=0):
+        self.driver = driver
+        self.host = host
+        self.port = port
+        self.writers = set()
+        self.sent_at = {} # digest of a message -> time read from driver
+        self.getproperties = 0
+        self._server = None
+        driver.on_element = self.broadcast
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def broadcast(self, element, raw, read_at):
+        self.sent_at[digest(raw)] = read_at
+        if len(self.sent_at) > 100000:
+            # Dicts keep insertion order, drop the oldest
+            del self.sent_at[next(iter(self.sent_at))]
+        raw += b'\n'
+        for writer in list(self.writers):
+            if writer.is_closing():
+                self.writers.discard(writer)
+                continue
+            writer.write(raw)
+
+    async def _handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                self.getproperties += data.count(b'<getProperties')
+                self.driver.send(data)
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def stop(self):
+        self._server.close()
+        for writer in list(self.writers):
+            writer.close()
+
+
+def canonical(element):
+    """Bytes of element without whatever whitespace followed it"""
+    element.tail = None
+    return ET.tostring(element)
+
+
+def digest(raw):
+    return hashlib.blake2b(raw, digest_size=8).digest()
+
+
+class Client():
+    """Simulated INDI client connected to a Relay
+
+    latencies collects relay read -> client parsed delay in seconds for
+    every message the client could match.
+    """
+    def __init__(self, relay):
+        self.relay = relay
+        self.latencies = []
+        self.messages = 0
+        self.definitions = set()
+        self._task = None
+        self._writer = None
+
+    async def connect(self):
+        reader, self._writer = await asyncio.open_connection(
+            self.relay.host, self.relay.port
+        )
+        self._writer.write(GET_PROPERTIES)
+        self._task = asyncio.ensure_future(self._read(reader))
+
+    async def _read(self, reader):
+        stream = XMLStream()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            for element in stream.feed(data):
+                now = time.perf_counter()
+                self.messages += 1
+                if element.tag.startswith('def'):
+                    self.definitions.add(element.get('name'))
+                sent = self.relay.sent_at.get(digest(canonical(element)))
+                if sent is not None:
+                    self.latencies.append(now - sent)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._task is not None:
+            self._task.cancel()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""loadtest.py
+
+Multi-client fan-out load test.
+
+Runs each driver on the simulated backend behind the indiserver stand-in
+(tools/indiserver_standin.py) and connects more and more simulated clients.
+Every new client sends getProperties like a real one, which makes the driver
+re-define everything and indiserver send those definitions to every client,
+so connecting N clients costs N x N definition messages. For each client
+count the harness reports
+
+    storm ms   time until every new client has all definitions
+    msg/s      messages per second delivered to each client
+    p50/p95/max latency from the stand-in reading a message off the driver
+               to a client having parsed it
+    cpu %      driver CPU over the measuring window
+    rss MB     driver resident memory
+
+    python tools/loadtest.py --drivers weather upperdome --clients 10 50 200
+
+Clients are parsed in this process too, past a few hundred clients the
+harness itself becomes the bottleneck (watch its own CPU with top).
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from indiserver_standin import DRIVERS, Client, DriverProcess, Relay
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+async def wait_for_definitions(clients, wanted, timeout):
+    """Returns seconds until every client has wanted definitions, or None"""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if all(len(c.definitions) >= wanted for c in clients):
+            return time.perf_counter() - start
+        await asyncio.sleep(0.005)
+    return None
+
+
+async def run_driver(name, counts, duration, env):
+    driver = DriverProcess(name, env=env)
+    relay = Relay(driver)
+    await relay.start()
+    await driver.start()
+
+    # First client learns how many properties the driver defines
+    first = Client(relay)
+    await first.connect()
+    await asyncio.sleep(2.0)
+    wanted = len(first.definitions)
+    clients = [first]
+    rows = []
+
+    for count in counts:
+        new = [Client(relay) for _ in range(count - len(clients))]
+        await asyncio.gather(*(c.connect() for c in new))
+        clients += new
+        storm = await wait_for_definitions(new, wanted, timeout=30)
+
+        # Let the storm settle, then measure steady state
+        await asyncio.sleep(0.5)
+        for c in clients:
+            c.latencies.clear()
+            c.messages = 0
+        cpu_start, _ = driver.stats()
+        start = time.perf_counter()
+        await asyncio.sleep(duration)
+        elapsed = time.perf_counter() - start
+        cpu_end, rss = driver.stats()
+
+        latencies = [l for c in clients for l in c.latencies]
+        rows.append({
+            'clients': len(clients),
+            'storm': storm,
+            'rate': statistics.mean(c.messages for c in clients) / elapsed,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'max': max(latencies) if latencies else float('nan'),
+            'cpu': 100 * (cpu_end - cpu_start) / elapsed,
+            'rss': rss / 2**20,
+        })
+
+    for c in clients:
+        await c.close()
+    await relay.stop()
+    await driver.stop()
+
+    return wanted, rows
+
+
+def report(name, wanted, rows):
+    print(f'\n{name}: {wanted} properties')
+    print(f'{"clients":>7} {"storm ms":>9} {"msg/s":>7} {"p50 ms":>7} '
+          f'{"p95 ms":>7} {"max ms":>7} {"cpu %":>6} {"rss MB":>7}')
+    for r in rows:
+        storm = f'{r["storm"] * 1000:.0f}' if r['storm'] is not None else '>30s'
+        print(f'{r["clients"]:>7} {storm:>9} {r["rate"]:>7.1f} '
+              f'{r["p50"] * 1000:>7.2f} {r["p95"] * 1000:>7.2f} '
+              f'{r["max"] * 1000:>7.2f} {r["cpu"]:>6.1f} {r["rss"]:>7.1f}')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Multi-client load test')
+    parser.add_argument(
+        '--drivers', nargs='+', default=list(DRIVERS), choices=list(DRIVERS)
+    )
+    parser.add_argument(
+        '--clients', nargs='+', type=int, default=[10, 25, 50, 100, 200]
+    )
+    parser.add_argument(
+        '--duration', type=float, default=10.0,
+        help='seconds to measure at each client count'
+    )
+    parser.add_argument(
+        '--speed', type=float, default=10.0,
+        help='simulated mechanisms run this many times faster'
+    )
+    args = parser.parse_args()
+
+    env = {'INDIDRIVERS_SIM_SPEED': str(args.speed)}
+    for name in args.drivers:
+        wanted, rows = await run_driver(
+            name, sorted(args.clients), args.duration, env
+        )
+        report(name, wanted, rows)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
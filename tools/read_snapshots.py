@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""read_snapshots.py
+
+Reads a driver's side channel (see indidrivers/sidechannel.py) and prints
+every snapshot, or with --stats only the rate, the age of the data on
+arrival and the snapshots missed, every --every seconds. Also an example of
+a reader: one line of JSON describes the records, then every record is
+exactly size bytes.
+
+    python tools/read_snapshots.py ~/.local/state/indidrivers/upper_dome.sock
+"""
+import argparse
+import asyncio
+import json
+import struct
+import time
+
+
+async def read(path, stats, every):
+    try:
+        reader, writer = await asyncio.open_unix_connection(path)
+    except OSError as e:
+        print(f'Cannot connect to {path}: {e}, is side_channel enabled?')
+        return
+    description = json.loads(await reader.readline())
+    record = struct.Struct(description['format'])
+    fields = description['fields']
+    print(f"{description['device']}: {record.size} B records, "
+          f"{len(fields) - 3} fields, sources {description['sources']}")
+
+    last = None
+    count = missed = 0
+    ages = []
+    started = time.monotonic()
+    try:
+        while True:
+            values = dict(zip(
+                fields, record.unpack(await reader.readexactly(record.size))
+            ))
+            if last is not None and values['sequence'] != last + 1:
+                missed += values['sequence'] - last - 1
+            last = values['sequence']
+            count += 1
+            ages.append(time.time() - values['timestamp'])
+            if not stats:
+                print(' '.join(f'{name}={value}'
+                               for name, value in values.items()))
+                continue
+            elapsed = time.monotonic() - started
+            if elapsed >= every:
+                print(f'{count / elapsed:6.1f} Hz  age mean '
+                      f'{sum(ages) / len(ages) * 1000:7.1f} ms  max '
+                      f'{max(ages) * 1000:7.1f} ms  missed {missed}')
+                count, ages, started = 0, [], time.monotonic()
+    except asyncio.IncompleteReadError:
+        print('Driver closed the side channel')
+    finally:
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument('path', help='socket of the side channel')
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='print rate, data age and missed snapshots instead'
+    )
+    parser.add_argument(
+        '--every', type=float, default=5.0, help='seconds between stats'
+    )
+    args = parser.parse_args()
+    try:
+        asyncio.run(read(args.path, args.stats, args.every))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""soak.py
+
+Accelerated memory soak test.
+
+The drivers run for weeks, rebuilding dicts, strings and vectors on every
+poll, so a leak of a few bytes per poll only shows up long after a restart.
+This runs each driver on the simulated backend with compressed time
+(INDIDRIVERS_TIME_SCALE, see indidrivers.clock) until it has done a month of
+polling, sampling its RSS as it goes, with tracemalloc on so memory_growth
+names the source lines that allocated the most.
+
+Simulated time is read off the timestamps of data_age, which every driver
+stamps with its own clock, so a driver that cannot keep up with the scale
+simply takes longer rather than being credited with polls it never made.
+
+After the warm-up (caches, histograms and the first profile of every
+vector filling up) RSS should stay flat. The run fails, exit status 1, if
+any driver grows more than --max-growth MB after warm-up.
+
+    python tools/soak.py --days 30 --scale 2000 --max-growth 5
+"""
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from indiserver_standin import DRIVERS, GET_PROPERTIES, DriverProcess
+
+
+def parse_timestamp(text):
+    """Unix seconds of an INDI timestamp, None if there is none"""
+    try:
+        return datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.%f').replace(
+            tzinfo=timezone.utc
+        ).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class Soak():
+    """One driver under soak, see module docstring"""
+    def __init__(self, name, env):
+        self.name = name
+        self.driver = DriverProcess(name, env=env, on_element=self.on_element)
+        self.seconds = 0 # Simulated seconds since the first data_age
+        self.first = None # Driver time of the first data_age
+        self.samples = [] # (simulated seconds, rss bytes)
+        self.growth = []
+
+    def on_element(self, element, raw, read_at):
+        name = element.get('name')
+        if name == 'data_age':
+            stamp = parse_timestamp(element.get('timestamp'))
+            if stamp is None:
+                return
+            if self.first is None:
+                self.first = stamp
+            self.seconds = max(self.seconds, stamp - self.first)
+        elif name == 'memory_growth':
+            self.growth = [
+                one.text.strip() for one in element if one.text and
+                one.text.strip()
+            ]
+
+    async def run(self, seconds, sample, timeout):
+        await self.driver.start()
+        self.driver.send(GET_PROPERTIES)
+        start = time.monotonic()
+        while self.seconds < seconds:
+            if time.monotonic() - start > timeout:
+                break
+            await asyncio.sleep(sample)
+            if self.driver.proc.returncode is not None:
+                break
+            _, rss = self.driver.stats()
+            self.samples.append((self.seconds, rss))
+        await self.driver.stop()
+
+        return
+
+    def report(self, warmup, max_growth):
+        """Prints the result, returns True if memory stayed bounded"""
+        days = self.seconds / 86400
+        print(f'\n{self.name}: {days:.1f} simulated days')
+        if self.driver.proc.returncode not in (None, 0, -15):
+            print(f'  driver exited with {self.driver.proc.returncode}')
+            return False
+        settled = [rss for s, rss in self.samples if s >= warmup * self.seconds]
+        if len(settled) < 2:
+            print('  not enough samples after warm-up')
+            return False
+
+        growth = (settled[-1] - settled[0]) / 2**20
+        peak = max(settled) / 2**20
+        print(f'  rss after warm-up {settled[0] / 2**20:.1f} MB, '
+              f'end {settled[-1] / 2**20:.1f} MB, peak {peak:.1f} MB')
+        print(f'  growth {growth:+.2f} MB '
+              f'({growth / max(days, 1e-9):+.3f} MB per day)')
+        for line in self.growth:
+            print(f'  {line}')
+        ok = growth <= max_growth
+        print('  OK' if ok else f'  FAIL, more than {max_growth} MB')
+
+        return ok
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Accelerated memory soak')
+    parser.add_argument(
+        '--drivers', nargs='+', default=list(DRIVERS), choices=list(DRIVERS)
+    )
+    parser.add_argument(
+        '--days', type=float, default=30.0, help='simulated days to run'
+    )
+    parser.add_argument(
+        '--scale', type=float, default=2000.0,
+        help='driver time runs this many times faster than wall time'
+    )
+    parser.add_argument(
+        '--sample', type=float, default=5.0,
+        help='wall seconds between RSS samples'
+    )
+    parser.add_argument(
+        '--warmup', type=float, default=0.1,
+        help='fraction of the run ignored while memory settles'
+    )
+    parser.add_argument(
+        '--max-growth', type=float, default=5.0,
+        help='MB of RSS growth after warm-up that fails the run'
+    )
+    args = parser.parse_args()
+
+    seconds = args.days * 86400
+    # Allow a slow driver three times the nominal wall time
+    timeout = 3 * seconds / args.scale
+    with tempfile.TemporaryDirectory() as state:
+        env = {
+            'INDIDRIVERS_TIME_SCALE': str(args.scale),
+            'INDIDRIVERS_TRACEMALLOC': '1',
+            'INDIDRIVERS_STATE_DIR': state,
+        }
+        soaks = [Soak(name, env) for name in args.drivers]
+        print(f'{args.days:g} days at x{args.scale:g}, '
+              f'about {seconds / args.scale / 60:.0f} min')
+        await asyncio.gather(
+            *(s.run(seconds, args.sample, timeout) for s in soaks)
+        )
+
+    results = [s.report(args.warmup, args.max_growth) for s in soaks]
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))